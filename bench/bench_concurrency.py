@@ -0,0 +1,91 @@
+# Throughput of update processing with N simulated users.
+#
+#   python bench/bench_concurrency.py --users 50 --messages 4 --concurrency 64
+#
+# Compares PTB's default sequential processing with PerUserUpdateProcessor.
+# The "AI call" is simulated with asyncio.sleep (real OpenAI is 3–10 s,
+# default here is scaled down 10x). Also checks that updates of one user
+# stay in order and that the daily limit counter is never overrun.
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+os.environ.setdefault("RENDER_EXTERNAL_URL", "https://bench.invalid")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.chdir(tempfile.mkdtemp(prefix="bench_concurrency_"))
+
+import bot  # noqa: E402
+from telegram import Chat, Message, Update, User  # noqa: E402
+from telegram.ext import SimpleUpdateProcessor  # noqa: E402
+
+
+def make_update(update_id: int, user_id: int, text: str) -> Update:
+    user = User(id=user_id, first_name="u", is_bot=False)
+    chat = Chat(id=user_id, type=Chat.PRIVATE)
+    msg = Message(message_id=update_id, date=datetime.now(timezone.utc), chat=chat, from_user=user, text=text)
+    return Update(update_id=update_id, message=msg)
+
+
+async def run(processor, updates, contexts, latency, seen, sequential: bool) -> float:
+    async def handle(update: Update):
+        uid = update.effective_user.id
+        seen[uid].append(int(update.message.text))
+        allowed, _ = await bot.reserve_ai_call(update, contexts[uid])
+        if allowed:
+            await asyncio.sleep(random.uniform(*latency))
+
+    t0 = time.perf_counter()
+    if sequential:
+        for u in updates:
+            await processor.process_update(u, handle(u))
+    else:
+        await asyncio.gather(*(processor.process_update(u, handle(u)) for u in updates))
+    return time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=50)
+    ap.add_argument("--messages", type=int, default=4, help="messages per user")
+    ap.add_argument("--concurrency", type=int, default=bot.MAX_CONCURRENT_UPDATES)
+    ap.add_argument("--latency-min", type=float, default=0.3)
+    ap.add_argument("--latency-max", type=float, default=1.0)
+    ap.add_argument("--skip-sequential", action="store_true")
+    args = ap.parse_args()
+
+    bot.COOLDOWN_SECONDS = 0
+    latency = (args.latency_min, args.latency_max)
+
+    updates = []
+    for n in range(args.messages):
+        for uid in range(1, args.users + 1):
+            updates.append(make_update(len(updates) + 1, uid, str(n)))
+
+    modes = [("concurrent", bot.PerUserUpdateProcessor(args.concurrency), False)]
+    if not args.skip_sequential:
+        modes.insert(0, ("sequential", SimpleUpdateProcessor(1), True))
+
+    print(f"users={args.users} messages/user={args.messages} total={len(updates)} "
+          f"latency={latency[0]}–{latency[1]}s concurrency={args.concurrency}")
+    for name, processor, sequential in modes:
+        contexts = {uid: SimpleNamespace(user_data={}) for uid in range(1, args.users + 1)}
+        seen = {uid: [] for uid in contexts}
+        elapsed = asyncio.run(run(processor, updates, contexts, latency, seen, sequential))
+
+        ordered = all(v == sorted(v) for v in seen.values())
+        expected = min(args.messages, bot.FREE_DAILY_LIMIT)
+        counts_ok = all(c.user_data["limits"]["count"] == expected for c in contexts.values())
+        print(f"{name:>10}: {elapsed:7.2f} s  {len(updates) / elapsed:8.1f} updates/s  "
+              f"ordered={ordered} limits_ok={counts_ok}")
+
+
+if __name__ == "__main__":
+    main()
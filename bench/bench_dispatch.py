@@ -0,0 +1,107 @@
+# Per-update dispatch cost of handle_message (menu buttons and settings
+# flow, no OpenAI calls) and memory allocated per update.
+#
+#   python bench/bench_dispatch.py --save before.json
+#   ... change bot.py ...
+#   python bench/bench_dispatch.py --compare before.json
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date
+from types import SimpleNamespace
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:bench")
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+os.environ.setdefault("RENDER_EXTERNAL_URL", "https://bench.invalid")
+os.environ.setdefault("USER_STATE_ENABLED", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+START_DIR = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="bench_dispatch_"))
+
+import bot  # noqa: E402
+
+# one "session": every menu button plus the settings state machine
+SCRIPT = [
+    "⚙️ Налаштування", "🛒 Платформа", "Prom", "🎛 Шаблон стилю", "💎 Преміум",
+    "🌐 Мова", "🇬🇧 English", "💎 Сегмент", "преміум", "⬅️ Назад",
+    "🧠 Профіль", "⭐ Тарифи", "📌 Приклади", "ℹ️ Допомога", "🎯 DEMO",
+    "⭐ PRO 99 грн", "💎 PRO+ 199 грн", "🆔 Мій ID", "💬 Відповіді клієнтам",
+    "✍️ Опис товару", "⬅️ Назад", "щось незрозуміле",
+]
+
+
+async def _noop_reply(*args, **kwargs):
+    return None
+
+
+def make_update(text: str):
+    message = SimpleNamespace(text=text, reply_text=_noop_reply, reply_photo=_noop_reply)
+    return SimpleNamespace(message=message, effective_user=SimpleNamespace(id=42), effective_chat=None)
+
+
+async def run(rounds: int) -> dict:
+    context = SimpleNamespace(user_data={}, args=[])
+    bot.ensure_defaults(context)
+    context.user_data["demo_day"] = str(date.today())  # DEMO answers "already used", no AI
+    updates = [make_update(t) for t in SCRIPT]
+
+    for u in updates:  # warm-up
+        await bot.handle_message(u, context)
+
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        for u in updates:
+            await bot.handle_message(u, context)
+    elapsed = time.perf_counter() - t0
+    n = rounds * len(updates)
+
+    tracemalloc.start()
+    peaks = []
+    before = tracemalloc.take_snapshot()
+    for u in updates:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        await bot.handle_message(u, context)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(s.count_diff for s in after.compare_to(before, "filename") if s.count_diff > 0)
+
+    return {
+        "updates": n,
+        "us_per_update": elapsed / n * 1e6,
+        "peak_bytes_per_update": sum(peaks) / len(peaks),
+        "retained_blocks_per_session": blocks,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rounds", type=int, default=2000)
+    ap.add_argument("--save", help="write results to a JSON file")
+    ap.add_argument("--compare", help="compare with a previously saved JSON file")
+    args = ap.parse_args()
+
+    res = asyncio.run(run(args.rounds))
+    print(f"updates: {res['updates']}")
+    print(f"dispatch: {res['us_per_update']:.1f} µs/update")
+    print(f"peak allocation: {res['peak_bytes_per_update']:.0f} B/update")
+    print(f"retained blocks per session: {res['retained_blocks_per_session']}")
+
+    if args.compare:
+        with open(os.path.join(START_DIR, args.compare), "r", encoding="utf-8") as f:
+            old = json.load(f)
+        for key in ("us_per_update", "peak_bytes_per_update"):
+            print(f"{key}: {old[key]:.1f} -> {res[key]:.1f} ({res[key] / old[key] - 1:+.0%})")
+    if args.save:
+        with open(os.path.join(START_DIR, args.save), "w", encoding="utf-8") as f:
+            json.dump(res, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
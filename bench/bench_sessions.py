@@ -0,0 +1,213 @@
+# End-to-end benchmark of scripted user sessions against local fakes:
+# no real tokens are spent and nothing is sent to Telegram.
+#
+#   python bench/bench_sessions.py --users 50 --sessions 4 --save before.json
+#   ... change bot.py ...
+#   python bench/bench_sessions.py --users 50 --sessions 4 --compare before.json
+#
+# Every update goes through the same path as in production:
+# PerUserUpdateProcessor -> Application.process_update -> handlers ->
+# OpenAI client (FakeOpenAI over HTTP) -> Bot API (FakeBotAPI over HTTP).
+# Reports throughput, p50/p95/p99 per step kind (menu / ai) and memory.
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+from fakes import FakeBotAPI, FakeOpenAI, latency_summary, update_json  # noqa: E402
+
+# (text, kind): "ai" steps call OpenAI (unless a limit/cache answers first)
+SESSIONS = {
+    "demo": [("/start", "menu"), ("🎯 DEMO", "ai")],
+    "quick_replies": [("⚡ Швидкі відповіді", "menu"), ("💸 Дорого", "ai"), ("🚚 Доставка", "ai")],
+    "description": [
+        ("✍️ Опис товару", "menu"),
+        ("Кросівки Nike Air Max 90, шкіра, розміри 40-45, білі, оригінал, гарантія 14 днів", "ai"),
+    ],
+    "replies": [
+        ("💬 Відповіді клієнтам", "menu"),
+        ("Добрий день! А можна дешевше, якщо візьму дві пари? І коли відправите?", "ai"),
+    ],
+    "settings": [
+        ("⚙️ Налаштування", "menu"), ("🛒 Платформа", "menu"), ("Prom", "menu"),
+        ("🌐 Мова", "menu"), ("🇬🇧 English", "menu"), ("⬅️ Назад", "menu"), ("🧠 Профіль", "menu"),
+    ],
+}
+DEFAULT_MIX = "demo=1,quick_replies=2,description=2,replies=2,settings=1"
+
+
+def parse_mix(raw: str) -> dict[str, float]:
+    mix = {}
+    for part in raw.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=50, help="simulated users running at the same time")
+    ap.add_argument("--sessions", type=int, default=4, help="sessions per user")
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="session weights, e.g. demo=1,settings=3")
+    ap.add_argument("--tiers", default="free=0.7,pro=0.2,pro_plus=0.1", help="share of users per tier")
+    ap.add_argument("--think", type=float, default=0.0, help="pause between steps of one user, s")
+    ap.add_argument("--cooldown", type=float, default=0.0, help="bot COOLDOWN_SECONDS during the run")
+    ap.add_argument("--latency", type=float, default=1.5, help="fake OpenAI median latency, s")
+    ap.add_argument("--latency-sigma", type=float, default=0.4)
+    ap.add_argument("--tokens", type=float, default=250, help="mean completion tokens")
+    ap.add_argument("--tokens-sd", type=float, default=80)
+    ap.add_argument("--openai-errors", type=float, default=0.0, help="share of fake OpenAI 500s")
+    ap.add_argument("--telegram-latency", type=float, default=0.0, help="fake Bot API latency, s")
+    ap.add_argument("--no-stream", action="store_true", help="STREAM_REPLIES=0")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--tracemalloc", action="store_true", help="also measure Python heap peak (slower)")
+    ap.add_argument("--save", help="write results to a JSON file")
+    ap.add_argument("--compare", help="compare with a previously saved JSON file")
+    return ap.parse_args()
+
+
+args = parse_args()
+START_DIR = os.getcwd()
+WORK_DIR = tempfile.mkdtemp(prefix="bench_sessions_")
+shutil.copy(os.path.join(BENCH_DIR, "..", "welcome.png"), WORK_DIR)
+os.chdir(WORK_DIR)
+
+openai_fake = FakeOpenAI(
+    latency_median=args.latency,
+    latency_sigma=args.latency_sigma,
+    tokens_mean=args.tokens,
+    tokens_sd=args.tokens_sd,
+    error_rate=args.openai_errors,
+    seed=args.seed,
+)
+telegram_fake = FakeBotAPI(latency=args.telegram_latency)
+os.environ.update({
+    "TELEGRAM_BOT_TOKEN": "123456:bench",
+    "OPENAI_API_KEY": "sk-bench",
+    "RENDER_EXTERNAL_URL": "https://bench.invalid",
+    "OPENAI_BASE_URL": openai_fake.base_url,
+    "TELEGRAM_API_BASE_URL": telegram_fake.base_url,
+    "STREAM_REPLIES": "0" if args.no_stream else "1",
+    "USER_STATE_ENABLED": "0",
+})
+
+import bot  # noqa: E402
+from telegram import Update  # noqa: E402
+
+
+def assign_tiers(user_ids: list[int], shares: dict[str, float], rng: random.Random) -> dict[int, str]:
+    tiers = {}
+    names, weights = list(shares), list(shares.values())
+    for uid in user_ids:
+        tier = rng.choices(names, weights)[0]
+        tiers[uid] = tier
+        if tier != "free":
+            bot.subscription_store.set_tier(uid, tier)
+    return tiers
+
+
+async def run() -> dict:
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    user_ids = [100000 + i for i in range(args.users)]
+    bot.COOLDOWN_SECONDS = args.cooldown
+    bot.subscription_store.ensure()
+    tiers = assign_tiers(user_ids, parse_mix(args.tiers), rng)
+    bot.load_tier_index()
+
+    openai_fake.start()
+    telegram_fake.start()
+    app = bot.build_application()
+    await app.initialize()
+    await app.start()
+
+    latencies: dict[str, list[float]] = {"menu": [], "ai": []}
+    next_update_id = iter(range(1, 10**9))
+
+    async def user(uid: int):
+        plan = rng.choices(list(mix), list(mix.values()), k=args.sessions)
+        for name in plan:
+            for text, kind in SESSIONS[name]:
+                update = Update.de_json(update_json(next(next_update_id), uid, text), app.bot)
+                t0 = time.perf_counter()
+                await app.update_processor.process_update(update, app.process_update(update))
+                latencies[kind].append(time.perf_counter() - t0)
+                if args.think:
+                    await asyncio.sleep(args.think)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    t0 = time.perf_counter()
+    await asyncio.gather(*(user(uid) for uid in user_ids))
+    elapsed = time.perf_counter() - t0
+    heap_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+
+    await app.stop()
+    await app.shutdown()
+    await bot.client.close()
+    await openai_fake.stop()
+    await telegram_fake.stop()
+
+    n = sum(len(v) for v in latencies.values())
+    res = {
+        "users": args.users,
+        "updates": n,
+        "seconds": elapsed,
+        "updates_per_s": n / elapsed,
+        "menu": latency_summary(latencies["menu"]),
+        "ai": latency_summary(latencies["ai"]),
+        "rss_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "heap_peak_mb": heap_peak / 2**20 if heap_peak is not None else None,
+        "tiers": {t: sum(1 for v in tiers.values() if v == t) for t in set(tiers.values())},
+        "openai": openai_fake.stats(),
+        "telegram": telegram_fake.stats(),
+        "gate": {k: v for k, v in bot.openai_gate.stats().items() if k != "tiers"},
+    }
+    return res
+
+
+def main():
+    res = asyncio.run(run())
+    print(f"users: {res['users']}  updates: {res['updates']}  in {res['seconds']:.1f} s "
+          f"({res['updates_per_s']:.1f} updates/s)")
+    for kind in ("menu", "ai"):
+        s = res[kind]
+        print(f"{kind:>5}: n={s['n']:<5} p50 {s['p50_ms']:7.1f} ms  p95 {s['p95_ms']:7.1f} ms  "
+              f"p99 {s['p99_ms']:7.1f} ms  max {s['max_ms']:7.1f} ms")
+    mem = f"rss peak {res['rss_peak_mb']:.0f} MB"
+    if res["heap_peak_mb"] is not None:
+        mem += f", python heap peak {res['heap_peak_mb']:.1f} MB"
+    print(f"memory: {mem}")
+    print(f"openai: {res['openai']}")
+    print(f"telegram: {res['telegram']}")
+
+    if args.compare:
+        with open(os.path.join(START_DIR, args.compare), "r", encoding="utf-8") as f:
+            old = json.load(f)
+        rows = [("updates_per_s", old["updates_per_s"], res["updates_per_s"]), ("rss_peak_mb", old["rss_peak_mb"], res["rss_peak_mb"])]
+        for kind in ("menu", "ai"):
+            for q in ("p50_ms", "p95_ms", "p99_ms"):
+                rows.append((f"{kind}.{q}", old[kind][q], res[kind][q]))
+        for key, a, b in rows:
+            change = f"{b / a - 1:+.0%}" if a else "n/a"
+            print(f"{key}: {a:.1f} -> {b:.1f} ({change})")
+    if args.save:
+        with open(os.path.join(START_DIR, args.save), "w", encoding="utf-8") as f:
+            json.dump(res, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,326 @@
+# Load test of the webhook server: POSTs synthetic Telegram updates to
+# /<token> at a fixed open-loop rate and measures
+#   ack   - POST -> HTTP 200 (Telegram retries when this is slow or fails)
+#   reply - POST -> the bot's final answer in that chat (via FakeBotAPI; the
+#           "⏳" placeholder and streaming previews are not a reply)
+#
+#   python bench/bench_webhook.py --rates 20,50,100,200 --duration 20
+#   python bench/bench_webhook.py --arrival burst --burst 50 --rates 40
+#   python bench/bench_webhook.py --bot-env WORKERS=2 --bot-env SUBSCRIPTIONS_BACKEND=sqlite
+#
+# By default bot.py is started as a subprocess on a free port, wired to
+# FakeOpenAI/FakeBotAPI from this process. With --url the updates go to an
+# already running bot; reply times are then only measured if that bot was
+# started with TELEGRAM_API_BASE_URL pointing at the printed fake URL.
+#
+# AI prompts are unique by default (--repeat-share of them are sent verbatim
+# and can hit the response cache) and the bot runs with COOLDOWN_SECONDS=0
+# (--cooldown), so AI updates really reach (fake) OpenAI.
+#
+# Send times are scheduled in advance (open loop) and latencies are taken
+# from the scheduled time, so a stalled server can't hide its own backlog.
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from fakes import FakeBotAPI, FakeOpenAI, latency_summary, update_json  # noqa: E402
+
+TOKEN = "123456:bench"
+MENU_TEXTS = ["🧠 Профіль", "⭐ Тарифи", "ℹ️ Допомога", "📌 Приклади"]
+AI_TEXTS = [
+    "Добрий день! А можна дешевше, якщо візьму дві пари?",
+    "Коли буде відправка і скільки коштує доставка у Львів?",
+    "Чи є розмір 42 у білому кольорі?",
+    "Це оригінал? Яка гарантія?",
+]
+
+
+def parse_args():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rates", default="20,50,100", help="updates/s, one step per value")
+    ap.add_argument("--duration", type=float, default=15, help="seconds per step")
+    ap.add_argument("--arrival", choices=("constant", "poisson", "burst"), default="poisson")
+    ap.add_argument("--burst", type=int, default=20, help="updates per burst (--arrival burst)")
+    ap.add_argument("--concurrency", type=int, default=40, help="max parallel POSTs (Telegram max_connections)")
+    ap.add_argument("--users", type=int, default=500)
+    ap.add_argument("--zipf", type=float, default=0.0, help="user skew; 0 = uniform, ~1.1 = a few very active users")
+    ap.add_argument("--tiers", default="free=0.7,pro=0.2,pro_plus=0.1")
+    ap.add_argument("--ai-share", type=float, default=0.5, help="share of updates that ask the AI")
+    ap.add_argument("--repeat-share", type=float, default=0.0,
+                    help="share of AI prompts sent verbatim (response cache hits); the rest are unique")
+    ap.add_argument("--cooldown", type=float, default=0.0, help="COOLDOWN_SECONDS of the bot, s")
+    ap.add_argument("--ack-timeout", type=float, default=10.0, help="a slower ack counts as a Telegram retry")
+    ap.add_argument("--drain", type=float, default=30.0, help="wait this long for outstanding replies")
+    ap.add_argument("--latency", type=float, default=1.5, help="fake OpenAI median latency, s")
+    ap.add_argument("--tokens", type=float, default=250, help="fake OpenAI mean completion tokens")
+    ap.add_argument("--telegram-latency", type=float, default=0.05, help="fake Bot API latency, s")
+    ap.add_argument("--url", help="webhook base URL of a running bot (skips starting bot.py)")
+    ap.add_argument("--bot-env", action="append", default=[], help="extra KEY=VALUE for the bot process")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--save", help="write results to a JSON file")
+    ap.add_argument("--compare", help="compare with a previously saved JSON file")
+    return ap.parse_args()
+
+
+def parse_mix(raw: str) -> dict[str, float]:
+    mix = {}
+    for part in raw.split(","):
+        name, _, weight = part.partition("=")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def arrival_times(kind: str, rate: float, duration: float, burst: int, rng: random.Random) -> list[float]:
+    # offsets (s) from the start of the step
+    times, t = [], 0.0
+    if kind == "constant":
+        return [i / rate for i in range(int(rate * duration))]
+    if kind == "poisson":
+        while True:
+            t += rng.expovariate(rate)
+            if t >= duration:
+                return times
+            times.append(t)
+    period = burst / rate
+    while t < duration:
+        times.extend([t] * burst)
+        t += period
+    return times
+
+
+class Users:
+    def __init__(self, n: int, zipf: float, tiers: dict[str, float], rng: random.Random):
+        self.ids = [200000 + i for i in range(n)]
+        self.weights = [1 / (i + 1) ** zipf for i in range(n)] if zipf else None
+        names, shares = list(tiers), list(tiers.values())
+        self.tier = {uid: rng.choices(names, shares)[0] for uid in self.ids}
+        self.started: set[int] = set()
+        self.rng = rng
+
+    def pick(self) -> int:
+        if self.weights:
+            return self.rng.choices(self.ids, self.weights)[0]
+        return self.rng.choice(self.ids)
+
+
+def ai_text(rng: random.Random, repeat_share: float) -> str:
+    text = rng.choice(AI_TEXTS)
+    if rng.random() < repeat_share:
+        return text
+    return f"{text} Замовлення №{rng.randrange(10**6)}"
+
+
+async def start_bot(work_dir: str, port: int, openai_fake: FakeOpenAI, telegram_fake: FakeBotAPI, users: Users,
+                    extra_env: list[str], cooldown: float):
+    shutil.copy(os.path.join(BENCH_DIR, "..", "welcome.png"), work_dir)
+    with open(os.path.join(work_dir, "subscriptions.json"), "w", encoding="utf-8") as f:
+        json.dump({"users": {str(u): t for u, t in users.tier.items() if t != "free"}}, f)
+    env = {
+        **os.environ,
+        "TELEGRAM_BOT_TOKEN": TOKEN,
+        "OPENAI_API_KEY": "sk-bench",
+        "RENDER_EXTERNAL_URL": "https://bench.invalid",
+        "OPENAI_BASE_URL": openai_fake.base_url,
+        "TELEGRAM_API_BASE_URL": telegram_fake.base_url,
+        "PORT": str(port),
+        "COOLDOWN_SECONDS": str(cooldown),
+    }
+    for item in extra_env:
+        key, _, value = item.partition("=")
+        env[key] = value
+    if env.get("SUBSCRIPTIONS_BACKEND", "json") != "json":
+        # e.g. WORKERS=2 needs a shared store: copy the tiers written above
+        migrate = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.join(BENCH_DIR, "..", "bot.py"), "migrate-subscriptions", cwd=work_dir, env=env,
+            stdout=asyncio.subprocess.DEVNULL,
+        )
+        if await migrate.wait():
+            raise RuntimeError("bot.py migrate-subscriptions failed")
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(BENCH_DIR, "..", "bot.py"), cwd=work_dir, env=env,
+        stdout=open(os.path.join(work_dir, "bot.log"), "wb"), stderr=asyncio.subprocess.STDOUT,
+    )
+    async with httpx.AsyncClient() as http:
+        for _ in range(200):
+            if proc.returncode is not None:
+                raise RuntimeError(f"bot.py exited with {proc.returncode}, see {work_dir}/bot.log")
+            try:
+                if (await http.get(f"http://127.0.0.1:{port}/metrics")).status_code == 200:
+                    return proc
+            except httpx.TransportError:
+                pass
+            await asyncio.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError(f"bot.py did not start, see {work_dir}/bot.log")
+
+
+async def run_step(http: httpx.AsyncClient, url: str, rate: float, args, users: Users, telegram_fake: FakeBotAPI,
+                   rng: random.Random, next_id) -> dict:
+    offsets = arrival_times(args.arrival, rate, args.duration, args.burst, rng)
+    sem = asyncio.Semaphore(args.concurrency)
+    acks, replies, errors, retries = [], [], 0, 0
+    reply_futures = []
+
+    async def send(at: float, uid: int, text: str):
+        nonlocal errors, retries
+        async with sem:
+            body = json.dumps(update_json(next(next_id), uid, text), ensure_ascii=False)
+            reply = telegram_fake.wait_reply(uid, at)
+            reply_futures.append((at, reply))
+            try:
+                r = await http.post(url, content=body.encode(), headers={"Content-Type": "application/json"},
+                                    timeout=args.ack_timeout)
+                ok = r.status_code == 200
+            except httpx.TimeoutException:
+                ok = False
+                retries += 1
+            except httpx.TransportError:
+                ok = False
+        ack = time.perf_counter() - at
+        if not ok:
+            errors += 1
+            reply.cancel()
+            return
+        acks.append(ack)
+        if ack > args.ack_timeout:
+            retries += 1
+
+    loop_t0 = time.perf_counter() + 0.05
+    tasks = []
+    for off in offsets:
+        uid = users.pick()
+        if uid not in users.started:
+            users.started.add(uid)
+            text = "💬 Відповіді клієнтам"  # first update puts the user into an AI mode
+        elif rng.random() < args.ai_share:
+            text = ai_text(rng, args.repeat_share)
+        else:
+            text = rng.choice(MENU_TEXTS)
+        delay = loop_t0 + off - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(send(loop_t0 + off, uid, text)))
+    await asyncio.gather(*tasks)
+    send_end = time.perf_counter()
+
+    pending = [f for _, f in reply_futures if not f.cancelled()]
+    if pending:
+        await asyncio.wait(pending, timeout=args.drain)
+    missing = 0
+    for at, fut in reply_futures:
+        if fut.cancelled():
+            continue
+        if fut.done():
+            replies.append(fut.result() - at)
+        else:
+            fut.cancel()
+            missing += 1
+
+    return {
+        "target_rate": rate,
+        "sent": len(offsets),
+        "achieved_rate": len(offsets) / max(send_end - loop_t0, 1e-9),
+        "errors": errors,
+        "retries": retries,
+        "missing_replies": missing,
+        "ack": latency_summary(acks),
+        "reply": latency_summary(replies),
+    }
+
+
+def print_step(s: dict):
+    a, r = s["ack"], s["reply"]
+    print(
+        f"{s['target_rate']:>7.1f}/s  sent {s['sent']:<6} "
+        f"ack p50 {a['p50_ms']:7.1f}  p95 {a['p95_ms']:7.1f}  p99 {a['p99_ms']:7.1f} ms | "
+        f"reply p50 {r['p50_ms']:7.0f}  p95 {r['p95_ms']:7.0f}  p99 {r['p99_ms']:7.0f} ms | "
+        f"errors {s['errors']}  retries {s['retries']}  no reply {s['missing_replies']}"
+    )
+
+
+async def run(args) -> dict:
+    rng = random.Random(args.seed)
+    users = Users(args.users, args.zipf, parse_mix(args.tiers), rng)
+    openai_fake = FakeOpenAI(latency_median=args.latency, tokens_mean=args.tokens, seed=args.seed)
+    telegram_fake = FakeBotAPI(latency=args.telegram_latency)
+    openai_fake.start()
+    telegram_fake.start()
+
+    proc = None
+    if args.url:
+        url = f"{args.url.rstrip('/')}/{TOKEN}"
+        print(f"fake OpenAI: {openai_fake.base_url}  fake Bot API: {telegram_fake.base_url}")
+    else:
+        port = free_port()
+        work_dir = tempfile.mkdtemp(prefix="bench_webhook_")
+        proc = await start_bot(work_dir, port, openai_fake, telegram_fake, users, args.bot_env, args.cooldown)
+        url = f"http://127.0.0.1:{port}/{TOKEN}"
+        print(f"bot.py on :{port} (logs: {work_dir}/bot.log)")
+
+    steps = []
+    next_id = iter(range(1, 10**9))
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(limits=limits) as http:
+            for rate in (float(r) for r in args.rates.split(",")):
+                step = await run_step(http, url, rate, args, users, telegram_fake, rng, next_id)
+                print_step(step)
+                steps.append(step)
+    finally:
+        if proc and proc.returncode is None:
+            proc.send_signal(signal.SIGTERM)
+            try:
+                await asyncio.wait_for(proc.wait(), 15)
+            except asyncio.TimeoutError:
+                proc.kill()
+        await openai_fake.stop()
+        await telegram_fake.stop()
+
+    return {"arrival": args.arrival, "steps": steps, "openai": openai_fake.stats(), "telegram": telegram_fake.stats()}
+
+
+def main():
+    args = parse_args()
+    start_dir = os.getcwd()
+    res = asyncio.run(run(args))
+    print(f"openai: {res['openai']}")
+    print(f"telegram: {res['telegram']}")
+
+    if args.compare:
+        with open(os.path.join(start_dir, args.compare), "r", encoding="utf-8") as f:
+            old = {s["target_rate"]: s for s in json.load(f)["steps"]}
+        for s in res["steps"]:
+            o = old.get(s["target_rate"])
+            if not o:
+                continue
+            for key in ("ack", "reply"):
+                for q in ("p50_ms", "p99_ms"):
+                    a, b = o[key][q], s[key][q]
+                    change = f"{b / a - 1:+.0%}" if a else "n/a"
+                    print(f"{s['target_rate']:.0f}/s {key}.{q}: {a:.1f} -> {b:.1f} ({change})")
+    if args.save:
+        with open(os.path.join(start_dir, args.save), "w", encoding="utf-8") as f:
+            json.dump(res, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,324 @@
+# Local stand-ins for the OpenAI API and the Telegram Bot API, used by the
+# benchmarks in this folder. Both are tornado apps on 127.0.0.1 and run on
+# the same event loop as the bot.
+#
+#   openai = FakeOpenAI(latency_median=1.5, tokens_mean=300)
+#   telegram = FakeBotAPI()
+#   os.environ["OPENAI_BASE_URL"] = openai.base_url            # before `import bot`
+#   os.environ["TELEGRAM_API_BASE_URL"] = telegram.base_url
+#   ... inside the loop: openai.start(); telegram.start()
+import asyncio
+import json
+import math
+import random
+import time
+from collections import defaultdict, deque
+
+import tornado.httpserver
+import tornado.netutil
+import tornado.web
+
+FILLER = "Дякую за питання! Товар в наявності, відправимо сьогодні Новою Поштою. ".split()
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * q
+    lo, hi = math.floor(k), math.ceil(k)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def latency_summary(values: list[float]) -> dict:
+    return {
+        "n": len(values),
+        "p50_ms": percentile(values, 0.50) * 1000,
+        "p95_ms": percentile(values, 0.95) * 1000,
+        "p99_ms": percentile(values, 0.99) * 1000,
+        "max_ms": max(values) * 1000 if values else 0.0,
+    }
+
+
+def update_json(update_id: int, user_id: int, text: str) -> dict:
+    # a private-chat text message as Telegram sends it to the webhook
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": user_id, "type": "private", "first_name": f"user{user_id}"},
+        "from": {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "language_code": "uk"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+class _FakeServer:
+    # the socket is bound in __init__, so base_url is known before the loop starts
+    def __init__(self):
+        self._sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        self.port = self._sockets[0].getsockname()[1]
+        self._server = None
+
+    def routes(self) -> list:
+        raise NotImplementedError
+
+    def start(self):
+        app = tornado.web.Application(self.routes(), log_function=lambda handler: None)
+        self._server = tornado.httpserver.HTTPServer(app)
+        self._server.add_sockets(self._sockets)
+
+    async def stop(self):
+        if self._server:
+            self._server.stop()
+            await self._server.close_all_connections()
+
+
+# ---------------------------------------------------------
+# OpenAI: /v1/chat/completions (plain and stream=True)
+# ---------------------------------------------------------
+class FakeOpenAI(_FakeServer):
+    # Total latency ~ lognormal(latency_median, latency_sigma); completion
+    # length ~ normal(tokens_mean, tokens_sd) capped by max_tokens. When
+    # streaming, the first token comes after ttft_share of the latency and
+    # the rest is spread evenly over the remaining time.
+    def __init__(
+        self,
+        latency_median: float = 1.5,
+        latency_sigma: float = 0.4,
+        tokens_mean: float = 250,
+        tokens_sd: float = 80,
+        ttft_share: float = 0.15,
+        error_rate: float = 0.0,
+        seed: int | None = None,
+    ):
+        super().__init__()
+        self.latency_median = latency_median
+        self.latency_sigma = latency_sigma
+        self.tokens_mean = tokens_mean
+        self.tokens_sd = tokens_sd
+        self.ttft_share = ttft_share
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def routes(self) -> list:
+        return [
+            (r"/v1/chat/completions", _ChatCompletionsHandler, {"fake": self}),
+            (r"/v1/models", _ModelsHandler),
+        ]
+
+    def sample(self, max_tokens: int) -> tuple[float, int]:
+        latency = self.latency_median * math.exp(self.rng.gauss(0, self.latency_sigma)) if self.latency_median else 0.0
+        tokens = int(min(max_tokens, max(1, self.rng.gauss(self.tokens_mean, self.tokens_sd))))
+        return latency, tokens
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "max_in_flight": self.max_in_flight,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+        }
+
+
+class _ModelsHandler(tornado.web.RequestHandler):
+    # the bot's connection warm-up lists models once per connection
+    def get(self):
+        self.write({"object": "list", "data": [{"id": "fake", "object": "model", "created": 0, "owned_by": "bench"}]})
+
+
+class _ChatCompletionsHandler(tornado.web.RequestHandler):
+    def initialize(self, fake: FakeOpenAI):
+        self.fake = fake
+
+    async def post(self):
+        fake = self.fake
+        body = json.loads(self.request.body)
+        fake.requests += 1
+        if fake.error_rate and fake.rng.random() < fake.error_rate:
+            fake.errors += 1
+            self.set_status(500)
+            self.write({"error": {"message": "fake server error", "type": "server_error"}})
+            return
+
+        prompt_tokens = sum(len(m.get("content") or "") for m in body.get("messages", [])) // 3
+        latency, n_tokens = fake.sample(int(body.get("max_tokens") or 512))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": n_tokens, "total_tokens": prompt_tokens + n_tokens}
+        words = [FILLER[i % len(FILLER)] for i in range(n_tokens)]
+        created = int(time.time())
+
+        fake.in_flight += 1
+        fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+        try:
+            if not body.get("stream"):
+                await asyncio.sleep(latency)
+                self.write({
+                    "id": f"chatcmpl-fake{fake.requests}",
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": body.get("model", "fake"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": " ".join(words)},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                })
+            else:
+                self.set_header("Content-Type", "text/event-stream")
+                await asyncio.sleep(latency * fake.ttft_share)
+                step = latency * (1 - fake.ttft_share) / max(1, n_tokens)
+                chunk_words = 8  # one SSE event per ~8 tokens
+                for i in range(0, n_tokens, chunk_words):
+                    delta = " ".join(words[i:i + chunk_words]) + " "
+                    self._event(body, created, [{"index": 0, "delta": {"content": delta}, "finish_reason": None}])
+                    await self.flush()
+                    await asyncio.sleep(step * chunk_words)
+                self._event(body, created, [{"index": 0, "delta": {}, "finish_reason": "stop"}])
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    self._event(body, created, [], usage)
+                self.write("data: [DONE]\n\n")
+        finally:
+            fake.in_flight -= 1
+        fake.prompt_tokens += prompt_tokens
+        fake.completion_tokens += n_tokens
+
+    def _event(self, body: dict, created: int, choices: list, usage: dict | None = None):
+        chunk = {
+            "id": f"chatcmpl-fake{self.fake.requests}",
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": body.get("model", "fake"),
+            "choices": choices,
+            "usage": usage,
+        }
+        self.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+
+
+# ---------------------------------------------------------
+# Telegram Bot API: /bot<token>/<method>
+# ---------------------------------------------------------
+class FakeBotAPI(_FakeServer):
+    # Records every call as (ts, method, chat_id, text). Messages get
+    # increasing ids; editMessageText returns the edited message.
+    # wait_reply() lets a load driver measure time-to-reply per chat: the
+    # "⏳ Готую відповідь..." placeholder and streaming previews ("… ▌") don't
+    # count, the reply is the message or edit that carries the final text.
+    BOT_USER = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls: list[tuple[float, str, int | None, str]] = []
+        self.by_method: dict[str, int] = defaultdict(int)
+        self._message_id = 0
+        self.webhook_url = ""
+        self._waiters: dict[int, deque[tuple[float, asyncio.Future]]] = defaultdict(deque)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def routes(self) -> list:
+        return [(r"/bot[^/]+/(\w+)", _BotMethodHandler, {"fake": self})]
+
+    def record(self, method: str, chat_id: int | None, text: str):
+        now = time.perf_counter()
+        self.calls.append((now, method, chat_id, text))
+        self.by_method[method] += 1
+        if chat_id is None or method not in ("sendMessage", "sendPhoto", "sendDocument", "editMessageText"):
+            return
+        if self.is_interim(method, text):
+            return
+        # one message answers the oldest waiting update of that chat (the bot
+        # handles updates of one user in order)
+        waiters = self._waiters.get(chat_id)
+        while waiters:
+            since, fut = waiters[0]
+            if since > now:
+                break
+            waiters.popleft()
+            if not fut.done():
+                fut.set_result(now)
+                break
+
+    @staticmethod
+    def is_interim(method: str, text: str) -> bool:
+        if method == "editMessageText":
+            return text.endswith("▌")
+        return text.startswith("⏳") and text.endswith("...")
+
+    def wait_reply(self, chat_id: int, since: float) -> asyncio.Future:
+        # resolves with the perf_counter() time of the first final message
+        # (or edit) sent to chat_id for an update posted at `since`
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[chat_id].append((since, fut))
+        return fut
+
+    def next_message(self, chat_id, text: str = "", **extra) -> dict:
+        self._message_id += 1
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+            "from": self.BOT_USER,
+            "text": text,
+            **extra,
+        }
+
+    def stats(self) -> dict:
+        return {"calls": len(self.calls), "by_method": dict(self.by_method)}
+
+
+class _BotMethodHandler(tornado.web.RequestHandler):
+    def initialize(self, fake: FakeBotAPI):
+        self.fake = fake
+
+    def _params(self) -> dict:
+        if self.request.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(self.request.body or b"{}")
+        return {k: v[0].decode("utf-8", "replace") for k, v in self.request.body_arguments.items()}
+
+    async def post(self, method: str):
+        fake = self.fake
+        if fake.latency:
+            await asyncio.sleep(fake.latency)
+        params = self._params()
+        chat_id = params.get("chat_id")
+        chat_id = int(chat_id) if chat_id not in (None, "") else None
+        text = params.get("text") or params.get("caption") or ""
+        fake.record(method, chat_id, text)
+
+        if method == "getMe":
+            result = {**fake.BOT_USER, "can_join_groups": False, "can_read_all_group_messages": False,
+                      "supports_inline_queries": False}
+        elif method in ("sendMessage", "editMessageText"):
+            result = fake.next_message(chat_id, text)
+        elif method == "sendPhoto":
+            photo = [{"file_id": "fake-photo", "file_unique_id": "fake-photo-u", "width": 640, "height": 640}]
+            result = fake.next_message(chat_id, "", photo=photo, caption=text)
+        elif method == "sendDocument":
+            document = {"file_id": "fake-doc", "file_unique_id": "fake-doc-u"}
+            result = fake.next_message(chat_id, "", document=document, caption=text)
+        elif method == "getWebhookInfo":
+            result = {"url": fake.webhook_url, "has_custom_certificate": False, "pending_update_count": 0}
+        elif method == "setWebhook":
+            fake.webhook_url = params.get("url", "")
+            result = True
+        else:
+            result = True  # deleteWebhook, answerCallbackQuery, ...
+        self.write({"ok": True, "result": result})
+
+    get = post
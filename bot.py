@@ -1,17 +1,41 @@
 import os
+import sys
 import json
 import asyncio
+import bisect
+import io
+import csv
+import codecs
 import time
+import random
+import hashlib
+import sqlite3
+import shutil
+import tempfile
+import threading
+import contextlib
+import contextvars
+import signal
+import functools
+import itertools
+from collections import OrderedDict, deque
 from datetime import date
 
+import httpx
+import tornado.httpserver
+import tornado.web
 from dotenv import load_dotenv
-from openai import OpenAI
 
-from telegram import Update, ReplyKeyboardMarkup
+from telegram import Update, ReplyKeyboardMarkup, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
+    BaseUpdateProcessor,
+    CallbackQueryHandler,
     CommandHandler,
     MessageHandler,
+    TypeHandler,
     ContextTypes,
     filters,
 )
@@ -19,6 +43,40 @@ from telegram.ext import (
 # =========================================================
 # 1) ENV + CONFIG
 # =========================================================
+def _process_age() -> float | None:
+    # seconds since this process started (Linux /proc), None elsewhere
+    try:
+        with open("/proc/self/stat", "r") as f:
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - start_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class StartupTimer:
+    # Cold start breakdown, printed once the server listens. The first step
+    # (interpreter + imports) is measured from the process start time.
+    def __init__(self):
+        self.steps: list[tuple[str, float]] = []
+        age = _process_age()
+        if age is not None:
+            self.steps.append(("imports", age))
+        self._last = time.perf_counter()
+
+    def mark(self, step: str):
+        now = time.perf_counter()
+        self.steps.append((step, now - self._last))
+        self._last = now
+
+    def report(self, prefix: str = "STARTUP"):
+        total = sum(seconds for _, seconds in self.steps)
+        parts = ", ".join(f"{step} {seconds * 1000:.0f} ms" for step, seconds in self.steps)
+        print(f"{prefix}: {parts} (total {total:.2f} s)")
+
+startup = StartupTimer()
+
 load_dotenv()
 
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -26,6 +84,12 @@ OPENAI_KEY = os.getenv("OPENAI_API_KEY")
 ADMIN_IDS_RAW = os.getenv("ADMIN_IDS", "")
 RENDER_EXTERNAL_URL = os.getenv("RENDER_EXTERNAL_URL", "").strip()
 PORT = int(os.getenv("PORT", "10000"))
+# if set, /metrics needs "Authorization: Bearer <token>"; if not, /metrics
+# only answers requests from localhost (it shares the public webhook port)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()
+# Alternative API endpoints (local fakes in bench/, proxies); "" = the real ones
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "").strip()
+TELEGRAM_API_BASE_URL = os.getenv("TELEGRAM_API_BASE_URL", "").strip()  # e.g. http://127.0.0.1:8081/bot
 
 if not TELEGRAM_TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN не знайдено у .env або Render env vars")
@@ -36,16 +100,176 @@ if not RENDER_EXTERNAL_URL.startswith("https://"):
     # Приклад: https://sales-ai-bot.onrender.com
     raise ValueError("RENDER_EXTERNAL_URL має починатися з https:// (додай у Render env vars)")
 
-client = OpenAI(api_key=OPENAI_KEY)
+# OpenAI: one pooled async HTTP client + a cap on in-flight requests
+OPENAI_MAX_IN_FLIGHT = int(os.getenv("OPENAI_MAX_IN_FLIGHT", "32"))
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "64"))
+OPENAI_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_KEEPALIVE_CONNECTIONS", "32"))
+OPENAI_KEEPALIVE_SECONDS = float(os.getenv("OPENAI_KEEPALIVE_SECONDS", "60"))
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "60"))
+# Scheduler: paying tiers first, FREE keeps at least this share of slots
+FREE_MIN_SHARE = float(os.getenv("FREE_MIN_SHARE", "0.2"))
+QUEUE_DEADLINE_SECONDS = float(os.getenv("QUEUE_DEADLINE_SECONDS", "20"))
+# OpenAI account limits (requests / tokens per minute); requests wait instead of 429
+OPENAI_RPM_LIMIT = int(os.getenv("OPENAI_RPM_LIMIT", "500"))
+OPENAI_TPM_LIMIT = int(os.getenv("OPENAI_TPM_LIMIT", "200000"))
+# Resilience: total time per request by mode (queue + retries), override
+# with OPENAI_DEADLINES="demo=20,description=60"
+OPENAI_DEFAULT_DEADLINES = {"demo": 25.0, "quick_replies": 25.0, "replies": 35.0, "description": 45.0, "other": 45.0}
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_RETRY_BASE_SECONDS = float(os.getenv("OPENAI_RETRY_BASE_SECONDS", "0.5"))
+OPENAI_RETRY_MAX_SECONDS = float(os.getenv("OPENAI_RETRY_MAX_SECONDS", "8"))
+# Hedging: 2nd request when the 1st is slower than p95 of its mode (costs tokens)
+OPENAI_HEDGE = os.getenv("OPENAI_HEDGE", "0") == "1"
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv("OPENAI_HEDGE_MIN_SAMPLES", "50"))
+OPENAI_HEDGE_MAX_SHARE = float(os.getenv("OPENAI_HEDGE_MAX_SHARE", "0.05"))
+# Circuit breaker: fail fast after N errors in a row, probe again after M seconds
+OPENAI_BREAKER_FAILURES = int(os.getenv("OPENAI_BREAKER_FAILURES", "5"))
+OPENAI_BREAKER_OPEN_SECONDS = float(os.getenv("OPENAI_BREAKER_OPEN_SECONDS", "30"))
+# Cold start: HTTPS connections opened to OpenAI right after startup (0 = off)
+OPENAI_WARM_CONNECTIONS = int(os.getenv("OPENAI_WARM_CONNECTIONS", "2"))
+
+
+class LazyOpenAIClient:
+    # The openai package alone takes ~0.5 s to import, so AsyncOpenAI is
+    # created on first use (normally by warm_up_openai(), in a thread, right
+    # after startup). Attribute access is forwarded to the real client.
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+                    self._client = AsyncOpenAI(
+                        api_key=OPENAI_KEY,
+                        base_url=OPENAI_BASE_URL or None,
+                        http_client=DefaultAsyncHttpxClient(
+                            limits=httpx.Limits(
+                                max_connections=OPENAI_POOL_SIZE,
+                                max_keepalive_connections=OPENAI_KEEPALIVE_CONNECTIONS,
+                                keepalive_expiry=OPENAI_KEEPALIVE_SECONDS,
+                            ),
+                            timeout=OPENAI_TIMEOUT_SECONDS,
+                        ),
+                        max_retries=0,  # retries are ours (request_completion), with deadlines and the breaker
+                    )
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+
+client = LazyOpenAIClient()
+
+# Set by the front for `bot.py worker` processes (see WORKER MODE)
+WORKER_INDEX = os.getenv("WORKER_INDEX", "")
+
+def worker_path(path: str) -> str:
+    # snapshot files rewritten with os.replace() get one copy per worker,
+    # so workers never overwrite each other's entries
+    if not WORKER_INDEX or not path:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.w{WORKER_INDEX}{ext}"
 
 WELCOME_IMAGE_PATH = "welcome.png"
+# Telegram file_id of already uploaded media (re-upload only if the file changes)
+MEDIA_CACHE_FILE = worker_path(os.getenv("MEDIA_CACHE_FILE", "media_cache.json"))
 SUBSCRIPTIONS_FILE = "subscriptions.json"
-
-MODEL_NAME = "gpt-4o-mini"
-MAX_TOKENS = 520
-
-COOLDOWN_SECONDS = 3
-MAX_INPUT_CHARS = 900
+SUBSCRIPTIONS_BACKEND = os.getenv("SUBSCRIPTIONS_BACKEND", "json").strip().lower()  # json / sqlite / redis
+SUBSCRIPTIONS_DB = os.getenv("SUBSCRIPTIONS_DB", "subscriptions.db")
+# Persistent user state (profile, daily limits, upsell) in SQLite
+USER_STATE_ENABLED = os.getenv("USER_STATE_ENABLED", "1") == "1"
+USER_STATE_DB = os.getenv("USER_STATE_DB", "user_state.db")
+USER_STATE_FLUSH_SECONDS = float(os.getenv("USER_STATE_FLUSH_SECONDS", "10"))
+# Shared state for several replicas: daily quota, cooldown and DEMO flag
+STATE_BACKEND = os.getenv("STATE_BACKEND", "local").strip().lower()  # local / sqlite / redis
+STATE_DB = os.getenv("STATE_DB", "shared_state.db")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "salesbot:")
+# how often get_user_tier may check the store for external edits
+TIER_RELOAD_CHECK_SECONDS = float(os.getenv("TIER_RELOAD_CHECK_SECONDS", "5"))
+
+MODEL_NAME = "gpt-4o-mini"  # default model; also part of the response cache key
+# Model router: candidates "name:quality" (higher = better, slower) and the
+# minimal quality per mode, e.g. OPENAI_MODE_QUALITY="description=2"
+OPENAI_MODELS = os.getenv("OPENAI_MODELS", f"{MODEL_NAME}:1")
+OPENAI_MODE_QUALITY = os.getenv("OPENAI_MODE_QUALITY", "")
+ROUTER_LATENCY_ALPHA = float(os.getenv("ROUTER_LATENCY_ALPHA", "0.2"))
+ROUTER_ERROR_ALPHA = float(os.getenv("ROUTER_ERROR_ALPHA", "0.1"))
+ROUTER_MAX_ERROR_RATE = float(os.getenv("ROUTER_MAX_ERROR_RATE", "0.3"))
+ROUTER_EXPLORE = float(os.getenv("ROUTER_EXPLORE", "0.05"))
+# the error rate halves every this many seconds without a new result, so an
+# unhealthy model (never picked) becomes eligible again
+ROUTER_ERROR_HALF_LIFE = float(os.getenv("ROUTER_ERROR_HALF_LIFE", "60"))
+MAX_TOKENS = 520  # output ceiling; the actual budget adapts per mode/style
+# Output budget learned from usage.completion_tokens (p99 * headroom)
+TOKEN_BUDGET_ADAPTIVE = os.getenv("TOKEN_BUDGET_ADAPTIVE", "1") == "1"
+TOKEN_BUDGET_MIN = int(os.getenv("TOKEN_BUDGET_MIN", "96"))
+TOKEN_BUDGET_MIN_SAMPLES = int(os.getenv("TOKEN_BUDGET_MIN_SAMPLES", "30"))
+TOKEN_BUDGET_HEADROOM = float(os.getenv("TOKEN_BUDGET_HEADROOM", "1.25"))
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")  # gpt-4o family
+# tiktoken keeps its downloaded vocabulary here instead of a temp dir; fill
+# it at build time with `python bot.py fetch-tokenizer`
+TOKENIZER_CACHE_DIR = os.path.abspath(os.getenv("TOKENIZER_CACHE_DIR", "tiktoken_cache"))
+os.environ.setdefault("TIKTOKEN_CACHE_DIR", TOKENIZER_CACHE_DIR)
+
+COOLDOWN_SECONDS = float(os.getenv("COOLDOWN_SECONDS", "3"))
+MAX_INPUT_TOKENS = int(os.getenv("MAX_INPUT_TOKENS", "300"))  # ~900 chars of Ukrainian text
+
+# Streaming: the "⏳" placeholder is edited while tokens arrive.
+# Edits are throttled (Telegram allows ~1 edit/s per chat).
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+STREAM_EDIT_MIN_CHARS = int(os.getenv("STREAM_EDIT_MIN_CHARS", "40"))
+TELEGRAM_MAX_MESSAGE = 4096
+
+# Response cache for DEMO / quick replies (closed set of prompts).
+# Each key keeps up to RESPONSE_CACHE_VARIANTS answers; until it has them
+# all, a request still goes to OpenAI and adds a new variant.
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "2000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600)))
+RESPONSE_CACHE_VARIANTS = int(os.getenv("RESPONSE_CACHE_VARIANTS", "3"))
+RESPONSE_CACHE_FILE = worker_path(os.getenv("RESPONSE_CACHE_FILE", "").strip())  # "" = memory only
+RESPONSE_CACHE_SAVE_SECONDS = float(os.getenv("RESPONSE_CACHE_SAVE_SECONDS", "300"))
+
+# Prefetch: when "⚡ Швидкі відповіді" is opened, generate the likely topics
+# in the background (only while OpenAI capacity is idle).
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "1") == "1"
+PREFETCH_TIERS = {t.strip() for t in os.getenv("PREFETCH_TIERS", "pro,pro_plus").split(",") if t.strip()}
+PREFETCH_TOPICS = int(os.getenv("PREFETCH_TOPICS", "2"))
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+PREFETCH_DAILY_CAP = int(os.getenv("PREFETCH_DAILY_CAP", "300"))
+PREFETCH_TTL = float(os.getenv("PREFETCH_TTL", "900"))
+
+# Bulk descriptions from an uploaded CSV/XLSX
+BULK_JOBS_DIR = os.getenv("BULK_JOBS_DIR", "bulk_jobs")
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "1000"))
+BULK_MAX_FILE_MB = int(os.getenv("BULK_MAX_FILE_MB", "10"))
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "4"))
+BULK_PROGRESS_SECONDS = float(os.getenv("BULK_PROGRESS_SECONDS", "3"))
+# unfinished jobs (quota, errors) are kept this long for a resume
+BULK_JOB_TTL_HOURS = float(os.getenv("BULK_JOB_TTL_HOURS", "72"))
+
+# Concurrency: how many updates are handled at once (updates of one user stay in order)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "4096"))
+# Worker mode: WORKERS>0 = front process + N worker processes, sharded by user_id
+WORKERS = int(os.getenv("WORKERS", "0"))
+WORKER_MAX_BACKLOG = int(os.getenv("WORKER_MAX_BACKLOG", "10000"))  # per worker; above it the front answers 503
+WORKER_RESTART_MAX_SECONDS = float(os.getenv("WORKER_RESTART_MAX_SECONDS", "30"))
+
+# Tracing: per-update spans (state, tier, prompt, queue, openai, Telegram calls)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").strip().lower()  # none / jsonl / otlp
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "").strip()  # e.g. http://otel-collector:4318
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", "10"))  # 0 = off
 
 # =========================================================
 # 2) TIERS + MONO LINKS
@@ -84,7 +308,372 @@ def is_admin(update: Update) -> bool:
 
 
 # =========================================================
-# 4) SUBSCRIPTIONS (JSON storage)
+# 4) METRICS (Prometheus text format, served on /metrics)
+# =========================================================
+def _fmt_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help_text, labels
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, v in self._values.items():
+            out.append(f"{self.name}{_fmt_labels(self.labels, key)} {v}")
+        return out
+
+
+class Gauge:
+    # value comes from a callback at scrape time; with labels the callback
+    # returns {label values tuple: value}
+    def __init__(self, name: str, help_text: str, fn, labels: tuple = ()):
+        self.name, self.help, self.fn, self.labels = name, help_text, fn, labels
+
+    def render(self) -> list[str]:
+        try:
+            values = self.fn() if self.labels else {(): self.fn()}
+            lines = [f"{self.name}{_fmt_labels(self.labels, key)} {float(v)}" for key, v in values.items()]
+        except Exception:
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", *lines]
+
+
+class Histogram:
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self._series: dict[tuple, list] = {}  # key -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in self._series.items():
+            for bound, n in zip(self.buckets, series):
+                le = _fmt_labels(self.labels, key, 'le="%s"' % bound)
+                out.append(f"{self.name}_bucket{le} {n}")
+            le = _fmt_labels(self.labels, key, 'le="+Inf"')
+            out.append(f"{self.name}_bucket{le} {series[-1]}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {series[-2]}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {series[-1]}")
+        return out
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+
+M_UPDATE_SECONDS = metrics.add(Histogram("bot_update_seconds", "Time to handle one Telegram update"))
+M_OPENAI_SECONDS = metrics.add(Histogram("bot_openai_seconds", "OpenAI request latency", ("mode", "model")))
+M_QUEUE_WAIT_SECONDS = metrics.add(Histogram("bot_openai_queue_wait_seconds", "Wait for an OpenAI slot", ("tier",)))
+M_TOKENS = metrics.add(Counter("bot_openai_tokens_total", "OpenAI tokens", ("direction", "mode")))
+M_ERRORS = metrics.add(Counter("bot_errors_total", "Errors by type", ("where", "type")))
+M_LIMIT_EVENTS = metrics.add(Counter("bot_limit_events_total", "Limit and upsell events", ("tier", "event")))
+M_OPENAI_RETRIES = metrics.add(Counter("bot_openai_retries_total", "OpenAI retries", ("mode", "reason")))
+M_HEDGES = metrics.add(Counter("bot_openai_hedges_total", "Hedged OpenAI requests", ("mode",)))
+M_MODEL_ROUTED = metrics.add(Counter("bot_model_routed_total", "Requests routed per mode and model", ("mode", "model")))
+M_FALLBACKS = metrics.add(Counter("bot_openai_fallbacks_total", "Answers served without OpenAI", ("mode", "source")))
+M_CACHE_LOOKUPS = metrics.add(Counter("bot_response_cache_lookups_total", "Response cache lookups", ("result",)))
+M_CACHE_SAVED_SECONDS = metrics.add(Counter(
+    "bot_response_cache_saved_seconds_total", "OpenAI generation time saved by response cache hits"
+))
+metrics.add(Gauge(
+    "bot_startup_seconds", "Time spent per startup step",
+    lambda: {(step,): seconds for step, seconds in startup.steps}, ("step",),
+))
+
+
+# =========================================================
+# 5) TRACING (per-update spans)
+# =========================================================
+class Trace:
+    # spans of one update: [name, start, end, parent index, attrs]
+    __slots__ = ("update_id", "user_id", "sampled", "start", "end", "spans", "wall_start")
+
+    def __init__(self, update_id, user_id, sampled: bool):
+        self.update_id, self.user_id, self.sampled = update_id, user_id, sampled
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.end = None
+        self.spans: list[list] = []
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def breakdown(self) -> dict[str, float]:
+        # total seconds per span name (a name may occur several times)
+        totals: dict[str, float] = {}
+        for name, start, end, _, _ in self.spans:
+            if end is not None:
+                totals[name] = totals.get(name, 0.0) + end - start
+        return totals
+
+
+_current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("current_trace", default=None)
+_current_span: contextvars.ContextVar[int] = contextvars.ContextVar("current_span", default=-1)
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set(self, **attrs):
+        pass
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    # the parent comes from a contextvar, so tasks spawned inside a span
+    # (e.g. streaming edits) nest under it correctly
+    __slots__ = ("trace", "record", "_token")
+
+    def __init__(self, trace: Trace, name: str, attrs: dict):
+        self.trace = trace
+        self.record = [name, 0.0, None, -1, attrs]
+
+    def __enter__(self):
+        self.record[3] = _current_span.get()
+        self.trace.spans.append(self.record)
+        self._token = _current_span.set(len(self.trace.spans) - 1)
+        self.record[1] = time.perf_counter()
+        return self
+
+    def set(self, **attrs):
+        self.record[4].update(attrs)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.record[2] = time.perf_counter()
+        if exc_type is not None:
+            self.record[4]["error"] = exc_type.__name__
+        _current_span.reset(self._token)
+        return False
+
+
+def span(name: str, **attrs):
+    # no-op unless the current update is traced
+    trace = _current_trace.get()
+    if trace is None or trace.end is not None:
+        return _NO_SPAN
+    return _Span(trace, name, attrs)
+
+
+class TraceExporter:
+    def export(self, trace: Trace):
+        raise NotImplementedError
+
+    async def flush(self):
+        pass
+
+
+class JsonLinesExporter(TraceExporter):
+    # one JSON object per update on stdout (Render keeps stdout as logs)
+    def export(self, trace: Trace):
+        print(json.dumps({
+            "trace": "update",
+            "update_id": trace.update_id,
+            "user_id": trace.user_id,
+            "ts": round(trace.wall_start, 3),
+            "duration_ms": round(trace.duration * 1000, 2),
+            "spans": [
+                {
+                    "name": name,
+                    "start_ms": round((start - trace.start) * 1000, 2),
+                    "duration_ms": round(((end or start) - start) * 1000, 2),
+                    "parent": parent,
+                    **attrs,
+                }
+                for name, start, end, parent, attrs in trace.spans
+            ],
+        }, ensure_ascii=False), flush=True)
+
+
+class OtlpJsonExporter(TraceExporter):
+    # OTLP/HTTP JSON (POST <endpoint>/v1/traces); without an endpoint the
+    # payload is printed, so a log shipper can forward it
+    def __init__(self, endpoint: str = "", service_name: str = "sales-ai-bot", batch_size: int = 100):
+        self.endpoint = endpoint.rstrip("/")
+        self.service_name = service_name
+        self.batch_size = batch_size
+        self._pending: list[dict] = []
+        self._http: httpx.AsyncClient | None = None
+        self.dropped = 0
+
+    @staticmethod
+    def _attr(key: str, value) -> dict:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    def _to_otlp(self, trace: Trace) -> list[dict]:
+        trace_id = os.urandom(16).hex()
+        root_id = os.urandom(8).hex()
+        ids = [os.urandom(8).hex() for _ in trace.spans]
+
+        def ns(t: float) -> str:
+            return str(int((trace.wall_start + t - trace.start) * 1e9))
+
+        spans = [{
+            "traceId": trace_id,
+            "spanId": root_id,
+            "name": "telegram.update",
+            "kind": 2,
+            "startTimeUnixNano": ns(trace.start),
+            "endTimeUnixNano": ns(trace.end or trace.start),
+            "attributes": [self._attr("update_id", trace.update_id or 0), self._attr("user_id", trace.user_id or 0)],
+        }]
+        for i, (name, start, end, parent, attrs) in enumerate(trace.spans):
+            spans.append({
+                "traceId": trace_id,
+                "spanId": ids[i],
+                "parentSpanId": ids[parent] if parent >= 0 else root_id,
+                "name": name,
+                "kind": 3 if name.startswith(("tg.", "openai")) else 1,
+                "startTimeUnixNano": ns(start),
+                "endTimeUnixNano": ns(end or start),
+                "attributes": [self._attr(k, v) for k, v in attrs.items()],
+            })
+        return spans
+
+    def export(self, trace: Trace):
+        if len(self._pending) >= self.batch_size * 10:
+            self.dropped += 1
+            return
+        self._pending.extend(self._to_otlp(trace))
+
+    async def flush(self):
+        if not self._pending:
+            return
+        spans, self._pending = self._pending, []
+        payload = {"resourceSpans": [{
+            "resource": {"attributes": [self._attr("service.name", self.service_name)]},
+            "scopeSpans": [{"scope": {"name": "bot"}, "spans": spans}],
+        }]}
+        if not self.endpoint:
+            print(json.dumps(payload, ensure_ascii=False), flush=True)
+            return
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=10)
+        try:
+            r = await self._http.post(f"{self.endpoint}/v1/traces", json=payload)
+            r.raise_for_status()
+        except Exception as e:
+            self.dropped += len(spans)
+            print("TRACE EXPORT ERROR:", repr(e))
+
+
+class Tracer:
+    # Head sampling: TRACE_SAMPLE_RATE of updates are exported. Spans are
+    # still recorded for the rest (a few tuple appends) so that a slow
+    # update is logged with its full breakdown even if it wasn't sampled.
+    def __init__(self, exporter: TraceExporter | None, sample_rate: float, slow_seconds: float):
+        self.exporter = exporter
+        self.sample_rate = sample_rate if exporter else 0.0
+        self.slow_seconds = slow_seconds
+        self.enabled = self.sample_rate > 0 or slow_seconds > 0
+        self.started = 0
+        self.exported = 0
+        self.slow = 0
+
+    def begin(self, update_id, user_id) -> Trace | None:
+        if not self.enabled:
+            return None
+        self.started += 1
+        return Trace(update_id, user_id, self.sample_rate >= 1 or random.random() < self.sample_rate)
+
+    def finish(self, trace: Trace):
+        trace.end = time.perf_counter()
+        if trace.sampled:
+            self.exported += 1
+            self.exporter.export(trace)
+        if self.slow_seconds and trace.duration >= self.slow_seconds:
+            self.slow += 1
+            totals = " | ".join(f"{name} {sec * 1000:.0f}ms" for name, sec in trace.breakdown().items())
+            print(f"SLOW UPDATE {trace.update_id} user={trace.user_id} {trace.duration:.3f}s: {totals}{self.format(trace)}")
+
+    @staticmethod
+    def format(trace: Trace) -> str:
+        parts = []
+        depth: list[int] = []
+        for name, start, end, parent, attrs in trace.spans:
+            depth.append(depth[parent] + 1 if parent >= 0 else 0)
+            indent = "  " * depth[-1]
+            took = f"{(end - start) * 1000:.1f}ms" if end is not None else "unfinished"
+            extra = "".join(f" {k}={v}" for k, v in attrs.items())
+            parts.append(f"{indent}{name} +{(start - trace.start) * 1000:.1f}ms {took}{extra}")
+        return "\n    " + "\n    ".join(parts) if parts else "(no spans)"
+
+    async def run_flusher(self, interval: float = 5.0):
+        while True:
+            await asyncio.sleep(interval)
+            await self.exporter.flush()
+
+    def stats(self) -> dict:
+        return {"started": self.started, "exported": self.exported, "slow": self.slow}
+
+
+class TracedRequest(HTTPXRequest):
+    # every Bot API round trip (sendMessage, editMessageText, ...) becomes a span
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        with span("tg." + url.rsplit("/", 1)[-1]):
+            return await super().do_request(url, method, *args, **kwargs)
+
+
+def make_tracer() -> Tracer:
+    exporters = {
+        "jsonl": JsonLinesExporter,
+        "otlp": lambda: OtlpJsonExporter(TRACE_OTLP_ENDPOINT),
+    }
+    factory = exporters.get(TRACE_EXPORTER)
+    if TRACE_EXPORTER not in exporters and TRACE_EXPORTER != "none":
+        print(f"Unknown TRACE_EXPORTER={TRACE_EXPORTER!r}, tracing export is off")
+    return Tracer(factory() if factory else None, TRACE_SAMPLE_RATE, SLOW_UPDATE_SECONDS)
+
+tracer = make_tracer()
+
+
+# =========================================================
+# 6) SUBSCRIPTIONS (storage: JSON by default, SQLite optional)
 # =========================================================
 def _ensure_subscriptions_file():
     if not os.path.exists(SUBSCRIPTIONS_FILE):
@@ -108,25 +697,274 @@ def save_subscriptions(data: dict):
         json.dump(data, f, ensure_ascii=False, indent=2)
     os.replace(tmp_path, SUBSCRIPTIONS_FILE)
 
-def set_user_tier(user_id: int, tier: str):
-    data = load_subscriptions()
-    data["users"][str(user_id)] = tier
-    save_subscriptions(data)
+TIERS = ("free", "pro", "pro_plus")
+
+
+class SubscriptionStore:
+    # Storage adapter for paid tiers. Methods are blocking: call them
+    # via asyncio.to_thread from handlers.
+    # version() changes when the data was modified outside this process.
+    def ensure(self):
+        pass
+
+    def load_all(self) -> dict[str, str]:
+        raise NotImplementedError
+
+    def set_tier(self, user_id: int, tier: str):
+        raise NotImplementedError
+
+    def remove(self, user_id: int):
+        raise NotImplementedError
+
+    def version(self):
+        return None
+
+    def close(self):
+        pass
+
 
-def remove_user(user_id: int):
-    data = load_subscriptions()
-    data["users"].pop(str(user_id), None)
-    save_subscriptions(data)
+class JsonSubscriptionStore(SubscriptionStore):
+    # The lock keeps load -> modify -> save atomic inside the process
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def ensure(self):
+        _ensure_subscriptions_file()
+
+    def load_all(self) -> dict[str, str]:
+        return load_subscriptions()["users"]
+
+    def set_tier(self, user_id: int, tier: str):
+        with self._lock:
+            data = load_subscriptions()
+            data["users"][str(user_id)] = tier
+            save_subscriptions(data)
+
+    def remove(self, user_id: int):
+        with self._lock:
+            data = load_subscriptions()
+            data["users"].pop(str(user_id), None)
+            save_subscriptions(data)
+
+    def version(self):
+        try:
+            return os.stat(SUBSCRIPTIONS_FILE).st_mtime_ns
+        except OSError:
+            return None
+
+
+class SqliteSubscriptionStore(SubscriptionStore):
+    # One row per user, WAL journal: a write touches one row and readers
+    # are never blocked by it.
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS subscriptions ("
+            " user_id INTEGER PRIMARY KEY,"
+            " tier TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+
+    def load_all(self) -> dict[str, str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, tier FROM subscriptions").fetchall()
+        return {str(uid): tier for uid, tier in rows}
+
+    def set_tier(self, user_id: int, tier: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO subscriptions (user_id, tier, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET tier = excluded.tier, updated_at = excluded.updated_at",
+                (user_id, tier, time.time()),
+            )
+
+    def set_many(self, items: dict[int, str]):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO subscriptions (user_id, tier, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET tier = excluded.tier, updated_at = excluded.updated_at",
+                    [(uid, tier, now) for uid, tier in items.items()],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def remove(self, user_id: int):
+        with self._lock:
+            self._conn.execute("DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
+
+    def version(self):
+        # data_version changes only on commits from other connections
+        with self._lock:
+            return self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisSubscriptionStore(SubscriptionStore):
+    # One hash user_id -> tier; every write bumps a version counter so the
+    # other replicas reload their tier index (see _refresh_tier_index_if_changed).
+    def __init__(self, url: str, prefix: str):
+        try:
+            import redis  # optional, only for SUBSCRIPTIONS_BACKEND=redis
+        except ImportError:
+            raise RuntimeError("SUBSCRIPTIONS_BACKEND=redis потребує пакет redis (pip install redis)") from None
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._key = f"{prefix}subscriptions"
+        self._version_key = f"{prefix}subscriptions:version"
+
+    def load_all(self) -> dict[str, str]:
+        return self._redis.hgetall(self._key)
+
+    def set_tier(self, user_id: int, tier: str):
+        with self._redis.pipeline() as pipe:
+            pipe.hset(self._key, str(user_id), tier).incr(self._version_key).execute()
+
+    def set_many(self, items: dict[int, str]):
+        if not items:
+            return
+        with self._redis.pipeline() as pipe:
+            pipe.hset(self._key, mapping={str(uid): tier for uid, tier in items.items()})
+            pipe.incr(self._version_key).execute()
+
+    def remove(self, user_id: int):
+        with self._redis.pipeline() as pipe:
+            pipe.hdel(self._key, str(user_id)).incr(self._version_key).execute()
+
+    def version(self):
+        return self._redis.get(self._version_key)
+
+    def close(self):
+        self._redis.close()
+
+
+def make_subscription_store() -> SubscriptionStore:
+    if SUBSCRIPTIONS_BACKEND == "sqlite":
+        return SqliteSubscriptionStore(SUBSCRIPTIONS_DB)
+    if SUBSCRIPTIONS_BACKEND == "redis":
+        return RedisSubscriptionStore(REDIS_URL, REDIS_PREFIX)
+    if SUBSCRIPTIONS_BACKEND != "json":
+        raise ValueError("SUBSCRIPTIONS_BACKEND має бути json, sqlite або redis")
+    return JsonSubscriptionStore()
+
+subscription_store = make_subscription_store()
+
+
+def migrate_json_to_sqlite(db_path: str = SUBSCRIPTIONS_DB) -> int:
+    # One-shot: copy subscriptions.json into SQLite, or into Redis with
+    # SUBSCRIPTIONS_BACKEND=redis (safe to re-run)
+    items: dict[int, str] = {}
+    for uid, tier in load_subscriptions()["users"].items():
+        try:
+            uid_int = int(uid)
+        except (TypeError, ValueError):
+            continue
+        if tier in TIERS and tier != "free":
+            items[uid_int] = tier
+
+    store = RedisSubscriptionStore(REDIS_URL, REDIS_PREFIX) if SUBSCRIPTIONS_BACKEND == "redis" else SqliteSubscriptionStore(db_path)
+    try:
+        store.set_many(items)
+    finally:
+        store.close()
+    return len(items)
+
+
+# In-memory tier index: user_id -> tier (only paid users are stored).
+# Loaded once, patched in place by set_user_tier/remove_user and reloaded
+# only when the store was changed by someone else (store.version()).
+# _tier_ids keeps sorted user ids per tier and for "all" paid users, so
+# /list_paid pages are slices instead of a sort of the whole index.
+_tier_index: dict[int, str] = {}
+_tier_ids: dict[str, list[int]] = {"all": [], "pro": [], "pro_plus": []}
+_tier_index_version = None
+_tier_index_checked_at = 0.0
+
+def load_tier_index():
+    global _tier_index, _tier_ids, _tier_index_version, _tier_index_checked_at
+    version = subscription_store.version()
+    index: dict[int, str] = {}
+    for uid, tier in subscription_store.load_all().items():
+        try:
+            uid_int = int(uid)
+        except (TypeError, ValueError):
+            continue
+        if tier in TIERS and tier != "free":
+            index[uid_int] = tier
+    ids: dict[str, list[int]] = {"all": sorted(index), "pro": [], "pro_plus": []}
+    for uid in ids["all"]:
+        ids[index[uid]].append(uid)
+    _tier_index = index
+    _tier_ids = ids
+    _tier_index_version = version
+    _tier_index_checked_at = time.monotonic()
+
+def _sorted_remove(ids: list[int], uid: int):
+    i = bisect.bisect_left(ids, uid)
+    if i < len(ids) and ids[i] == uid:
+        del ids[i]
+
+def _index_set(user_id: int, tier: str):
+    old = _tier_index.get(user_id)
+    if old == tier:
+        return
+    if old is None:
+        bisect.insort(_tier_ids["all"], user_id)
+    else:
+        _sorted_remove(_tier_ids[old], user_id)
+    bisect.insort(_tier_ids[tier], user_id)
+    _tier_index[user_id] = tier
+
+def _index_remove(user_id: int):
+    old = _tier_index.pop(user_id, None)
+    if old is not None:
+        _sorted_remove(_tier_ids["all"], user_id)
+        _sorted_remove(_tier_ids[old], user_id)
+
+def _refresh_tier_index_if_changed():
+    global _tier_index_checked_at
+    now = time.monotonic()
+    if now - _tier_index_checked_at < TIER_RELOAD_CHECK_SECONDS:
+        return
+    _tier_index_checked_at = now
+    if subscription_store.version() != _tier_index_version:
+        load_tier_index()
+
+def _mark_tier_index_fresh():
+    # our own write: don't reload what we just wrote
+    global _tier_index_version
+    _tier_index_version = subscription_store.version()
+
+async def set_user_tier(user_id: int, tier: str):
+    await asyncio.to_thread(subscription_store.set_tier, user_id, tier)
+    _index_set(user_id, tier)
+    _mark_tier_index_fresh()
+
+async def remove_user(user_id: int):
+    await asyncio.to_thread(subscription_store.remove, user_id)
+    _index_remove(user_id)
+    _mark_tier_index_fresh()
+
+def get_tier_by_id(user_id: int) -> str:
+    _refresh_tier_index_if_changed()
+    return _tier_index.get(user_id, "free")
 
 def get_user_tier(update: Update) -> str:
     uid = update.effective_user.id if update.effective_user else None
     if not uid:
         return "free"
-    data = load_subscriptions()
-    tier = data["users"].get(str(uid), "free")
-    if tier not in ("free", "pro", "pro_plus"):
-        return "free"
-    return tier
+    with span("tier"):
+        return get_tier_by_id(uid)
 
 def tier_label(tier: str) -> str:
     if tier == "pro_plus":
@@ -144,83 +982,397 @@ def tier_daily_limit(tier: str) -> int | None:
 
 
 # =========================================================
-# 5) UI (menus)
+# 7) USER STATE (profile/limits survive restarts)
+# =========================================================
+# Only these user_data keys are persisted; "mode" etc. stay in memory.
+PERSISTED_USER_KEYS = ("profile", "limits", "upsell", "demo_day")
+
+
+class UserStateStore:
+    # SQLite (WAL), one JSON row per user
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_state ("
+            " user_id INTEGER PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+
+    def load(self, user_id: int) -> dict | None:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM user_state WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_many(self, rows: dict[int, str]):
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO user_state (user_id, data, updated_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                    [(uid, data, now) for uid, data in rows.items()],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class UserStatePersistence:
+    # Lazy load: a user's row is read on their first update after start.
+    # Write-behind: touched users are flushed together every
+    # USER_STATE_FLUSH_SECONDS (and on shutdown), unchanged ones are skipped.
+    def __init__(self, store: UserStateStore):
+        self.store = store
+        self._loaded: set[int] = set()
+        self._dirty: dict[int, dict] = {}
+        self._saved: dict[int, str] = {}
+        self._flush_lock = asyncio.Lock()
+        self.flushes = 0
+        self.rows_written = 0
+
+    async def hydrate(self, user_id: int, user_data: dict):
+        if user_id not in self._loaded:
+            data = await asyncio.to_thread(self.store.load, user_id)
+            self._loaded.add(user_id)
+            if data:
+                for key, value in data.items():
+                    user_data.setdefault(key, value)
+                self._saved[user_id] = json.dumps(data, ensure_ascii=False, sort_keys=True)
+        self._dirty[user_id] = user_data
+
+    def touch(self, user_id: int, user_data: dict):
+        # changed outside of an update (background job): flush it next time
+        if user_id in self._loaded:
+            self._dirty[user_id] = user_data
+
+    async def flush(self):
+        async with self._flush_lock:
+            dirty, self._dirty = self._dirty, {}
+            rows: dict[int, str] = {}
+            for uid, user_data in dirty.items():
+                snapshot = {k: user_data[k] for k in PERSISTED_USER_KEYS if k in user_data}
+                data = json.dumps(snapshot, ensure_ascii=False, sort_keys=True)
+                if self._saved.get(uid) != data:
+                    rows[uid] = data
+            if not rows:
+                return
+            try:
+                await asyncio.to_thread(self.store.save_many, rows)
+            except Exception as e:
+                print("USER STATE FLUSH ERROR:", repr(e))
+                for uid, user_data in dirty.items():
+                    self._dirty.setdefault(uid, user_data)
+                return
+            self._saved.update(rows)
+            self.flushes += 1
+            self.rows_written += len(rows)
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(USER_STATE_FLUSH_SECONDS)
+            await self.flush()
+
+# opened in build_application(): importing the module creates no files
+user_state: UserStatePersistence | None = None
+
+
+# =========================================================
+# 7b) SHARED STATE (quota / cooldown / DEMO across replicas)
+# =========================================================
+# With STATE_BACKEND=local (default) limits live in user_data as before.
+# sqlite (one host, several processes) and redis (several hosts) keep them
+# in one place and check + increment atomically, so two replicas can never
+# both pass the same limit. user_data["limits"]["count"] is then only a
+# copy of the shared counter, refreshed on every reservation.
+# Only the limits are shared. The conversation state (user_data["mode"],
+# the profile, pending steps) stays in the process that handled the user's
+# last update, and USER_STATE_DB is per host. Replicas behind a load
+# balancer therefore need sticky routing by user id (as the WORKERS front
+# does), or a user can land in a process that doesn't know their mode.
+class QuotaBackend:
+    async def reserve(self, user_id: int, day: str, limit: int | None, cooldown: float) -> tuple[bool, str, int, float]:
+        # -> (allowed, "" / "COOLDOWN" / "LIMIT_REACHED", count today, seconds to wait)
+        raise NotImplementedError
+
+    async def release(self, user_id: int, day: str):
+        raise NotImplementedError
+
+    async def claim_demo(self, user_id: int, day: str) -> bool:
+        # True only for the first claim of the day
+        raise NotImplementedError
+
+    async def release_demo(self, user_id: int, day: str):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class SqliteQuotaBackend(QuotaBackend):
+    # BEGIN IMMEDIATE takes the write lock before reading, so
+    # check + increment is atomic across processes sharing the file.
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS quota ("
+            " user_id INTEGER PRIMARY KEY,"
+            " day TEXT NOT NULL,"
+            " count INTEGER NOT NULL,"
+            " last_ts REAL NOT NULL,"
+            " demo_day TEXT)"
+        )
+
+    def _tx(self, fn):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+                self._conn.execute("COMMIT")
+                return result
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _row(conn, user_id: int, day: str) -> tuple[int, float, str | None]:
+        row = conn.execute("SELECT day, count, last_ts, demo_day FROM quota WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None:
+            conn.execute("INSERT INTO quota (user_id, day, count, last_ts) VALUES (?, ?, 0, 0)", (user_id, day))
+            return 0, 0.0, None
+        row_day, count, last_ts, demo_day = row
+        return (count if row_day == day else 0), last_ts, demo_day
+
+    def _reserve(self, user_id: int, day: str, limit: int | None, cooldown: float):
+        def fn(conn):
+            count, last_ts, _ = self._row(conn, user_id, day)
+            now = time.time()
+            if now - last_ts < cooldown:
+                return False, "COOLDOWN", count, cooldown - (now - last_ts)
+            if limit is not None and count >= limit:
+                return False, "LIMIT_REACHED", count, 0.0
+            conn.execute(
+                "UPDATE quota SET day = ?, count = ?, last_ts = ? WHERE user_id = ?",
+                (day, count + 1, now if cooldown else last_ts, user_id),
+            )
+            return True, "", count + 1, 0.0
+        return self._tx(fn)
+
+    def _release(self, user_id: int, day: str):
+        self._tx(lambda conn: conn.execute(
+            "UPDATE quota SET count = MAX(count - 1, 0) WHERE user_id = ? AND day = ?", (user_id, day)
+        ))
+
+    def _claim_demo(self, user_id: int, day: str) -> bool:
+        def fn(conn):
+            _, _, demo_day = self._row(conn, user_id, day)
+            if demo_day == day:
+                return False
+            conn.execute("UPDATE quota SET demo_day = ? WHERE user_id = ?", (day, user_id))
+            return True
+        return self._tx(fn)
+
+    def _release_demo(self, user_id: int, day: str):
+        self._tx(lambda conn: conn.execute(
+            "UPDATE quota SET demo_day = NULL WHERE user_id = ? AND demo_day = ?", (user_id, day)
+        ))
+
+    async def reserve(self, user_id, day, limit, cooldown):
+        return await asyncio.to_thread(self._reserve, user_id, day, limit, cooldown)
+
+    async def release(self, user_id, day):
+        await asyncio.to_thread(self._release, user_id, day)
+
+    async def claim_demo(self, user_id, day):
+        return await asyncio.to_thread(self._claim_demo, user_id, day)
+
+    async def release_demo(self, user_id, day):
+        await asyncio.to_thread(self._release_demo, user_id, day)
+
+    async def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisQuotaBackend(QuotaBackend):
+    # Lua scripts run atomically on the server; time comes from the server
+    # too (TIME), so replica clock skew doesn't matter for cooldowns.
+    RESERVE = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local limit = tonumber(ARGV[1])
+local cooldown = tonumber(ARGV[2])
+local count = tonumber(redis.call('GET', KEYS[1]) or '0')
+local last = tonumber(redis.call('GET', KEYS[2]) or '0')
+if now - last < cooldown then
+  return {0, 'COOLDOWN', count, tostring(cooldown - (now - last))}
+end
+if limit >= 0 and count >= limit then
+  return {0, 'LIMIT_REACHED', count, '0'}
+end
+count = redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], 172800)
+if cooldown > 0 then
+  redis.call('SET', KEYS[2], tostring(now), 'EX', math.ceil(cooldown) + 1)
+end
+return {1, '', count, '0'}
+"""
+    RELEASE = """
+if tonumber(redis.call('GET', KEYS[1]) or '0') > 0 then
+  return redis.call('DECR', KEYS[1])
+end
+return 0
+"""
+
+    def __init__(self, url: str, prefix: str):
+        try:
+            import redis.asyncio as aioredis  # optional, only for STATE_BACKEND=redis
+        except ImportError:
+            raise RuntimeError("STATE_BACKEND=redis потребує пакет redis (pip install redis)") from None
+        self.prefix = prefix
+        self._redis = aioredis.from_url(url, decode_responses=True)
+        self._reserve = self._redis.register_script(self.RESERVE)
+        self._release = self._redis.register_script(self.RELEASE)
+
+    def _keys(self, user_id: int, day: str) -> list[str]:
+        return [f"{self.prefix}quota:{user_id}:{day}", f"{self.prefix}last:{user_id}"]
+
+    async def reserve(self, user_id, day, limit, cooldown):
+        allowed, reason, count, wait = await self._reserve(
+            keys=self._keys(user_id, day), args=[-1 if limit is None else limit, cooldown]
+        )
+        return bool(allowed), reason, int(count), float(wait)
+
+    async def release(self, user_id, day):
+        await self._release(keys=self._keys(user_id, day)[:1])
+
+    async def claim_demo(self, user_id, day):
+        return bool(await self._redis.set(f"{self.prefix}demo:{user_id}:{day}", 1, nx=True, ex=172800))
+
+    async def release_demo(self, user_id, day):
+        await self._redis.delete(f"{self.prefix}demo:{user_id}:{day}")
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+def make_quota_backend() -> QuotaBackend | None:
+    if STATE_BACKEND == "local":
+        return None
+    if STATE_BACKEND == "sqlite":
+        return SqliteQuotaBackend(STATE_DB)
+    if STATE_BACKEND == "redis":
+        return RedisQuotaBackend(REDIS_URL, REDIS_PREFIX)
+    raise ValueError("STATE_BACKEND має бути local, sqlite або redis")
+
+quota_backend = make_quota_backend()
+
+
+# =========================================================
+# 8) UI (menus)
 # =========================================================
+# Keyboards are immutable, so each one is built once and reused.
+MAIN_MENU = ReplyKeyboardMarkup(
+    [
+        ["🎯 DEMO", "⚡ Швидкі відповіді"],
+        ["💬 Відповіді клієнтам", "✍️ Опис товару"],
+        ["⚙️ Налаштування", "🧠 Профіль"],
+        ["⭐ Тарифи", "📌 Приклади"],
+        ["📦 Масовий опис", "ℹ️ Допомога"],
+    ],
+    resize_keyboard=True,
+)
+
+SETTINGS_MENU = ReplyKeyboardMarkup(
+    [
+        ["🛒 Платформа", "🎛 Шаблон стилю"],
+        ["🌐 Мова", "💎 Сегмент"],
+        ["⬅️ Назад"],
+    ],
+    resize_keyboard=True,
+)
+
+PLATFORM_MENU = ReplyKeyboardMarkup(
+    [
+        ["OLX", "Prom"],
+        ["Instagram", "Rozetka"],
+        ["Site", "Telegram"],
+        ["⬅️ Назад"],
+    ],
+    resize_keyboard=True,
+)
+
+STYLE_TEMPLATE_MENU = ReplyKeyboardMarkup(
+    [
+        ["⚡ Коротко", "🔥 Продаюче"],
+        ["🏢 Офіційно", "💎 Преміум"],
+        ["⬅️ Назад"],
+    ],
+    resize_keyboard=True,
+)
+
+LANGUAGE_MENU = ReplyKeyboardMarkup(
+    [
+        ["🇺🇦 Українська", "🇬🇧 English"],
+        ["⬅️ Назад"],
+    ],
+    resize_keyboard=True,
+)
+
+QUICK_REPLIES_MENU = ReplyKeyboardMarkup(
+    [
+        ["💸 Дорого", "🚚 Доставка"],
+        ["📦 Наявність", "🏷️ Знижка/торг"],
+        ["💳 Оплата/оформлення", "🛡️ Повернення/гарантія"],
+        ["⬅️ Назад"],
+    ],
+    resize_keyboard=True,
+)
+
+PRO_UPSELL_MENU = ReplyKeyboardMarkup(
+    [
+        ["⭐ PRO 99 грн", "💎 PRO+ 199 грн"],
+        ["🆔 Мій ID", "⬅️ Назад"],
+    ],
+    resize_keyboard=True,
+)
+
 def main_menu():
-    return ReplyKeyboardMarkup(
-        [
-            ["🎯 DEMO", "⚡ Швидкі відповіді"],
-            ["💬 Відповіді клієнтам", "✍️ Опис товару"],
-            ["⚙️ Налаштування", "🧠 Профіль"],
-            ["⭐ Тарифи", "📌 Приклади"],
-            ["ℹ️ Допомога"],
-        ],
-        resize_keyboard=True,
-    )
+    return MAIN_MENU
 
 def settings_menu():
-    return ReplyKeyboardMarkup(
-        [
-            ["🛒 Платформа", "🎛 Шаблон стилю"],
-            ["🌐 Мова", "💎 Сегмент"],
-            ["⬅️ Назад"],
-        ],
-        resize_keyboard=True,
-    )
+    return SETTINGS_MENU
 
 def platform_menu():
-    return ReplyKeyboardMarkup(
-        [
-            ["OLX", "Prom"],
-            ["Instagram", "Rozetka"],
-            ["Site", "Telegram"],
-            ["⬅️ Назад"],
-        ],
-        resize_keyboard=True,
-    )
+    return PLATFORM_MENU
 
 def style_template_menu():
-    return ReplyKeyboardMarkup(
-        [
-            ["⚡ Коротко", "🔥 Продаюче"],
-            ["🏢 Офіційно", "💎 Преміум"],
-            ["⬅️ Назад"],
-        ],
-        resize_keyboard=True,
-    )
+    return STYLE_TEMPLATE_MENU
 
 def language_menu():
-    return ReplyKeyboardMarkup(
-        [
-            ["🇺🇦 Українська", "🇬🇧 English"],
-            ["⬅️ Назад"],
-        ],
-        resize_keyboard=True,
-    )
+    return LANGUAGE_MENU
 
 def quick_replies_menu():
-    return ReplyKeyboardMarkup(
-        [
-            ["💸 Дорого", "🚚 Доставка"],
-            ["📦 Наявність", "🏷️ Знижка/торг"],
-            ["💳 Оплата/оформлення", "🛡️ Повернення/гарантія"],
-            ["⬅️ Назад"],
-        ],
-        resize_keyboard=True,
-    )
+    return QUICK_REPLIES_MENU
 
 def pro_upsell_menu():
-    return ReplyKeyboardMarkup(
-        [
-            ["⭐ PRO 99 грн", "💎 PRO+ 199 грн"],
-            ["🆔 Мій ID", "⬅️ Назад"],
-        ],
-        resize_keyboard=True,
-    )
+    return PRO_UPSELL_MENU
 
 
 # =========================================================
-# 6) HELPERS: profile + limits + prompts
+# 9) HELPERS: profile + limits + prompts
 # =========================================================
 def ensure_defaults(context: ContextTypes.DEFAULT_TYPE):
     if "profile" not in context.user_data:
@@ -279,6 +1431,37 @@ def can_call_ai(update: Update, context: ContextTypes.DEFAULT_TYPE) -> tuple[boo
 
     return True, ""
 
+async def release_ai_call(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # refund a reserved call that was never served
+    limits = context.user_data["limits"]
+    limits["count"] = max(0, int(limits.get("count", 0)) - 1)
+    if quota_backend and update.effective_user:
+        await quota_backend.release(update.effective_user.id, limits["day"])
+
+async def reserve_ai_call(update: Update, context: ContextTypes.DEFAULT_TYPE) -> tuple[bool, str]:
+    # check + register in one step, so two updates can never both pass the
+    # same limit/cooldown check (locally: no await in between; shared
+    # backends: one atomic operation)
+    if quota_backend is None or not update.effective_user:
+        allowed, reason = can_call_ai(update, context)
+        if allowed:
+            register_ai_call(context)
+        return allowed, reason
+
+    ensure_defaults(context)
+    reset_daily_if_needed(context)
+    limits = context.user_data["limits"]
+    tier = get_user_tier(update)
+    allowed, reason, count, wait_s = await quota_backend.reserve(
+        update.effective_user.id, limits["day"], tier_daily_limit(tier), COOLDOWN_SECONDS
+    )
+    limits["count"] = count
+    if reason == "COOLDOWN":
+        return False, f"⏳ Зачекай {int(wait_s) + 1} с і спробуй ще раз."
+    if allowed:
+        limits["last_ts"] = time.time()
+    return allowed, reason
+
 def language_label(profile: dict) -> str:
     return "українською" if profile.get("language") == "uk" else "English"
 
@@ -291,12 +1474,27 @@ def style_instructions(style_template: str) -> str:
     }
     return mapping.get(style_template, mapping["🔥 Продаюче"])
 
-def build_system_prompt(profile: dict, mode: str) -> str:
-    lang = language_label(profile)
-    style = style_instructions(profile.get("style_template", "🔥 Продаюче"))
-    platform = profile.get("platform", "OLX")
-    segment = profile.get("segment", "середній")
+# Prompt builders are memoized on a hashable profile key. A request is
+# ~160 tokens of instructions plus at most MAX_INPUT_TOKENS of user text,
+# below the 1024-token minimum of OpenAI prompt caching, so the layout
+# doesn't matter for it; cached_tokens is still reported (PromptUsageStats)
+# in case the prompts grow.
+
+def profile_style(profile: dict) -> str:
+    return profile.get("style_template", "🔥 Продаюче")
+
+def profile_key(profile: dict) -> tuple:
+    return (
+        profile.get("language", "uk"),
+        profile.get("platform", "OLX"),
+        profile.get("segment", "середній"),
+        profile.get("style_template", "🔥 Продаюче"),
+    )
 
+@functools.lru_cache(maxsize=4096)
+def _system_prompt(mode: str, language: str, platform: str, segment: str, style_template: str) -> str:
+    lang = language_label({"language": language})
+    style = style_instructions(style_template)
     return (
         "You are an experienced sales assistant for online commerce.\n"
         f"Respond in {lang}.\n"
@@ -307,6 +1505,10 @@ def build_system_prompt(profile: dict, mode: str) -> str:
         f"Task mode: {mode}\n"
     )
 
+def build_system_prompt(profile: dict, mode: str) -> str:
+    with span("prompt.system", mode=mode):
+        return _system_prompt(mode, *profile_key(profile))
+
 def description_format_for_platform(platform: str) -> str:
     p = (platform or "").lower()
     if p == "instagram":
@@ -328,75 +1530,1641 @@ def description_format_for_platform(platform: str) -> str:
             "4) Benefits/assurance (3–5 bullets)\n"
             "5) CTA (1 line)"
         )
-    if p == "telegram":
-        return (
-            "Format:\n"
-            "1) Short title\n"
-            "2) Main text (3–5 sentences)\n"
-            "3) Benefits (bullets)\n"
-            "4) CTA + how to order (generic)"
+    if p == "telegram":
+        return (
+            "Format:\n"
+            "1) Short title\n"
+            "2) Main text (3–5 sentences)\n"
+            "3) Benefits (bullets)\n"
+            "4) CTA + how to order (generic)"
+        )
+    return (
+        "Format:\n"
+        "1) Title\n"
+        "2) Short description (2–4 sentences)\n"
+        "3) Specs/condition/what's included (if known)\n"
+        "4) Benefits (5–7 bullets)\n"
+        "5) Delivery/payment (generic, no invented details)\n"
+        "6) Call to action"
+    )
+
+@functools.lru_cache(maxsize=64)
+def _user_prompt_prefix(mode: str, platform: str) -> str:
+    if mode == "description":
+        return (
+            f"Write a sales-ready product description for platform: {platform}\n"
+            f"{description_format_for_platform(platform)}\n\n"
+            "Input from seller:\n"
+        )
+
+    return (
+        "Create 5 short reply options to the customer message.\n"
+        "1–3: universal replies\n"
+        "4: reply with a clarifying question\n"
+        "5: soft close (next step: order/reserve/contact)\n"
+        "Each option on a new line. No pressure.\n\n"
+        "Customer message / situation:\n"
+    )
+
+def build_user_prompt(mode: str, text: str, profile: dict) -> str:
+    with span("prompt.user", mode=mode):
+        return _user_prompt_prefix(mode, profile.get("platform", "OLX")) + text
+
+
+class PromptUsageStats:
+    # per mode: prompt / cached / completion tokens from resp.usage
+    def __init__(self):
+        self.modes: dict[str, dict] = {}
+
+    def record(self, mode: str, usage):
+        if usage is None:
+            return
+        st = self.modes.setdefault(mode, {"requests": 0, "prompt": 0, "cached": 0, "completion": 0})
+        M_TOKENS.inc(usage.prompt_tokens or 0, direction="in", mode=mode)
+        M_TOKENS.inc(usage.completion_tokens or 0, direction="out", mode=mode)
+        st["requests"] += 1
+        st["prompt"] += usage.prompt_tokens or 0
+        st["completion"] += usage.completion_tokens or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        st["cached"] += (getattr(details, "cached_tokens", 0) or 0) if details else 0
+
+    def report(self) -> dict:
+        out = {}
+        for mode, st in self.modes.items():
+            n = st["requests"]
+            out[mode] = {
+                "requests": n,
+                "prompt_avg": st["prompt"] / n,
+                "completion_avg": st["completion"] / n,
+                "cached_ratio": st["cached"] / st["prompt"] if st["prompt"] else 0.0,
+            }
+        return out
+
+prompt_usage = PromptUsageStats()
+
+
+class SchedulerBusy(Exception):
+    pass
+
+
+# lower = served first; "prefetch" is background work from the prefetcher
+TIER_PRIORITY = {"pro_plus": 0, "pro": 1, "free": 2, "prefetch": 3}
+
+
+class TierScheduler:
+    # Priority queue in front of OpenAI: `limit` requests in flight, waiting
+    # requests are served PRO+ -> PRO -> FREE, except that at least every
+    # FREE_EVERY-th slot goes to a waiting FREE request (guaranteed share).
+    # A request that waits longer than its deadline gets SchedulerBusy.
+    def __init__(self, limit: int, free_min_share: float):
+        self.limit = limit
+        self.free_every = max(1, round(1 / free_min_share)) if free_min_share > 0 else 0
+        self.in_flight = 0
+        self._queues: dict[str, deque] = {t: deque() for t in TIER_PRIORITY}
+        self._since_free = 0
+        self._stats = {t: {"granted": 0, "timeouts": 0, "wait_total": 0.0, "wait_max": 0.0} for t in TIER_PRIORITY}
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for q in self._queues.values())
+
+    def queue_position(self, tier: str) -> int:
+        # position a new request of this tier would get
+        prio = TIER_PRIORITY.get(tier, TIER_PRIORITY["free"])
+        return 1 + sum(len(q) for t, q in self._queues.items() if TIER_PRIORITY[t] <= prio)
+
+    def _record(self, tier: str, wait: float):
+        M_QUEUE_WAIT_SECONDS.observe(wait, tier=tier)
+        st = self._stats[tier]
+        st["granted"] += 1
+        st["wait_total"] += wait
+        st["wait_max"] = max(st["wait_max"], wait)
+        if tier == "free":
+            self._since_free = 0
+        else:
+            self._since_free += 1
+
+    def _next_waiter(self):
+        free_q = self._queues["free"]
+        if free_q and self.free_every and self._since_free >= self.free_every - 1:
+            return free_q.popleft()
+        for tier in TIER_PRIORITY:
+            if self._queues[tier]:
+                return self._queues[tier].popleft()
+        return None
+
+    def _release(self):
+        while True:
+            waiter = self._next_waiter()
+            if waiter is None:
+                self.in_flight -= 1
+                return
+            fut, tier, t0 = waiter
+            if not fut.done():
+                # hand the slot over directly
+                self._record(tier, time.monotonic() - t0)
+                fut.set_result(None)
+                return
+
+    @contextlib.asynccontextmanager
+    async def slot(self, tier: str = "free", deadline: float | None = None):
+        if tier not in TIER_PRIORITY:
+            tier = "free"
+        t0 = time.monotonic()
+        if self.in_flight < self.limit and not self.waiting:
+            self.in_flight += 1
+            self._record(tier, 0.0)
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            waiter = (fut, tier, t0)
+            self._queues[tier].append(waiter)
+            try:
+                with span("queue", tier=tier, position=len(self._queues[tier])):
+                    await asyncio.wait_for(asyncio.shield(fut), deadline)
+            except BaseException as e:
+                if fut.done() and not fut.cancelled():
+                    # the slot was granted right when we gave up
+                    self._release()
+                else:
+                    fut.cancel()
+                    with contextlib.suppress(ValueError):
+                        self._queues[tier].remove(waiter)
+                if isinstance(e, asyncio.TimeoutError):
+                    self._stats[tier]["timeouts"] += 1
+                    raise SchedulerBusy(f"{tier} request waited more than {deadline} s") from None
+                raise
+
+        try:
+            yield time.monotonic() - t0
+        finally:
+            self._release()
+
+    def stats(self) -> dict:
+        tiers = {}
+        for tier, st in self._stats.items():
+            tiers[tier] = {
+                "queue_depth": len(self._queues[tier]),
+                "position": self.queue_position(tier),
+                "granted": st["granted"],
+                "timeouts": st["timeouts"],
+                "wait_avg_s": st["wait_total"] / st["granted"] if st["granted"] else 0.0,
+                "wait_max_s": st["wait_max"],
+            }
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "total": sum(st["granted"] for st in self._stats.values()),
+            "tiers": tiers,
+        }
+
+openai_gate = TierScheduler(OPENAI_MAX_IN_FLIGHT, FREE_MIN_SHARE)
+
+class TokenBucket:
+    # capacity = per-minute limit, refilled continuously; the level may go
+    # below zero when a request turns out bigger than estimated (debt)
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        # a request bigger than the whole bucket only waits for a full bucket
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount: float):
+        self._refill()
+        self.level -= amount
+
+    def give_back(self, amount: float):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class OpenAIRateLimiter:
+    # Global RPM + TPM buckets. Callers wait in FIFO order instead of
+    # getting 429 from OpenAI.
+    def __init__(self, rpm: int, tpm: int):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._lock = asyncio.Lock()
+        self.waits = 0
+        self.wait_total = 0.0
+        self.corrections = 0
+
+    async def acquire(self, est_tokens: int, deadline: float | None = None) -> float:
+        # deadline (time.monotonic()): SchedulerBusy instead of waiting past
+        # it, so local throttling never looks like an upstream timeout
+        t0 = time.monotonic()
+        try:
+            await asyncio.wait_for(self._lock.acquire(), None if deadline is None else max(0.0, deadline - t0))
+        except asyncio.TimeoutError:
+            raise SchedulerBusy("OpenAI rate limit: no capacity before the deadline") from None
+        try:
+            while True:
+                delay = max(self.requests.wait_time(1), self.tokens.wait_time(est_tokens))
+                if delay <= 0:
+                    break
+                if deadline is not None and time.monotonic() + delay > deadline:
+                    raise SchedulerBusy("OpenAI rate limit: no capacity before the deadline")
+                await asyncio.sleep(delay)
+            self.requests.take(1)
+            self.tokens.take(est_tokens)
+        finally:
+            self._lock.release()
+        waited = time.monotonic() - t0
+        if waited > 0.001:
+            self.waits += 1
+            self.wait_total += waited
+        return waited
+
+    def settle(self, est_tokens: int, actual_tokens: int):
+        # correct the estimate with resp.usage
+        diff = est_tokens - actual_tokens
+        if diff > 0:
+            self.tokens.give_back(diff)
+        elif diff < 0:
+            self.tokens.take(-diff)
+        self.corrections += 1
+
+    def stats(self) -> dict:
+        self.requests._refill()
+        self.tokens._refill()
+        return {
+            "rpm_left": int(self.requests.level),
+            "rpm_limit": int(self.requests.capacity),
+            "tpm_left": int(self.tokens.level),
+            "tpm_limit": int(self.tokens.capacity),
+            "waits": self.waits,
+            "wait_total_s": self.wait_total,
+        }
+
+rate_limiter = OpenAIRateLimiter(OPENAI_RPM_LIMIT, OPENAI_TPM_LIMIT)
+
+# Local token counts for input limits and rate-limit estimates. tiktoken
+# is optional; its vocabulary is loaded in a thread at startup
+# (load_tokenizer), never on the request path. Until it is loaded, or
+# without tiktoken, a conservative character heuristic is used.
+_encoding = None
+
+def _load_encoding():
+    global _encoding
+    import tiktoken  # optional
+
+    _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+
+async def load_tokenizer():
+    # the vocabulary may need a download: retry with backoff on failure
+    delay = 30.0
+    while _encoding is None:
+        try:
+            await asyncio.to_thread(_load_encoding)
+        except ImportError:
+            print("TOKENIZER: tiktoken not installed, using heuristic counts")
+            return
+        except Exception as e:
+            print(f"TOKENIZER: load failed ({e!r}), heuristic counts; retry in {delay:.0f} s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 1800.0)
+
+def count_tokens(text: str) -> int:
+    enc = _encoding
+    if enc:
+        return len(enc.encode(text, disallowed_special=()))
+    # ~4 chars per token for Latin, ~3 for Cyrillic and the rest
+    ascii_chars = sum(1 for ch in text if ch < "\x80")
+    return -(-ascii_chars // 4) - (-(len(text) - ascii_chars) // 3)
+
+def truncate_tokens(text: str, limit: int) -> str:
+    enc = _encoding
+    if enc:
+        tokens = enc.encode(text, disallowed_special=())
+        return text if len(tokens) <= limit else enc.decode(tokens[:limit])
+    while count_tokens(text) > limit:
+        text = text[: max(0, len(text) - max(1, (count_tokens(text) - limit) * 3))]
+    return text
+
+def estimate_request_tokens(system_prompt: str, user_prompt: str, max_tokens: int = MAX_TOKENS) -> int:
+    # prompt + chat framing + full output budget
+    return count_tokens(system_prompt) + count_tokens(user_prompt) + 16 + max_tokens
+
+
+class TokenBudget:
+    # max_tokens per (mode, style): p99 of recent completion lengths plus
+    # headroom, between TOKEN_BUDGET_MIN and MAX_TOKENS. Answers cut by the
+    # budget (finish_reason "length") count as MAX_TOKENS, so the budget
+    # grows back right away when answers get longer.
+    def __init__(self, window: int = 300):
+        self.window = window
+        self._samples: dict[tuple[str, str], deque] = {}
+        self._limits: dict[tuple[str, str], int] = {}
+        self.truncated: dict[tuple[str, str], int] = {}
+
+    def limit(self, mode: str, style: str) -> int:
+        if not TOKEN_BUDGET_ADAPTIVE:
+            return MAX_TOKENS
+        return self._limits.get((mode, style), MAX_TOKENS)
+
+    def record(self, mode: str, style: str, usage, finish_reason: str | None):
+        if usage is None:
+            return
+        key = (mode, style)
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+        tokens = usage.completion_tokens or 0
+        if finish_reason == "length":
+            self.truncated[key] = self.truncated.get(key, 0) + 1
+            tokens = MAX_TOKENS
+        samples.append(tokens)
+        if len(samples) >= TOKEN_BUDGET_MIN_SAMPLES:
+            ordered = sorted(samples)
+            p99 = ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))]
+            self._limits[key] = max(TOKEN_BUDGET_MIN, min(MAX_TOKENS, int(p99 * TOKEN_BUDGET_HEADROOM) + 16))
+
+    def stats(self) -> dict:
+        return {
+            key: {"n": len(s), "limit": self.limit(*key), "truncated": self.truncated.get(key, 0)}
+            for key, s in self._samples.items()
+        }
+
+token_budget = TokenBudget()
+
+class OpenAIUnavailable(Exception):
+    # circuit open, or retries / deadline used up on retryable errors:
+    # the caller answers from cache or a template instead
+    pass
+
+
+def _parse_deadlines(raw: str) -> dict[str, float]:
+    deadlines = dict(OPENAI_DEFAULT_DEADLINES)
+    for part in raw.split(","):
+        mode, _, seconds = part.partition("=")
+        if mode.strip() and seconds.strip():
+            deadlines[mode.strip()] = float(seconds)
+    return deadlines
+
+OPENAI_DEADLINES = _parse_deadlines(os.getenv("OPENAI_DEADLINES", ""))
+
+def mode_deadline(mode: str) -> float:
+    return OPENAI_DEADLINES.get(mode, OPENAI_DEADLINES["other"])
+
+
+def _is_status_error(e: BaseException) -> bool:
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(e, openai.APIStatusError)
+
+def _is_retryable(e: BaseException) -> bool:
+    # 408/409/429/5xx, connection errors and timeouts; 400/401/403 are not
+    import openai  # loaded by the client already
+
+    if isinstance(e, (openai.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code in (408, 409, 429) or e.status_code >= 500
+    return False
+
+def _retry_delay(e: BaseException, attempt: int) -> float:
+    # full jitter; a Retry-After from the server is a lower bound
+    import openai
+
+    delay = random.uniform(0, min(OPENAI_RETRY_MAX_SECONDS, OPENAI_RETRY_BASE_SECONDS * 2 ** attempt))
+    if isinstance(e, openai.APIStatusError):
+        with contextlib.suppress(TypeError, ValueError):
+            delay = max(delay, float(e.response.headers.get("retry-after")))
+    return delay
+
+
+class LatencyTracker:
+    # recent OpenAI latencies per mode (seconds) -> percentiles
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: dict[str, deque] = {}
+
+    def observe(self, mode: str, seconds: float):
+        samples = self._samples.get(mode)
+        if samples is None:
+            samples = self._samples[mode] = deque(maxlen=self.window)
+        samples.append(seconds)
+
+    def percentile(self, mode: str, q: float, min_samples: int = 1) -> float | None:
+        samples = self._samples.get(mode)
+        if not samples or len(samples) < min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> dict:
+        return {
+            mode: {"n": len(s), "p50_s": self.percentile(mode, 0.5), "p95_s": self.percentile(mode, 0.95)}
+            for mode, s in self._samples.items()
+        }
+
+openai_latency = LatencyTracker()
+
+
+class CircuitBreaker:
+    # closed -> open after `failures` retryable errors in a row; open fails
+    # fast for `open_seconds`; then half-open lets one probe through, its
+    # result closes or re-opens the circuit.
+    def __init__(self, failures: int, open_seconds: float):
+        self.failures = failures
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._probe = False
+        self.opened = 0
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.open_seconds:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+            self._probe = False
+        if self.state == "half_open":
+            if self._probe:
+                self.rejected += 1
+                return False
+            self._probe = True
+        return True
+
+    def success(self):
+        self._consecutive = 0
+        self._probe = False
+        if self.state != "closed":
+            print("OPENAI CIRCUIT: closed")
+            self.state = "closed"
+
+    def failure(self):
+        self._consecutive += 1
+        self._probe = False
+        if self.state == "half_open" or (self.state == "closed" and self._consecutive >= self.failures):
+            if self.state == "closed":
+                print(f"OPENAI CIRCUIT: open after {self._consecutive} failures")
+            self.state = "open"
+            self._opened_at = time.monotonic()
+            self.opened += 1
+
+    def abandon(self):
+        # the probe ended without telling anything about upstream health
+        self._probe = False
+
+    def stats(self) -> dict:
+        return {"state": self.state, "opened": self.opened, "rejected": self.rejected}
+
+openai_breaker = CircuitBreaker(OPENAI_BREAKER_FAILURES, OPENAI_BREAKER_OPEN_SECONDS)
+
+
+class ModelRouter:
+    # Per mode: among models whose quality >= the mode's tier, take the
+    # healthy one (EWMA error rate below ROUTER_MAX_ERROR_RATE) with the
+    # lowest EWMA latency for that mode. A small share of requests goes to
+    # another eligible model so that stats of the others stay fresh. The
+    # error rate decays while a model gets no traffic, so a model that was
+    # excluded for errors gets probed again after a while.
+    def __init__(self, models: dict[str, int], mode_quality: dict[str, int]):
+        self.models = models  # name -> quality (1 = fastest/cheapest)
+        self.mode_quality = mode_quality
+        self.latency: dict[tuple[str, str], float] = {}  # (mode, model) -> EWMA seconds
+        self.error_rate: dict[str, float] = {m: 0.0 for m in models}  # EWMA as of _error_at
+        self._error_at: dict[str, float] = {}
+        self.routed: dict[tuple[str, str], int] = {}
+        self.best: dict[str, str] = {}  # current choice per mode, for the log
+
+    def candidates(self, mode: str) -> list[str]:
+        need = self.mode_quality.get(mode, self.mode_quality.get("other", 1))
+        eligible = [m for m, q in self.models.items() if q >= need]
+        # nothing good enough configured: the best we have
+        return eligible or [max(self.models, key=self.models.get)]
+
+    def current_error_rate(self, model: str) -> float:
+        rate = self.error_rate[model]
+        if rate and ROUTER_ERROR_HALF_LIFE > 0:
+            idle = time.monotonic() - self._error_at.get(model, time.monotonic())
+            rate *= 0.5 ** (idle / ROUTER_ERROR_HALF_LIFE)
+        return rate
+
+    def pick(self, mode: str, avoid: str | None = None) -> str:
+        models = self.candidates(mode)
+        if avoid and len(models) > 1:
+            models = [m for m in models if m != avoid]
+        errors = {m: self.current_error_rate(m) for m in models}
+        healthy = [m for m in models if errors[m] < ROUTER_MAX_ERROR_RATE] or [min(models, key=errors.get)]
+        if len(healthy) > 1 and random.random() < ROUTER_EXPLORE:
+            model = random.choice(healthy)
+        else:
+            # unmeasured models first (0.0), then the fastest
+            model = min(healthy, key=lambda m: self.latency.get((mode, m), 0.0))
+            if avoid is None and self.best.get(mode, model) != model:
+                print(f"MODEL ROUTER: {mode} {self.best[mode]} -> {model}")
+            if avoid is None:
+                self.best[mode] = model
+        key = (mode, model)
+        self.routed[key] = self.routed.get(key, 0) + 1
+        M_MODEL_ROUTED.inc(mode=mode, model=model)
+        return model
+
+    def record(self, mode: str, model: str, seconds: float | None, ok: bool):
+        # seconds=None: failed request, only the error rate moves
+        rate = self.current_error_rate(model)
+        self.error_rate[model] = rate + ROUTER_ERROR_ALPHA * ((0.0 if ok else 1.0) - rate)
+        self._error_at[model] = time.monotonic()
+        if ok and seconds is not None:
+            key = (mode, model)
+            prev = self.latency.get(key)
+            self.latency[key] = seconds if prev is None else prev + ROUTER_LATENCY_ALPHA * (seconds - prev)
+
+    def stats(self) -> dict:
+        return {
+            model: {
+                "quality": quality,
+                "error_rate": self.current_error_rate(model),
+                "modes": {
+                    mode: {"ewma_s": self.latency.get((mode, model)), "routed": n}
+                    for (mode, m), n in self.routed.items() if m == model
+                },
+            }
+            for model, quality in self.models.items()
+        }
+
+
+def _parse_weights(raw: str, default: int = 1) -> dict[str, int]:
+    # "a:1,b:2" or "a=1,b=2" -> {"a": 1, "b": 2}
+    out = {}
+    for part in raw.split(","):
+        name, _, value = part.replace("=", ":").partition(":")
+        if name.strip():
+            out[name.strip()] = int(value) if value.strip() else default
+    return out
+
+model_router = ModelRouter(_parse_weights(OPENAI_MODELS), {"other": 1, **_parse_weights(OPENAI_MODE_QUALITY)})
+
+
+class HedgeStats:
+    def __init__(self):
+        self.requests = 0
+        self.hedged = 0
+        self.won = 0
+
+    def allowed(self) -> bool:
+        # budget: at most OPENAI_HEDGE_MAX_SHARE extra requests
+        return self.hedged < OPENAI_HEDGE_MAX_SHARE * max(self.requests, 1)
+
+hedge_stats = HedgeStats()
+
+
+def _retry_plan(e: BaseException, attempt: int, deadline: float, mode: str) -> float | None:
+    # delay before the next attempt, or None = give up
+    if not _is_retryable(e):
+        openai_breaker.abandon()
+        return None
+    openai_breaker.failure()
+    if attempt >= OPENAI_MAX_RETRIES:
+        return None
+    delay = _retry_delay(e, attempt)
+    if time.monotonic() + delay >= deadline or not openai_breaker.allow():
+        return None
+    M_OPENAI_RETRIES.inc(mode=mode, reason=type(e).__name__)
+    return delay
+
+
+async def _completion_attempt(
+    system_prompt: str, user_prompt: str, tier: str, mode: str, style: str, deadline: float,
+    avoid_model: str | None = None, picked: dict | None = None,
+):
+    # picked: receives {"model": ...} as soon as the model is chosen, so a
+    # hedge started while this attempt runs can avoid that model
+    queue_deadline = max(0.0, min(QUEUE_DEADLINE_SECONDS, deadline - time.monotonic()))
+    async with openai_gate.slot(tier, queue_deadline):
+        max_tokens = token_budget.limit(mode, style)
+        est = estimate_request_tokens(system_prompt, user_prompt, max_tokens)
+        with span("ratelimit"):
+            await rate_limiter.acquire(est, deadline)
+        model = model_router.pick(mode, avoid_model)
+        if picked is not None:
+            picked["model"] = model
+        t0 = time.monotonic()
+        try:
+            with span("openai", mode=mode, model=model, max_tokens=max_tokens) as sp:
+                # only the upstream call is under the deadline: a timeout
+                # here is an upstream timeout (local waits raise SchedulerBusy)
+                resp = await asyncio.wait_for(
+                    client.chat.completions.create(
+                        model=model,
+                        messages=[
+                            {"role": "system", "content": system_prompt},
+                            {"role": "user", "content": user_prompt},
+                        ],
+                        max_tokens=max_tokens,
+                    ),
+                    deadline - time.monotonic(),
+                )
+                if resp.usage:
+                    sp.set(prompt_tokens=resp.usage.prompt_tokens, completion_tokens=resp.usage.completion_tokens)
+        except BaseException as e:
+            # rejected by the API (4xx/5xx): nothing was charged; cancelled
+            # (hedge loser) or timed out: the request may have been billed
+            rate_limiter.settle(est, 0 if _is_status_error(e) else est)
+            if isinstance(e, Exception):
+                M_ERRORS.inc(where="openai", type=type(e).__name__)
+                if _is_retryable(e):
+                    model_router.record(mode, model, None, ok=False)
+            raise
+        M_OPENAI_SECONDS.observe(time.monotonic() - t0, mode=mode, model=model)
+        model_router.record(mode, model, time.monotonic() - t0, ok=True)
+        rate_limiter.settle(est, resp.usage.total_tokens if resp.usage else est)
+        prompt_usage.record(mode, resp.usage)
+        token_budget.record(mode, style, resp.usage, resp.choices[0].finish_reason if resp.choices else None)
+        return resp
+
+
+async def _hedged_completion(system_prompt: str, user_prompt: str, tier: str, mode: str, style: str, deadline: float):
+    # a second identical request once the first is slower than p95 for
+    # this mode; the first answer wins, the other one is cancelled
+    hedge_stats.requests += 1
+    first_picked: dict = {}
+    first = asyncio.create_task(
+        _completion_attempt(system_prompt, user_prompt, tier, mode, style, deadline, picked=first_picked)
+    )
+    tasks = [first]
+    try:
+        hedge_after = openai_latency.percentile(mode, 0.95, OPENAI_HEDGE_MIN_SAMPLES) if OPENAI_HEDGE else None
+        if hedge_after is not None and tier != "prefetch":
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done and not openai_gate.waiting and hedge_stats.allowed():
+                hedge_stats.hedged += 1
+                M_HEDGES.inc(mode=mode)
+                # prefer another model for the hedge: the first one may be the slow one
+                tasks.append(asyncio.create_task(_completion_attempt(
+                    system_prompt, user_prompt, tier, mode, style, deadline, first_picked.get("model")
+                )))
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not first:
+                        hedge_stats.won += 1
+                    return task.result()
+        raise first.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def request_completion(
+    system_prompt: str, user_prompt: str, tier: str = "free", mode: str = "other", style: str = ""
+):
+    # deadline per mode, jittered retries on 429/5xx/timeouts, optional
+    # hedging, circuit breaker (OpenAIUnavailable while upstream is down)
+    if not openai_breaker.allow():
+        raise OpenAIUnavailable("circuit open")
+    probe = openai_breaker.state == "half_open"
+    try:
+        deadline = time.monotonic() + mode_deadline(mode)
+        attempt = 0
+        while True:
+            t0 = time.monotonic()
+            try:
+                # every attempt bounds its own upstream call by the deadline
+                resp = await _hedged_completion(system_prompt, user_prompt, tier, mode, style, deadline)
+            except SchedulerBusy:
+                openai_breaker.abandon()
+                raise
+            except Exception as e:
+                delay = _retry_plan(e, attempt, deadline, mode)
+                if delay is None:
+                    if _is_retryable(e):
+                        raise OpenAIUnavailable(f"{type(e).__name__} after {attempt + 1} attempt(s)") from e
+                    raise
+                attempt += 1
+                with span("retry.backoff", attempt=attempt):
+                    await asyncio.sleep(delay)
+                continue
+            openai_breaker.success()
+            openai_latency.observe(mode, time.monotonic() - t0)
+            return resp
+    except (asyncio.CancelledError, GeneratorExit):
+        # cancelled mid-request: tells nothing about upstream, but a
+        # half-open probe must give its slot back or the circuit stays shut
+        if probe:
+            openai_breaker.abandon()
+        raise
+
+async def call_openai(
+    system_prompt: str, user_prompt: str, tier: str = "free", mode: str = "other", style: str = ""
+) -> str:
+    resp = await request_completion(system_prompt, user_prompt, tier, mode, style)
+    return resp.choices[0].message.content
+
+async def _stream_attempt(system_prompt: str, user_prompt: str, tier: str, mode: str, style: str, deadline: float):
+    # yields text deltas; the in-flight slot is held until the stream ends
+    queue_deadline = max(0.0, min(QUEUE_DEADLINE_SECONDS, deadline - time.monotonic()))
+    async with openai_gate.slot(tier, queue_deadline):
+        max_tokens = token_budget.limit(mode, style)
+        est = estimate_request_tokens(system_prompt, user_prompt, max_tokens)
+        with span("ratelimit"):
+            await rate_limiter.acquire(est, deadline)
+        model = model_router.pick(mode)
+        actual = None
+        usage = finish_reason = None
+        t0 = time.monotonic()
+        try:
+            with span("openai", mode=mode, model=model, max_tokens=max_tokens, stream=True) as sp:
+                stream = await asyncio.wait_for(
+                    client.chat.completions.create(
+                        model=model,
+                        messages=[
+                            {"role": "system", "content": system_prompt},
+                            {"role": "user", "content": user_prompt},
+                        ],
+                        max_tokens=max_tokens,
+                        stream=True,
+                        stream_options={"include_usage": True},
+                    ),
+                    deadline - time.monotonic(),
+                )
+                try:
+                    chunks = stream.__aiter__()
+                    first = True
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), deadline - time.monotonic())
+                        except StopAsyncIteration:
+                            break
+                        if chunk.usage:
+                            usage = chunk.usage
+                            actual = usage.total_tokens
+                            prompt_usage.record(mode, usage)
+                            sp.set(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+                        if chunk.choices and chunk.choices[0].finish_reason:
+                            finish_reason = chunk.choices[0].finish_reason
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            if first:
+                                sp.set(first_token_ms=round((time.monotonic() - t0) * 1000, 1))
+                                first = False
+                            yield chunk.choices[0].delta.content
+                finally:
+                    await stream.close()
+            M_OPENAI_SECONDS.observe(time.monotonic() - t0, mode=mode, model=model)
+            model_router.record(mode, model, time.monotonic() - t0, ok=True)
+            token_budget.record(mode, style, usage, finish_reason)
+        except Exception as e:
+            M_ERRORS.inc(where="openai", type=type(e).__name__)
+            if _is_retryable(e):
+                model_router.record(mode, model, None, ok=False)
+            raise
+        finally:
+            rate_limiter.settle(est, est if actual is None else actual)
+
+async def stream_openai(
+    system_prompt: str, user_prompt: str, tier: str = "free", mode: str = "other", style: str = ""
+):
+    # same policy as request_completion, but a stream is only retried while
+    # nothing was yielded yet (no hedging: the user already sees the text)
+    if not openai_breaker.allow():
+        raise OpenAIUnavailable("circuit open")
+    probe = openai_breaker.state == "half_open"
+    try:
+        deadline = time.monotonic() + mode_deadline(mode)
+        attempt = 0
+        while True:
+            t0 = time.monotonic()
+            yielded = False
+            try:
+                async with contextlib.aclosing(
+                    _stream_attempt(system_prompt, user_prompt, tier, mode, style, deadline)
+                ) as deltas:
+                    async for delta in deltas:
+                        yielded = True
+                        yield delta
+            except SchedulerBusy:
+                openai_breaker.abandon()
+                raise
+            except Exception as e:
+                if yielded:
+                    if _is_retryable(e):
+                        openai_breaker.failure()
+                    else:
+                        openai_breaker.abandon()
+                    raise
+                delay = _retry_plan(e, attempt, deadline, mode)
+                if delay is None:
+                    if _is_retryable(e):
+                        raise OpenAIUnavailable(f"{type(e).__name__} after {attempt + 1} attempt(s)") from e
+                    raise
+                attempt += 1
+                with span("retry.backoff", attempt=attempt):
+                    await asyncio.sleep(delay)
+                continue
+            openai_breaker.success()
+            openai_latency.observe(mode, time.monotonic() - t0)
+            return
+    except (asyncio.CancelledError, GeneratorExit):
+        # cancelled mid-request: tells nothing about upstream, but a
+        # half-open probe must give its slot back or the circuit stays shut
+        if probe:
+            openai_breaker.abandon()
+        raise
+
+def quick_template_to_text(button_text: str) -> str:
+    mapping = {
+        "💸 Дорого": "Customer says: 'Too expensive' / 'It's pricey'.",
+        "🚚 Доставка": "Customer asks about delivery: cost and time.",
+        "📦 Наявність": "Customer asks if it's in stock / available options (size/color).",
+        "🏷️ Знижка/торг": "Customer asks for a discount / negotiation.",
+        "💳 Оплата/оформлення": "Customer asks how to pay and place an order.",
+        "🛡️ Повернення/гарантія": "Customer asks about returns / warranty if it doesn't fit.",
+    }
+    return mapping.get(button_text, "")
+
+def demo_used_today(context: ContextTypes.DEFAULT_TYPE) -> bool:
+    return context.user_data.get("demo_day") == str(date.today())
+
+def mark_demo_used(context: ContextTypes.DEFAULT_TYPE):
+    context.user_data["demo_day"] = str(date.today())
+
+async def claim_demo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    # False = FREE user already had the DEMO today (on any replica)
+    if quota_backend and update.effective_user:
+        first = await quota_backend.claim_demo(update.effective_user.id, str(date.today()))
+    else:
+        first = not demo_used_today(context)
+    if not first and get_user_tier(update) == "free":
+        return False
+    mark_demo_used(context)
+    return True
+
+async def unclaim_demo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.pop("demo_day", None)
+    if quota_backend and update.effective_user:
+        await quota_backend.release_demo(update.effective_user.id, str(date.today()))
+
+
+# =========================================================
+# 10) AI REPLIES (placeholder -> answer, optional streaming)
+# =========================================================
+def split_message(text: str, limit: int = TELEGRAM_MAX_MESSAGE) -> list[str]:
+    # split on line breaks where possible, never above Telegram's limit
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    parts.append(text)
+    return parts
+
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    retry = e.retry_after
+    if hasattr(retry, "total_seconds"):
+        retry = retry.total_seconds()
+    return float(retry)
+
+
+class StreamingMessage:
+    # Edits one Telegram message as text grows. An edit is sent when
+    # STREAM_EDIT_INTERVAL passed and STREAM_EDIT_MIN_CHARS new chars arrived.
+    # The first preview waits one interval too, so an answer that is done by
+    # then gets only the final edit. Only one edit is in flight; tokens keep
+    # arriving while it is sent.
+    def __init__(self, message):
+        self.message = message
+        self.text = ""
+        self.shown = ""
+        self.next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL
+        self._edit_task: asyncio.Task | None = None
+
+    def push(self, delta: str):
+        self.text += delta
+        if self._edit_task and not self._edit_task.done():
+            return
+        now = time.monotonic()
+        if now < self.next_edit_at:
+            return
+        if self.shown and len(self.text) - len(self.shown) < STREAM_EDIT_MIN_CHARS:
+            return
+        preview = self.text
+        if len(preview) > TELEGRAM_MAX_MESSAGE - 2:
+            preview = preview[: TELEGRAM_MAX_MESSAGE - 2]
+        self._edit_task = asyncio.create_task(self._edit(preview + " ▌"))
+        self.shown = self.text
+
+    async def _edit(self, text: str):
+        self.next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL
+        try:
+            await self.message.edit_text(text)
+        except RetryAfter as e:
+            self.next_edit_at = time.monotonic() + _retry_after_seconds(e)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+
+    async def finish(self, update: Update, reply_markup):
+        if self._edit_task:
+            with contextlib.suppress(Exception):
+                await self._edit_task
+        # the final edit goes out right away, even inside the throttle
+        # window: a rare 429 is cheaper than delaying every answer
+        parts = split_message(self.text)
+        for attempt in range(3):
+            try:
+                await self.message.edit_text(parts[0])
+                break
+            except RetryAfter as e:
+                if attempt == 2:
+                    raise
+                await asyncio.sleep(_retry_after_seconds(e))
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+                break
+        for part in parts[1:]:
+            await update.message.reply_text(part, reply_markup=reply_markup)
+
+
+def _write_json_atomic(path: str, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class ResponseCache:
+    # LRU + TTL cache: key -> {"ts": created, "variants": [[text, gen_seconds], ...]}
+    def __init__(self, max_entries: int, ttl: float, variants: int, path: str = ""):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = variants
+        self.path = path
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    @staticmethod
+    def key(system_prompt: str, user_prompt: str, model: str, max_tokens: int) -> str:
+        norm = "\x1f".join([
+            " ".join(system_prompt.split()),
+            " ".join(user_prompt.split()),
+            model,
+            str(max_tokens),
+        ])
+        return hashlib.sha256(norm.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry["ts"] > self.ttl:
+            del self._entries[key]
+            entry = None
+        if entry is None or len(entry["variants"]) < self.variants:
+            self.misses += 1
+            M_CACHE_LOOKUPS.inc(result="miss")
+            return None
+        self._entries.move_to_end(key)
+        text, gen_seconds = random.choice(entry["variants"])
+        self.hits += 1
+        self.saved_seconds += gen_seconds
+        M_CACHE_LOOKUPS.inc(result="hit")
+        M_CACHE_SAVED_SECONDS.inc(gen_seconds)
+        return text
+
+    def get_stale(self, key: str) -> str | None:
+        # any variant, even before all are collected: fallback while OpenAI is down
+        entry = self._entries.get(key)
+        if entry is None or not entry["variants"]:
+            return None
+        return random.choice(entry["variants"])[0]
+
+    def put(self, key: str, text: str, gen_seconds: float):
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {"ts": time.time(), "variants": []}
+        self._entries.move_to_end(key)
+        if len(entry["variants"]) < self.variants:
+            entry["variants"].append([text, gen_seconds])
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        self._dirty = True
+
+    def has_all_variants(self, key: str) -> bool:
+        entry = self._entries.get(key)
+        return entry is not None and len(entry["variants"]) >= self.variants
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / total if total else 0.0,
+            "saved_seconds": self.saved_seconds,
+        }
+
+    def load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except Exception as e:
+            print("RESPONSE CACHE LOAD ERROR:", repr(e))
+            return
+        now = time.time()
+        for key, entry in data.items():
+            if now - entry.get("ts", 0) <= self.ttl:
+                self._entries[key] = entry
+
+    def save(self):
+        if not self.path or not self._dirty:
+            return
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        _write_json_atomic(self.path, dict(self._entries))
+
+    async def maybe_save(self):
+        if self.path and self._dirty and time.monotonic() - self._saved_at >= RESPONSE_CACHE_SAVE_SECONDS:
+            self._saved_at = time.monotonic()
+            self._dirty = False
+            snapshot = dict(self._entries)
+            await asyncio.to_thread(_write_json_atomic, self.path, snapshot)
+
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL, RESPONSE_CACHE_VARIANTS, RESPONSE_CACHE_FILE)
+metrics.add(Gauge("bot_response_cache_hit_ratio", "Response cache hits / lookups", lambda: response_cache.stats()["hit_ratio"]))
+metrics.add(Gauge("bot_response_cache_entries", "Response cache entries", lambda: len(response_cache._entries)))
+
+
+QUICK_TOPICS = ["💸 Дорого", "🚚 Доставка", "📦 Наявність", "🏷️ Знижка/торг", "💳 Оплата/оформлення", "🛡️ Повернення/гарантія"]
+
+
+class QuickReplyPrefetcher:
+    # Answers are kept per user: (user_id, prompt_key) ->
+    # (text, tokens, ts, gen_seconds, cache_key). The stash is keyed on the
+    # prompts only, so a token budget change between prefetch and tap
+    # doesn't orphan the answer; cache_key (with the budget the answer was
+    # generated under) is where it goes into the response cache.
+    # Picks are counted per profile (platform, style, language) to guess
+    # which topics to generate first.
+    def __init__(self):
+        self._stash: dict[int, dict[str, tuple[str, int, float, float, str]]] = {}
+        self._picks: dict[tuple, dict[str, int]] = {}
+        self._sem = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+        self._tasks: set[asyncio.Task] = set()
+        self._inflight: set[tuple[int, str]] = set()
+        self._swept_at = time.time()
+        self.day = str(date.today())
+        self.today = 0
+        self.started = 0
+        self.hits = 0
+        self.wasted = 0
+        self.tokens_used = 0
+        self.tokens_wasted = 0
+
+    @staticmethod
+    def profile_key(profile: dict) -> tuple:
+        return (profile.get("platform"), profile.get("style_template"), profile.get("language"))
+
+    @staticmethod
+    def prompt_key(system_prompt: str, user_prompt: str) -> str:
+        return hashlib.sha256(f"{system_prompt}\x1f{user_prompt}".encode("utf-8")).hexdigest()
+
+    def record_pick(self, profile: dict, topic: str):
+        picks = self._picks.setdefault(self.profile_key(profile), {})
+        picks[topic] = picks.get(topic, 0) + 1
+
+    def likely_topics(self, profile: dict) -> list[str]:
+        picks = self._picks.get(self.profile_key(profile), {})
+        # most picked first, menu order breaks ties
+        return sorted(QUICK_TOPICS, key=lambda t: -picks.get(t, 0))[:PREFETCH_TOPICS]
+
+    def _expire(self, uid: int):
+        entries = self._stash.get(uid)
+        if not entries:
+            return
+        now = time.time()
+        for key in [k for k, v in entries.items() if now - v[2] > PREFETCH_TTL]:
+            self.wasted += 1
+            self.tokens_wasted += entries.pop(key)[1]
+        if not entries:
+            del self._stash[uid]
+
+    def take(self, uid: int, system_prompt: str, user_prompt: str) -> tuple[str, float, str] | None:
+        # -> (text, gen_seconds, cache_key it was generated for)
+        self._expire(uid)
+        entry = self._stash.get(uid, {}).pop(self.prompt_key(system_prompt, user_prompt), None)
+        if entry is None:
+            return None
+        self.hits += 1
+        return entry[0], entry[3], entry[4]
+
+    def _budget_left(self) -> bool:
+        today = str(date.today())
+        if self.day != today:
+            self.day = today
+            self.today = 0
+        return self.today < PREFETCH_DAILY_CAP
+
+    def schedule(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not PREFETCH_ENABLED or not update.effective_user:
+            return
+        uid = update.effective_user.id
+        tier = get_user_tier(update)
+        if tier not in PREFETCH_TIERS:
+            return
+        limit = tier_daily_limit(tier)
+        if limit is not None and context.user_data["limits"]["count"] >= limit:
+            return
+        # low priority: only when nobody waits for OpenAI
+        if openai_gate.waiting or openai_gate.in_flight >= openai_gate.limit // 2:
+            return
+
+        if time.time() - self._swept_at > PREFETCH_TTL:
+            self._swept_at = time.time()
+            for other in list(self._stash):
+                self._expire(other)
+        else:
+            self._expire(uid)
+        profile = dict(context.user_data["profile"])
+        system_prompt = build_system_prompt(profile, "quick_replies")
+        for topic in self.likely_topics(profile):
+            user_prompt = build_user_prompt("quick_replies", quick_template_to_text(topic), profile)
+            key = self.prompt_key(system_prompt, user_prompt)
+            if key in self._stash.get(uid, {}) or (uid, key) in self._inflight:
+                continue
+            budget = token_budget.limit("quick_replies", profile_style(profile))
+            if response_cache.has_all_variants(ResponseCache.key(system_prompt, user_prompt, MODEL_NAME, budget)):
+                continue
+            if not self._budget_left():
+                return
+            self.today += 1
+            self._inflight.add((uid, key))
+            # own context: prefetch work is not part of the update's trace
+            task = asyncio.create_task(
+                self._run(uid, key, system_prompt, user_prompt, profile_style(profile)), context=contextvars.Context()
+            )
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, uid: int, key: str, system_prompt: str, user_prompt: str, style: str):
+        try:
+            async with self._sem:
+                if openai_gate.waiting:
+                    self.today -= 1
+                    return
+                self.started += 1
+                t0 = time.monotonic()
+                resp = await request_completion(system_prompt, user_prompt, "prefetch", "quick_replies", style)
+                text = resp.choices[0].message.content or ""
+                tokens = resp.usage.total_tokens if resp.usage else 0
+                self.tokens_used += tokens
+                if text.strip():
+                    # the budget the request just ran with, not the one at scheduling
+                    budget = token_budget.limit("quick_replies", style)
+                    cache_key = ResponseCache.key(system_prompt, user_prompt, MODEL_NAME, budget)
+                    self._stash.setdefault(uid, {})[key] = (text, tokens, time.time(), time.monotonic() - t0, cache_key)
+        except Exception as e:
+            print("PREFETCH ERROR:", repr(e))
+        finally:
+            self._inflight.discard((uid, key))
+
+    def stats(self) -> dict:
+        return {
+            "today": self.today,
+            "daily_cap": PREFETCH_DAILY_CAP,
+            "generated": self.started,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.started if self.started else 0.0,
+            "wasted": self.wasted,
+            "tokens_used": self.tokens_used,
+            "tokens_wasted": self.tokens_wasted,
+        }
+
+prefetcher = QuickReplyPrefetcher()
+
+
+# Served while OpenAI is unavailable (circuit open / retries used up)
+FALLBACK_REPLIES = {
+    "replies": (
+        "Шаблон, поки AI недоступний:\n\n"
+        "Вітаю! Дякую за повідомлення 🙌 Уточню деталі і відповім вам протягом кількох хвилин."
+    ),
+    "quick_replies": (
+        "Шаблон, поки AI недоступний:\n\n"
+        "Дякую за питання! Зараз перевірю і напишу вам усі деталі 🙏"
+    ),
+    "demo": (
+        "Приклад відповіді на «Дорого»:\n\n"
+        "Розумію вас! Ціна включає гарантію та швидку доставку. Можу запропонувати безкоштовну доставку, "
+        "якщо оформите сьогодні 😊"
+    ),
+}
+
+
+async def send_fallback_answer(update: Update, cache_key: str | None, mode: str, reply_markup) -> bool:
+    # True = a real (cached) answer was sent, False = only a template
+    cached = response_cache.get_stale(cache_key) if cache_key else None
+    if cached is not None:
+        M_FALLBACKS.inc(mode=mode, source="cache")
+        for part in split_message(cached):
+            await update.message.reply_text(part, reply_markup=reply_markup)
+        return True
+    M_FALLBACKS.inc(mode=mode, source="template")
+    text = "⚠️ AI зараз недоступний, ліміт не списано. Спробуй за хвилину."
+    if mode in FALLBACK_REPLIES:
+        text += "\n\n" + FALLBACK_REPLIES[mode]
+    await update.message.reply_text(text, reply_markup=reply_markup)
+    return False
+
+
+async def send_ai_answer(
+    update: Update,
+    placeholder: str,
+    system_prompt: str,
+    user_prompt: str,
+    reply_markup,
+    cacheable: bool = False,
+    mode: str = "other",
+    style: str = "",
+) -> bool:
+    # False = not answered by AI: queue full or OpenAI unavailable (caller refunds the limit)
+    tier = get_user_tier(update)
+    cache_key = None
+    if cacheable:
+        # the output budget is part of the key: an answer generated under a
+        # small budget is not served to a request that would get a larger one
+        cache_key = ResponseCache.key(system_prompt, user_prompt, MODEL_NAME, token_budget.limit(mode, style))
+        prefetched = prefetcher.take(update.effective_user.id, system_prompt, user_prompt) if update.effective_user else None
+        if prefetched is not None:
+            # this user asked for exactly this prompt; the shared cache gets
+            # it under the budget it was generated with
+            cached, gen_seconds, generated_key = prefetched
+            response_cache.put(generated_key, cached, gen_seconds)
+        else:
+            cached = response_cache.get(cache_key)
+        if cached is not None:
+            for part in split_message(cached):
+                await update.message.reply_text(part, reply_markup=reply_markup)
+            return True
+
+    msg = await update.message.reply_text(placeholder, reply_markup=reply_markup)
+    try:
+        t0 = time.monotonic()
+        if STREAM_REPLIES:
+            streaming = StreamingMessage(msg)
+            async with contextlib.aclosing(stream_openai(system_prompt, user_prompt, tier, mode, style)) as deltas:
+                async for delta in deltas:
+                    streaming.push(delta)
+            if not streaming.text.strip():
+                raise RuntimeError("empty completion")
+            answer = streaming.text
+            gen_seconds = time.monotonic() - t0
+            await streaming.finish(update, reply_markup)
+        else:
+            answer = await call_openai(system_prompt, user_prompt, tier, mode, style)
+            gen_seconds = time.monotonic() - t0
+            for part in split_message(answer):
+                await update.message.reply_text(part, reply_markup=reply_markup)
+        if cache_key:
+            response_cache.put(cache_key, answer, gen_seconds)
+            await response_cache.maybe_save()
+    except SchedulerBusy as e:
+        print("OPENAI BUSY:", e)
+        M_LIMIT_EVENTS.inc(tier=tier, event="queue_deadline")
+        text = "⏳ Зараз забагато запитів. Спробуй за хвилину — ліміт не списано."
+        ahead = openai_gate.queue_position(tier) - 1
+        if ahead:
+            text += f"\nЗапитів у черзі перед тобою: {ahead}."
+        await update.message.reply_text(text, reply_markup=reply_markup)
+        return False
+    except OpenAIUnavailable as e:
+        print("OPENAI UNAVAILABLE:", e)
+        return await send_fallback_answer(update, cache_key, mode, reply_markup)
+    except Exception as e:
+        print("OPENAI ERROR:", repr(e))
+        await update.message.reply_text("⚠️ Помилка AI. Деталі в логах Render.", reply_markup=main_menu())
+    return True
+
+
+# =========================================================
+# 11) BULK DESCRIPTIONS (CSV/XLSX -> CSV)
+# =========================================================
+# Job dir: BULK_JOBS_DIR/<job_id>/ with input.<ext> and results.csv
+# (row, input, description). job_id depends on user + file content, so
+# re-sending the same file resumes: rows already in results.csv are skipped.
+# A job dir is removed once all rows are delivered; unfinished ones are
+# swept after BULK_JOB_TTL_HOURS. Row numbers are file positions (stable
+# for a resume), the BULK_MAX_ROWS cap counts only non-empty rows.
+_bulk_tasks: dict[int, asyncio.Task] = {}
+
+# Excel in UA/RU locales saves "CSV" as cp1251; UTF-8 is tried first (strict,
+# so cp1251 text never decodes as UTF-8 by accident)
+CSV_ENCODINGS = ("utf-8-sig", "cp1251")
+
+
+class BulkFileError(Exception):
+    # the uploaded file can't be read; the message is shown to the user
+    pass
+
+
+def csv_encoding(path: str) -> str:
+    for encoding in CSV_ENCODINGS:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        try:
+            with open(path, "rb") as f:
+                while chunk := f.read(1 << 16):
+                    if b"\0" in chunk:
+                        raise BulkFileError("⚠️ Це не текстовий CSV. Збережи таблицю як CSV (UTF-8) або XLSX.")
+                    decoder.decode(chunk)
+            decoder.decode(b"", final=True)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    raise BulkFileError("⚠️ Не вдалося розпізнати кодування CSV. Збережи файл як CSV (UTF-8).")
+
+
+def check_table_file(path: str) -> int:
+    # reads the whole file once before the job starts; returns the row count
+    try:
+        rows = _bulk_count_rows(path)
+    except BulkFileError:
+        raise
+    except Exception as e:  # zipfile.BadZipFile, openpyxl errors, csv.Error
+        raise BulkFileError("⚠️ Файл пошкоджений або не є таблицею CSV/XLSX. Перевір його та надішли знову.") from e
+    if not rows:
+        raise BulkFileError("⚠️ У файлі немає рядків з даними (перший рядок — заголовок).")
+    return rows
+
+
+def iter_table_rows(path: str):
+    # streams rows as lists of strings (first row = header)
+    if path.endswith(".xlsx"):
+        from openpyxl import load_workbook  # optional, only for XLSX
+
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            for row in wb.active.iter_rows(values_only=True):
+                yield ["" if v is None else str(v) for v in row]
+        finally:
+            wb.close()
+        return
+
+    with open(path, "r", encoding=csv_encoding(path), newline="") as f:
+        sample = f.read(4096)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        yield from csv.reader(f, dialect)
+
+
+def bulk_row_text(header: list[str], row: list[str]) -> str:
+    parts = []
+    for i, value in enumerate(row):
+        value = value.strip()
+        if not value:
+            continue
+        name = header[i].strip() if i < len(header) and header[i].strip() else f"col{i + 1}"
+        parts.append(f"{name}: {value}")
+    return truncate_tokens("\n".join(parts), MAX_INPUT_TOKENS)
+
+
+def _bulk_done_rows(results_path: str) -> set[int]:
+    if not os.path.exists(results_path):
+        return set()
+    with open(results_path, "r", encoding="utf-8", newline="") as f:
+        return {int(r[0]) for r in csv.reader(f) if r and r[0].isdigit()}
+
+
+def _bulk_count_rows(path: str) -> int:
+    rows = iter_table_rows(path)
+    next(rows, None)  # header
+    return sum(1 for row in rows if any(v.strip() for v in row))
+
+
+async def reserve_bulk_row(update: Update, context: ContextTypes.DEFAULT_TYPE, tier: str) -> bool:
+    # quota only: bulk rows skip the per-message cooldown
+    reset_daily_if_needed(context)
+    limit = tier_daily_limit(tier)
+    limits = context.user_data["limits"]
+    if quota_backend:
+        allowed, _, limits["count"], _ = await quota_backend.reserve(update.effective_user.id, limits["day"], limit, 0)
+        return allowed
+    if limit is not None and int(limits.get("count", 0)) >= limit:
+        return False
+    limits["count"] += 1
+    return True
+
+
+async def run_bulk_job(update: Update, context: ContextTypes.DEFAULT_TYPE, job_dir: str, input_path: str):
+    profile = dict(context.user_data["profile"])
+    tier = get_user_tier(update)
+    results_path = os.path.join(job_dir, "results.csv")
+    done = await asyncio.to_thread(_bulk_done_rows, results_path)
+    total = min(await asyncio.to_thread(_bulk_count_rows, input_path), BULK_MAX_ROWS)
+
+    system_prompt = build_system_prompt(profile, "description")
+    progress = await update.message.reply_text(f"📦 Обробка: {len(done)}/{total}…")
+    state = {"done": len(done), "failed": 0, "quota": False, "shown_at": time.monotonic()}
+
+    async def show_progress(force: bool = False):
+        if not force and time.monotonic() - state["shown_at"] < BULK_PROGRESS_SECONDS:
+            return
+        state["shown_at"] = time.monotonic()
+        with contextlib.suppress(BadRequest, RetryAfter):
+            await progress.edit_text(f"📦 Обробка: {state['done']}/{total} (помилок: {state['failed']})…")
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=BULK_CONCURRENCY * 2)
+
+    with open(results_path, "a", encoding="utf-8", newline="") as out:
+        writer = csv.writer(out)
+        write_lock = threading.Lock()
+
+        def write_result(row: list):
+            with write_lock:
+                writer.writerow(row)
+                out.flush()
+
+        async def worker():
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                row_no, row_text = item
+                if state["quota"] or not await reserve_bulk_row(update, context, tier):
+                    state["quota"] = True
+                    continue
+                user_prompt = build_user_prompt("description", row_text, profile)
+                try:
+                    answer = await call_openai(system_prompt, user_prompt, tier, "description", profile_style(profile))
+                except Exception as e:
+                    print("BULK OPENAI ERROR:", repr(e))
+                    await release_ai_call(update, context)
+                    state["failed"] += 1
+                    continue
+                await asyncio.to_thread(write_result, [row_no, row_text, answer])
+                state["done"] += 1
+                if user_state:
+                    user_state.touch(update.effective_user.id, context.user_data)
+                await show_progress()
+
+        workers = [asyncio.create_task(worker()) for _ in range(BULK_CONCURRENCY)]
+        try:
+            rows = iter_table_rows(input_path)
+            header = next(rows, [])
+            data_rows = 0
+            for row_no, row in enumerate(rows, start=1):
+                if state["quota"]:
+                    break
+                row_text = bulk_row_text(header, row)
+                if not row_text:
+                    continue
+                data_rows += 1
+                if data_rows > BULK_MAX_ROWS:
+                    break
+                if row_no not in done:
+                    await queue.put((row_no, row_text))
+        finally:
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+
+    await show_progress(force=True)
+    if state["quota"]:
+        await update.message.reply_text(
+            f"❌ Ліміт на сьогодні вичерпано. Готово {state['done']}/{total}.\n"
+            "Надішли той самий файл пізніше (або після підключення тарифу) — продовжу з місця зупинки.",
+            reply_markup=main_menu(),
+        )
+
+    output = await asyncio.to_thread(_bulk_sorted_results, results_path)
+    if output:
+        await update.message.reply_document(
+            document=output,
+            filename=f"descriptions_{os.path.basename(job_dir)}.csv",
+            caption=f"✅ Описи: {state['done']}/{total}",
+            reply_markup=main_menu(),
         )
-    return (
-        "Format:\n"
-        "1) Title\n"
-        "2) Short description (2–4 sentences)\n"
-        "3) Specs/condition/what's included (if known)\n"
-        "4) Benefits (5–7 bullets)\n"
-        "5) Delivery/payment (generic, no invented details)\n"
-        "6) Call to action"
-    )
+    if state["done"] >= total:
+        await asyncio.to_thread(shutil.rmtree, job_dir, True)
 
-def build_user_prompt(mode: str, text: str, profile: dict) -> str:
-    platform = profile.get("platform", "OLX")
 
-    if mode == "description":
-        return (
-            f"Write a sales-ready product description for platform: {platform}\n"
-            f"{description_format_for_platform(platform)}\n\n"
-            f"Input from seller:\n{text}"
-        )
+def _sweep_bulk_jobs(skip: str = ""):
+    # removes unfinished job dirs untouched for BULK_JOB_TTL_HOURS
+    if not os.path.isdir(BULK_JOBS_DIR):
+        return
+    cutoff = time.time() - BULK_JOB_TTL_HOURS * 3600
+    for name in os.listdir(BULK_JOBS_DIR):
+        job_dir = os.path.join(BULK_JOBS_DIR, name)
+        if name == skip or not os.path.isdir(job_dir):
+            continue
+        with contextlib.suppress(OSError):
+            touched = max([os.path.getmtime(job_dir)] + [os.path.getmtime(e.path) for e in os.scandir(job_dir)])
+            if touched < cutoff:
+                shutil.rmtree(job_dir, True)
+
+
+def _bulk_sorted_results(results_path: str) -> bytes:
+    with open(results_path, "r", encoding="utf-8", newline="") as f:
+        rows = [r for r in csv.reader(f) if r and r[0].isdigit()]
+    if not rows:
+        return b""
+    rows.sort(key=lambda r: int(r[0]))
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(["row", "input", "description"])
+    writer.writerows(rows)
+    return buf.getvalue().encode("utf-8-sig")
+
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    ensure_defaults(context)
+    if context.user_data.get("mode") != "bulk_description":
+        await update.message.reply_text("Щоб обробити файл, натисни 📦 Масовий опис.", reply_markup=main_menu())
+        return
 
-    return (
-        "Create 5 short reply options to the customer message.\n"
-        "1–3: universal replies\n"
-        "4: reply with a clarifying question\n"
-        "5: soft close (next step: order/reserve/contact)\n"
-        "Each option on a new line. No pressure.\n\n"
-        f"Customer message / situation:\n{text}"
-    )
+    uid = update.effective_user.id
+    running = _bulk_tasks.get(uid)
+    if running and not running.done():
+        await update.message.reply_text("⏳ Попередній файл ще обробляється.", reply_markup=main_menu())
+        return
 
-async def call_openai(system_prompt: str, user_prompt: str) -> str:
-    resp = await asyncio.to_thread(
-        client.chat.completions.create,
-        model=MODEL_NAME,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        max_tokens=MAX_TOKENS,
-    )
-    return resp.choices[0].message.content
+    doc = update.message.document
+    name = (doc.file_name or "").lower()
+    ext = ".xlsx" if name.endswith(".xlsx") else ".csv" if name.endswith(".csv") else ""
+    if not ext:
+        await update.message.reply_text("Підтримуються лише файли .csv та .xlsx.", reply_markup=main_menu())
+        return
+    if doc.file_size and doc.file_size > BULK_MAX_FILE_MB * 1024 * 1024:
+        await update.message.reply_text(f"Файл завеликий (макс. {BULK_MAX_FILE_MB} МБ).", reply_markup=main_menu())
+        return
+    if ext == ".xlsx":
+        try:
+            import openpyxl  # noqa: F401
+        except ImportError:
+            await update.message.reply_text("XLSX тимчасово не підтримується — збережи файл як CSV.", reply_markup=main_menu())
+            return
 
-def quick_template_to_text(button_text: str) -> str:
-    mapping = {
-        "💸 Дорого": "Customer says: 'Too expensive' / 'It's pricey'.",
-        "🚚 Доставка": "Customer asks about delivery: cost and time.",
-        "📦 Наявність": "Customer asks if it's in stock / available options (size/color).",
-        "🏷️ Знижка/торг": "Customer asks for a discount / negotiation.",
-        "💳 Оплата/оформлення": "Customer asks how to pay and place an order.",
-        "🛡️ Повернення/гарантія": "Customer asks about returns / warranty if it doesn't fit.",
-    }
-    return mapping.get(button_text, "")
+    tg_file = await doc.get_file()
+    data = bytes(await tg_file.download_as_bytearray())
+    job_id = hashlib.sha256(str(uid).encode() + b":" + data).hexdigest()[:16]
+    job_dir = os.path.join(BULK_JOBS_DIR, job_id)
+    input_path = os.path.join(job_dir, "input" + ext)
+    await asyncio.to_thread(_sweep_bulk_jobs, job_id)
+    if not os.path.exists(input_path):
+        os.makedirs(job_dir, exist_ok=True)
+        await asyncio.to_thread(_write_bytes, input_path, data)
+    try:
+        await asyncio.to_thread(check_table_file, input_path)
+    except BulkFileError as e:
+        await asyncio.to_thread(shutil.rmtree, job_dir, True)
+        await update.message.reply_text(str(e), reply_markup=main_menu())
+        return
 
-def demo_used_today(context: ContextTypes.DEFAULT_TYPE) -> bool:
-    return context.user_data.get("demo_day") == str(date.today())
+    # in the background: the user's other messages shouldn't wait for the whole file
+    task = asyncio.create_task(_run_bulk_job_safe(update, context, job_dir, input_path), context=contextvars.Context())
+    _bulk_tasks[uid] = task
+    task.add_done_callback(lambda t: _bulk_tasks.pop(uid, None) if _bulk_tasks.get(uid) is t else None)
 
-def mark_demo_used(context: ContextTypes.DEFAULT_TYPE):
-    context.user_data["demo_day"] = str(date.today())
+
+async def _run_bulk_job_safe(update, context, job_dir, input_path):
+    try:
+        await run_bulk_job(update, context, job_dir, input_path)
+    except BulkFileError as e:
+        await update.message.reply_text(str(e), reply_markup=main_menu())
+    except Exception as e:
+        print("BULK JOB ERROR:", repr(e))
+        await update.message.reply_text(
+            "⚠️ Обробку файлу перервано. Надішли той самий файл ще раз — продовжу з місця зупинки.",
+            reply_markup=main_menu(),
+        )
+
+
+def _write_bytes(path: str, data: bytes):
+    with open(path, "wb") as f:
+        f.write(data)
 
 
 # =========================================================
-# 7) MONETIZATION MESSAGES
+# 12) MONETIZATION MESSAGES
 # =========================================================
 async def send_pro_upsell(update: Update, context: ContextTypes.DEFAULT_TYPE, reason: str = "soft"):
     ensure_defaults(context)
@@ -472,7 +3240,7 @@ async def send_payment_instructions(update: Update, context: ContextTypes.DEFAUL
 
 
 # =========================================================
-# 8) ADMIN COMMANDS: /activate /deactivate /list_paid
+# 13) ADMIN COMMANDS: /activate /deactivate /list_paid /export_paid /stats
 # =========================================================
 async def activate_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update):
@@ -504,7 +3272,7 @@ async def activate_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Некоректний user_id.", reply_markup=main_menu())
         return
 
-    set_user_tier(user_id, tier)
+    await set_user_tier(user_id, tier)
     await update.message.reply_text(f"✅ Активовано {tier_label(tier)} для ID {user_id}", reply_markup=main_menu())
 
 
@@ -533,36 +3301,282 @@ async def deactivate_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Некоректний user_id.", reply_markup=main_menu())
         return
 
-    remove_user(user_id)
+    await remove_user(user_id)
     await update.message.reply_text(f"✅ Деактивовано підписку для ID {user_id}", reply_markup=main_menu())
 
 
+PAID_PAGE_SIZE = 50
+# /export_paid sends one document per this many rows (~1 MB)
+EXPORT_PART_ROWS = int(os.getenv("EXPORT_PART_ROWS", "50000"))
+PAID_FILTERS = {"all": "Усі", "pro": "⭐ PRO", "pro_plus": "💎 PRO+"}
+
+
+def paid_page(tier_filter: str, page: int) -> tuple[str, InlineKeyboardMarkup]:
+    # one page of the sorted id list: O(PAID_PAGE_SIZE) per page
+    _refresh_tier_index_if_changed()
+    ids = _tier_ids[tier_filter]
+    pages = max(1, -(-len(ids) // PAID_PAGE_SIZE))
+    page = min(max(page, 0), pages - 1)
+    chunk = ids[page * PAID_PAGE_SIZE:(page + 1) * PAID_PAGE_SIZE]
+
+    lines = [
+        f"📋 Платні користувачі: {PAID_FILTERS[tier_filter]} ({len(ids)})",
+        f"PRO: {len(_tier_ids['pro'])}, PRO+: {len(_tier_ids['pro_plus'])}",
+        "",
+    ]
+    if tier_filter == "all":
+        lines.extend(f"• {uid} — {_tier_index.get(uid, '?')}" for uid in chunk)
+    else:
+        lines.extend(f"• {uid}" for uid in chunk)
+    if not chunk:
+        lines.append("—")
+
+    filters_row = [
+        InlineKeyboardButton(("· " if key == tier_filter else "") + label, callback_data=f"paid:{key}:0")
+        for key, label in PAID_FILTERS.items()
+    ]
+    nav_row = [
+        InlineKeyboardButton("◀️", callback_data=f"paid:{tier_filter}:{max(page - 1, 0)}"),
+        InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"paid:{tier_filter}:{page}"),
+        InlineKeyboardButton("▶️", callback_data=f"paid:{tier_filter}:{min(page + 1, pages - 1)}"),
+    ]
+    return "\n".join(lines), InlineKeyboardMarkup([filters_row, nav_row])
+
+
+def parse_paid_filter(args: list[str]) -> str | None:
+    if not args:
+        return "all"
+    value = args[0].lower().replace("+", "_plus")
+    return value if value in PAID_FILTERS else None
+
+
 async def list_paid_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update):
         await update.message.reply_text("⛔ Немає доступу.", reply_markup=main_menu())
         return
 
-    data = load_subscriptions()
-    users = data.get("users", {})
+    tier_filter = parse_paid_filter(context.args or [])
+    if tier_filter is None:
+        await update.message.reply_text("Використання: /list_paid [pro|pro_plus]", reply_markup=main_menu())
+        return
+    text, keyboard = paid_page(tier_filter, 0)
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+
+async def list_paid_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # inline buttons of /list_paid: callback_data "paid:<filter>:<page>"
+    query = update.callback_query
+    if not is_admin(update):
+        await query.answer("⛔ Немає доступу.")
+        return
+    _, tier_filter, page = query.data.split(":")
+    if tier_filter not in PAID_FILTERS or not page.isdigit():
+        await query.answer()
+        return
+    text, keyboard = paid_page(tier_filter, int(page))
+    await query.answer()
+    with contextlib.suppress(BadRequest):  # "message is not modified" on the same page
+        await query.edit_message_text(text, reply_markup=keyboard)
+
+
+async def export_paid_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # CSV user_id,tier in documents of up to EXPORT_PART_ROWS rows: an upload
+    # is read into memory whole, so one part is the most held at once. A
+    # cursor on user_id keeps concurrent /activate or /deactivate between
+    # chunks from shifting rows.
+    if not is_admin(update):
+        await update.message.reply_text("⛔ Немає доступу.", reply_markup=main_menu())
+        return
+
+    tier_filter = parse_paid_filter(context.args or [])
+    if tier_filter is None:
+        await update.message.reply_text("Використання: /export_paid [pro|pro_plus]", reply_markup=main_menu())
+        return
+
+    _refresh_tier_index_if_changed()
+    name = f"paid_{tier_filter}_{date.today()}"
+    split = len(_tier_ids[tier_filter]) > EXPORT_PART_ROWS
+    rows, part, last = 0, 0, -1
+    while True:
+        buf = io.BytesIO()
+        buf.write(b"user_id,tier\n")
+        n = 0
+        while n < EXPORT_PART_ROWS:
+            ids = _tier_ids[tier_filter]
+            start = bisect.bisect_right(ids, last)
+            chunk = ids[start:start + min(1000, EXPORT_PART_ROWS - n)]
+            if not chunk:
+                break
+            buf.write("".join(f"{uid},{_tier_index.get(uid, tier_filter)}\n" for uid in chunk).encode("utf-8"))
+            n += len(chunk)
+            last = chunk[-1]
+        if not n and part:
+            break
+        part += 1
+        rows += n
+        caption = f"📋 Платні користувачі ({PAID_FILTERS[tier_filter]}): {n}"
+        if split:
+            caption += f" (частина {part}, рядки {rows - n + 1}–{rows})"
+        await update.message.reply_document(
+            document=buf.getvalue(),
+            filename=f"{name}_part{part}.csv" if split else f"{name}.csv",
+            caption=caption,
+            reply_markup=main_menu(),
+        )
+        if n < EXPORT_PART_ROWS:
+            break
+    if part > 1:
+        await update.message.reply_text(f"📋 Усього: {rows} у {part} файлах.", reply_markup=main_menu())
+
 
-    pro = sorted([uid for uid, t in users.items() if t == "pro"])
-    pro_plus = sorted([uid for uid, t in users.items() if t == "pro_plus"])
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔ Немає доступу.", reply_markup=main_menu())
+        return
+    for part in split_message(stats_text()):
+        await update.message.reply_text(part, reply_markup=main_menu())
+
+
+def stats_text() -> str:
+    # also sent to the front in worker mode (see worker_control)
+    g = openai_gate.stats()
+    c = response_cache.stats()
+    p = prefetcher.stats()
+    lines = [
+        "📊 Статистика\n",
+        "OpenAI:",
+        f"• В роботі: {g['in_flight']}/{g['limit']}",
+        f"• У черзі: {g['queue_depth']}",
+        f"• Запитів: {g['total']}",
+    ]
+    for tier, t in g["tiers"].items():
+        lines.append(
+            f"• {tier}: черга {t['queue_depth']} (новий запит — {t['position']}-й), видано {t['granted']}, "
+            f"очік. сер. {t['wait_avg_s']:.2f} с / макс. {t['wait_max_s']:.2f} с, таймаутів {t['timeouts']}"
+        )
+    r = rate_limiter.stats()
+    b = openai_breaker.stats()
+    lines += [
+        f"• RPM: {r['rpm_left']}/{r['rpm_limit']}, TPM: {r['tpm_left']}/{r['tpm_limit']}",
+        f"• Очікувань ліміту: {r['waits']} ({r['wait_total_s']:.1f} с)",
+        f"• Circuit: {b['state']} (відкривався {b['opened']} р., відхилено {b['rejected']})",
+        f"• Hedge: {hedge_stats.hedged}/{hedge_stats.requests} (виграв {hedge_stats.won})",
+    ]
+    for mode, lat in openai_latency.stats().items():
+        lines.append(f"• {mode}: p50 {lat['p50_s']:.1f} с, p95 {lat['p95_s']:.1f} с ({lat['n']} зап.)")
+    lines += ["", "Моделі:"]
+    for model, m in model_router.stats().items():
+        lines.append(f"• {model} (якість {m['quality']}): помилок {m['error_rate']:.0%}")
+        for mode, st in m["modes"].items():
+            ewma = f"{st['ewma_s']:.1f} с" if st["ewma_s"] is not None else "—"
+            lines.append(f"    {mode}: {ewma}, обрано {st['routed']}")
+    lines += [
+        "",
+        "Кеш відповідей:",
+        f"• Записів: {c['entries']}",
+        f"• Влучання: {c['hits']}/{c['hits'] + c['misses']} ({c['hit_ratio']:.0%})",
+        f"• Зекономлено: {c['saved_seconds']:.1f} с генерації",
+        "",
+        "Предзавантаження швидких відповідей:",
+        f"• Сьогодні: {p['today']}/{p['daily_cap']}",
+        f"• Влучання: {p['hits']}/{p['generated']} ({p['hit_rate']:.0%})",
+        f"• Токени: {p['tokens_used']} (марно: {p['tokens_wasted']}, {p['wasted']} відп.)",
+    ]
+    usage = prompt_usage.report()
+    if usage:
+        lines += ["", "Токени по режимах (prompt / кеш / відповідь):"]
+        for mode, u in usage.items():
+            lines.append(
+                f"• {mode}: {u['requests']} зап., {u['prompt_avg']:.0f} / {u['cached_ratio']:.0%} / {u['completion_avg']:.0f}"
+            )
+    budgets = token_budget.stats()
+    if budgets:
+        lines += ["", f"Ліміт токенів відповіді (стеля {MAX_TOKENS}):"]
+        for (mode, style), b in budgets.items():
+            lines.append(f"• {mode} {style}: {b['limit']} ({b['n']} відп., обрізано {b['truncated']})")
+    if user_state:
+        lines += ["", f"Стан користувачів: завантажено {len(user_state._loaded)}, записів {user_state.rows_written}"]
+    if tracer.enabled:
+        t = tracer.stats()
+        lines += ["", f"Трасування: {t['started']} апдейтів, експортовано {t['exported']}, повільних {t['slow']}"]
+    return "\n".join(lines)
 
-    lines = ["📋 Платні користувачі\n"]
-    lines.append(f"⭐ PRO ({len(pro)}):")
-    lines.extend([f"• {uid}" for uid in pro] if pro else ["—"])
-    lines.append("")
-    lines.append(f"💎 PRO+ ({len(pro_plus)}):")
-    lines.extend([f"• {uid}" for uid in pro_plus] if pro_plus else ["—"])
 
-    msg = "\n".join(lines)
-    if len(msg) > 3500:
-        msg = msg[:3500] + "\n…(обрізано)"
-    await update.message.reply_text(msg, reply_markup=main_menu())
+# =========================================================
+# 14) MEDIA (Telegram file_id cache)
+# =========================================================
+class MediaCache:
+    # Telegram keeps every uploaded file: after the first upload we send
+    # its file_id instead of the bytes. Entries are keyed by path and
+    # bound to the file's sha256, so a changed file is uploaded again.
+    def __init__(self, path: str):
+        self.path = path
+        self._entries: dict[str, dict] | None = None
+        self._hashes: dict[str, tuple[tuple[int, int], str]] = {}
+
+    def _load(self) -> dict[str, dict]:
+        if self._entries is None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+        return self._entries
+
+    def file_hash(self, media_path: str) -> str:
+        # re-hash only when size/mtime change
+        st = os.stat(media_path)
+        sig = (st.st_mtime_ns, st.st_size)
+        cached = self._hashes.get(media_path)
+        if cached and cached[0] == sig:
+            return cached[1]
+        h = hashlib.sha256()
+        with open(media_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 16), b""):
+                h.update(chunk)
+        self._hashes[media_path] = (sig, h.hexdigest())
+        return self._hashes[media_path][1]
+
+    def get(self, media_path: str) -> str | None:
+        entry = self._load().get(media_path)
+        if entry and entry.get("sha256") == self.file_hash(media_path):
+            return entry["file_id"]
+        return None
+
+    def put(self, media_path: str, file_id: str):
+        self._load()[media_path] = {"sha256": self.file_hash(media_path), "file_id": file_id}
+        try:
+            _write_json_atomic(self.path, self._entries)
+        except OSError as e:
+            print("MEDIA CACHE SAVE ERROR:", repr(e))
+
+    def invalidate(self, media_path: str):
+        self._load().pop(media_path, None)
+
+    async def send(self, update: Update, kind: str, media_path: str, **kwargs):
+        # kind: photo / document / video / animation / audio / voice
+        reply = getattr(update.message, f"reply_{kind}")
+        file_id = self.get(media_path)
+        if file_id:
+            try:
+                return await reply(**{kind: file_id}, **kwargs)
+            except BadRequest as e:
+                print("MEDIA FILE_ID REJECTED:", media_path, repr(e))
+                self.invalidate(media_path)
+
+        with open(media_path, "rb") as f:
+            msg = await reply(**{kind: f}, **kwargs)
+        sent = getattr(msg, kind)
+        if kind == "photo":
+            sent = sent[-1]  # largest size
+        self.put(media_path, sent.file_id)
+        return msg
+
+media_cache = MediaCache(MEDIA_CACHE_FILE)
 
 
 # =========================================================
-# 9) USER COMMANDS
+# 15) USER COMMANDS
 # =========================================================
 async def whoami_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id if update.effective_user else None
@@ -585,8 +3599,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     if os.path.exists(WELCOME_IMAGE_PATH):
-        with open(WELCOME_IMAGE_PATH, "rb") as photo:
-            await update.message.reply_photo(photo=photo, caption=caption, reply_markup=main_menu())
+        await media_cache.send(update, "photo", WELCOME_IMAGE_PATH, caption=caption, reply_markup=main_menu())
     else:
         await update.message.reply_text(caption, reply_markup=main_menu())
 
@@ -598,6 +3611,7 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• ⚡ Швидкі відповіді — теми одним кліком\n"
         "• 💬 Відповіді клієнтам — встав повідомлення\n"
         "• ✍️ Опис товару — встав товар + характеристики\n"
+        "• 📦 Масовий опис — CSV/XLSX з товарами → файл з описами\n"
         "• ⚙️ Налаштування — платформа/мова/стиль\n\n"
         "Команди:\n"
         "/whoami — показати твій Telegram ID\n"
@@ -646,240 +3660,527 @@ async def tariffs_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # =========================================================
-# 10) MAIN HANDLER
+# 16) MAIN HANDLER (router)
 # =========================================================
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    ensure_defaults(context)
-    reset_daily_if_needed(context)
+# Text is routed in two steps:
+#   1) BUTTON_ROUTES: exact button text -> handler (works in any mode)
+#   2) MODE_HANDLERS: context.user_data["mode"] -> handler for free text
+#
+# Modes:
+#   None ─┬─ ⚡ -> quick_replies    ─ topic -> AI answer (stays in mode)
+#         ├─ 💬 -> replies          ─ text  -> AI answer (stays in mode)
+#         ├─ ✍️ -> description      ─ text  -> AI answer (stays in mode)
+#         ├─ 📦 -> bulk_description ─ file  -> handle_document
+#         └─ ⚙️ -> settings ─┬─ 🛒 -> platform_pick ─ choice -> settings
+#                            ├─ 🎛 -> style_pick    ─ choice -> settings
+#                            ├─ 🌐 -> lang_pick     ─ choice -> settings
+#                            └─ 💎 -> segment_input ─ text   -> settings
+#   ⬅️ from anywhere -> None
+PLATFORMS = ("OLX", "Prom", "Instagram", "Rozetka", "Site", "Telegram")
+STYLE_TEMPLATES = ("⚡ Коротко", "🔥 Продаюче", "🏢 Офіційно", "💎 Преміум")
+LANGUAGES = {"🇺🇦 Українська": "uk", "🇬🇧 English": "en"}
+
+
+def enter_mode(mode: str | None, prompt: str, keyboard: ReplyKeyboardMarkup):
+    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, profile: dict):
+        context.user_data["mode"] = mode
+        await update.message.reply_text(prompt, reply_markup=keyboard)
+    return handler
+
+
+def run_command(command):
+    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, profile: dict):
+        await command(update, context)
+    return handler
+
+
+def payment(plan: str):
+    async def handler(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, profile: dict):
+        await send_payment_instructions(update, context, plan=plan)
+    return handler
+
+
+async def reserve_or_upsell(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
+    tier = get_user_tier(update)
+    allowed, reason = await reserve_ai_call(update, context)
+    if not allowed:
+        if reason == "LIMIT_REACHED":
+            M_LIMIT_EVENTS.inc(tier=tier, event="limit_reached")
+            await send_pro_upsell(update, context, reason="limit")
+        else:
+            M_LIMIT_EVENTS.inc(tier=tier, event="cooldown")
+            await update.message.reply_text(reason, reply_markup=MAIN_MENU)
+        return False
 
-    text = (update.message.text or "").strip()
-    profile = context.user_data["profile"]
+    # soft upsell: after 3rd call, once/day, only FREE
+    if tier == "free":
+        if context.user_data["limits"]["count"] >= 3 and not context.user_data["upsell"]["shown_soft"]:
+            context.user_data["upsell"]["shown_soft"] = True
+            M_LIMIT_EVENTS.inc(tier=tier, event="soft_upsell")
+            await send_pro_upsell(update, context, reason="soft")
+    return True
 
-    # Payment buttons
-    if text == "⭐ PRO 99 грн":
-        await send_payment_instructions(update, context, plan="pro")
-        return
-    if text == "💎 PRO+ 199 грн":
-        await send_payment_instructions(update, context, plan="pro_plus")
-        return
-    if text == "🆔 Мій ID":
-        await whoami_cmd(update, context)
+
+async def on_demo(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, profile: dict):
+    if not await claim_demo(update, context):
+        await update.message.reply_text("✅ DEMO вже було сьогодні.", reply_markup=MAIN_MENU)
         return
 
-    # Main menu
-    if text == "🎯 DEMO":
-        if demo_used_today(context) and get_user_tier(update) == "free":
-            await update.message.reply_text("✅ DEMO вже було сьогодні.", reply_markup=main_menu())
-            return
+    demo_text = "Customer says: 'Too expensive'."
+    system_prompt = build_system_prompt(profile, "demo")
+    user_prompt = build_user_prompt("demo", demo_text, profile)
 
-        mark_demo_used(context)
-        demo_text = "Customer says: 'Too expensive'."
-        system_prompt = build_system_prompt(profile, "demo")
-        user_prompt = build_user_prompt("demo", demo_text, profile)
+    delivered = await send_ai_answer(
+        update, "🎯 DEMO: генерую відповіді...", system_prompt, user_prompt, MAIN_MENU,
+        cacheable=True, mode="demo", style=profile_style(profile),
+    )
+    if not delivered:
+        await unclaim_demo(update, context)
 
-        await update.message.reply_text("🎯 DEMO: генерую відповіді...", reply_markup=main_menu())
-        try:
-            answer = await call_openai(system_prompt, user_prompt)
-            await update.message.reply_text(answer, reply_markup=main_menu())
-        except Exception as e:
-            print("OPENAI ERROR:", repr(e))
-            await update.message.reply_text("⚠️ Помилка AI. Деталі в логах Render.", reply_markup=main_menu())
-        return
 
-    if text == "⚡ Швидкі відповіді":
-        context.user_data["mode"] = "quick_replies"
-        await update.message.reply_text("Обери тему:", reply_markup=quick_replies_menu())
-        return
+async def on_quick_replies_menu(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, profile: dict):
+    context.user_data["mode"] = "quick_replies"
+    prefetcher.schedule(update, context)
+    await update.message.reply_text("Обери тему:", reply_markup=QUICK_REPLIES_MENU)
+
+
+async def on_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, profile: dict):
+    tier = get_user_tier(update)
+    await update.message.reply_text(
+        "🧠 Профіль\n"
+        f"• Платформа: {profile.get('platform')}\n"
+        f"• Шаблон стилю: {profile.get('style_template')}\n"
+        f"• Сегмент: {profile.get('segment')}\n"
+        f"• Мова: {'Українська' if profile.get('language') == 'uk' else 'English'}\n"
+        f"• Тариф: {tier_label(tier)}\n"
+        f"• Використано сьогодні: {context.user_data['limits']['count']}\n",
+        reply_markup=MAIN_MENU,
+    )
 
-    if text == "💬 Відповіді клієнтам":
-        context.user_data["mode"] = "replies"
-        await update.message.reply_text("Встав повідомлення клієнта.", reply_markup=main_menu())
-        return
 
-    if text == "✍️ Опис товару":
-        context.user_data["mode"] = "description"
-        await update.message.reply_text("Надішли назву + характеристики товару.", reply_markup=main_menu())
+async def on_platform_pick(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, profile: dict):
+    if text in PLATFORMS:
+        profile["platform"] = text
+        context.user_data["mode"] = "settings"
+        await update.message.reply_text("✅ Платформу збережено.", reply_markup=SETTINGS_MENU)
         return
+    await update.message.reply_text("Обери платформу з кнопок.", reply_markup=PLATFORM_MENU)
+
 
-    if text == "📌 Приклади":
-        await examples_cmd(update, context)
+async def on_style_pick(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, profile: dict):
+    if text in STYLE_TEMPLATES:
+        profile["style_template"] = text
+        context.user_data["mode"] = "settings"
+        await update.message.reply_text("✅ Шаблон стилю збережено.", reply_markup=SETTINGS_MENU)
         return
+    await update.message.reply_text("Обери стиль з кнопок.", reply_markup=STYLE_TEMPLATE_MENU)
+
+
+async def on_lang_pick(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, profile: dict):
+    if text in LANGUAGES:
+        profile["language"] = LANGUAGES[text]
+    context.user_data["mode"] = "settings"
+    await update.message.reply_text("✅ Мову збережено.", reply_markup=SETTINGS_MENU)
+
 
-    if text == "⭐ Тарифи":
-        await tariffs_cmd(update, context)
+async def on_segment_input(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, profile: dict):
+    profile["segment"] = text[:60]
+    context.user_data["mode"] = "settings"
+    await update.message.reply_text("✅ Сегмент збережено.", reply_markup=SETTINGS_MENU)
+
+
+async def on_quick_topic(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, profile: dict):
+    template = quick_template_to_text(text)
+    if not template:
+        await update.message.reply_text("Обери тему з кнопок.", reply_markup=QUICK_REPLIES_MENU)
         return
+    prefetcher.record_pick(profile, text)
 
-    if text == "ℹ️ Допомога":
-        await help_cmd(update, context)
+    if not await reserve_or_upsell(update, context):
         return
 
-    if text == "🧠 Профіль":
-        tier = get_user_tier(update)
+    system_prompt = build_system_prompt(profile, "quick_replies")
+    user_prompt = build_user_prompt("quick_replies", template, profile)
+
+    delivered = await send_ai_answer(
+        update,
+        "⏳ Генерую відповіді...",
+        system_prompt,
+        user_prompt,
+        QUICK_REPLIES_MENU,
+        cacheable=True,
+        mode="quick_replies",
+        style=profile_style(profile),
+    )
+    if not delivered:
+        await release_ai_call(update, context)
+
+
+async def on_ai_text(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, profile: dict):
+    mode = context.user_data["mode"]
+    if count_tokens(text) > MAX_INPUT_TOKENS:
         await update.message.reply_text(
-            "🧠 Профіль\n"
-            f"• Платформа: {profile.get('platform')}\n"
-            f"• Шаблон стилю: {profile.get('style_template')}\n"
-            f"• Сегмент: {profile.get('segment')}\n"
-            f"• Мова: {'Українська' if profile.get('language') == 'uk' else 'English'}\n"
-            f"• Тариф: {tier_label(tier)}\n"
-            f"• Використано сьогодні: {context.user_data['limits']['count']}\n",
-            reply_markup=main_menu(),
+            f"✂️ Текст задовгий (>{MAX_INPUT_TOKENS} токенів, ~{MAX_INPUT_TOKENS * 3} символів). Стисни та надішли ще раз.",
+            reply_markup=MAIN_MENU,
         )
         return
 
-    # Settings
-    if text == "⚙️ Налаштування":
-        context.user_data["mode"] = "settings"
-        await update.message.reply_text("Налаштування:", reply_markup=settings_menu())
+    if not await reserve_or_upsell(update, context):
         return
 
-    if text == "⬅️ Назад":
-        context.user_data["mode"] = None
-        await update.message.reply_text("Повернувся в меню.", reply_markup=main_menu())
-        return
+    system_prompt = build_system_prompt(profile, mode)
+    user_prompt = build_user_prompt(mode, text, profile)
 
-    if text == "🛒 Платформа":
-        context.user_data["mode"] = "platform_pick"
-        await update.message.reply_text("Обери платформу:", reply_markup=platform_menu())
-        return
+    if not await send_ai_answer(
+        update, "⏳ Готую відповідь...", system_prompt, user_prompt, MAIN_MENU, mode=mode, style=profile_style(profile)
+    ):
+        await release_ai_call(update, context)
+
+
+async def on_unknown(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, profile: dict):
+    await update.message.reply_text("Обери дію з меню.", reply_markup=MAIN_MENU)
+
+
+BUTTON_ROUTES = {
+    # payment
+    "⭐ PRO 99 грн": payment("pro"),
+    "💎 PRO+ 199 грн": payment("pro_plus"),
+    "🆔 Мій ID": run_command(whoami_cmd),
+    # main menu
+    "🎯 DEMO": on_demo,
+    "⚡ Швидкі відповіді": on_quick_replies_menu,
+    "💬 Відповіді клієнтам": enter_mode("replies", "Встав повідомлення клієнта.", MAIN_MENU),
+    "✍️ Опис товару": enter_mode("description", "Надішли назву + характеристики товару.", MAIN_MENU),
+    "📦 Масовий опис": enter_mode(
+        "bulk_description",
+        "📦 Надішли файл CSV або XLSX.\n"
+        "Перший рядок — назви колонок, далі один товар на рядок.\n"
+        f"До {BULK_MAX_ROWS} рядків, кожен рядок = 1 запит з ліміту.\n\n"
+        "Якщо обробку перервано — надішли той самий файл ще раз, я продовжу з місця зупинки.",
+        MAIN_MENU,
+    ),
+    "📌 Приклади": run_command(examples_cmd),
+    "⭐ Тарифи": run_command(tariffs_cmd),
+    "ℹ️ Допомога": run_command(help_cmd),
+    "🧠 Профіль": on_profile,
+    # settings
+    "⚙️ Налаштування": enter_mode("settings", "Налаштування:", SETTINGS_MENU),
+    "⬅️ Назад": enter_mode(None, "Повернувся в меню.", MAIN_MENU),
+    "🛒 Платформа": enter_mode("platform_pick", "Обери платформу:", PLATFORM_MENU),
+    "🎛 Шаблон стилю": enter_mode("style_pick", "Обери шаблон стилю:", STYLE_TEMPLATE_MENU),
+    "🌐 Мова": enter_mode("lang_pick", "Обери мову:", LANGUAGE_MENU),
+    "💎 Сегмент": enter_mode("segment_input", "Введи сегмент (бюджет/середній/преміум):", SETTINGS_MENU),
+}
+
+MODE_HANDLERS = {
+    "platform_pick": on_platform_pick,
+    "style_pick": on_style_pick,
+    "lang_pick": on_lang_pick,
+    "segment_input": on_segment_input,
+    "quick_replies": on_quick_topic,
+    "description": on_ai_text,
+    "replies": on_ai_text,
+}
 
-    if text == "🎛 Шаблон стилю":
-        context.user_data["mode"] = "style_pick"
-        await update.message.reply_text("Обери шаблон стилю:", reply_markup=style_template_menu())
-        return
 
-    if text == "🌐 Мова":
-        context.user_data["mode"] = "lang_pick"
-        await update.message.reply_text("Обери мову:", reply_markup=language_menu())
-        return
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    ensure_defaults(context)
+    reset_daily_if_needed(context)
 
-    if text == "💎 Сегмент":
-        context.user_data["mode"] = "segment_input"
-        await update.message.reply_text("Введи сегмент (бюджет/середній/преміум):", reply_markup=settings_menu())
-        return
+    text = (update.message.text or "").strip()
+    profile = context.user_data["profile"]
 
-    if context.user_data.get("mode") == "platform_pick":
-        if text in ("OLX", "Prom", "Instagram", "Rozetka", "Site", "Telegram"):
-            profile["platform"] = text
-            context.user_data["mode"] = "settings"
-            await update.message.reply_text("✅ Платформу збережено.", reply_markup=settings_menu())
-            return
-        await update.message.reply_text("Обери платформу з кнопок.", reply_markup=platform_menu())
-        return
+    handler = BUTTON_ROUTES.get(text) or MODE_HANDLERS.get(context.user_data.get("mode"), on_unknown)
+    with span("handler", route=getattr(handler, "__name__", "route")):
+        await handler(update, context, text, profile)
 
-    if context.user_data.get("mode") == "style_pick":
-        if text in ("⚡ Коротко", "🔥 Продаюче", "🏢 Офіційно", "💎 Преміум"):
-            profile["style_template"] = text
-            context.user_data["mode"] = "settings"
-            await update.message.reply_text("✅ Шаблон стилю збережено.", reply_markup=settings_menu())
+
+# =========================================================
+# 17) CONCURRENT UPDATES (per-user ordering)
+# =========================================================
+def update_user_key(update: object) -> int | None:
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Different users run concurrently (up to max_concurrent_updates),
+    # updates of the same user run strictly one after another.
+    # PTB's own semaphore only bounds pending updates; the real cap is taken
+    # after the per-user lock, so a user with a long queue doesn't hold slots.
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int = MAX_PENDING_UPDATES):
+        super().__init__(max(max_pending_updates, max_concurrent_updates, 2))
+        self.max_running = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._user_locks: dict[int, asyncio.Lock] = {}
+        self._user_waiters: dict[int, int] = {}
+        self.running = 0
+        self.processed = 0
+
+    async def do_process_update(self, update, coroutine):
+        key = update_user_key(update)
+        trace = tracer.begin(getattr(update, "update_id", None), key)
+        token = _current_trace.set(trace)
+        try:
+            await self._process(key, coroutine)
+        finally:
+            _current_trace.reset(token)
+            if trace:
+                tracer.finish(trace)
+
+    async def _process(self, key, coroutine):
+        if key is None:
+            with span("wait.slot"):
+                await self._slots.acquire()
+            try:
+                await self._run(coroutine)
+            finally:
+                self._slots.release()
             return
-        await update.message.reply_text("Обери стиль з кнопок.", reply_markup=style_template_menu())
-        return
 
-    if context.user_data.get("mode") == "lang_pick":
-        if text == "🇺🇦 Українська":
-            profile["language"] = "uk"
-        elif text == "🇬🇧 English":
-            profile["language"] = "en"
-        context.user_data["mode"] = "settings"
-        await update.message.reply_text("✅ Мову збережено.", reply_markup=settings_menu())
-        return
+        lock = self._user_locks.get(key)
+        if lock is None:
+            lock = self._user_locks[key] = asyncio.Lock()
+        self._user_waiters[key] = self._user_waiters.get(key, 0) + 1
+        try:
+            with span("wait.user"):
+                await lock.acquire()
+            try:
+                with span("wait.slot"):
+                    await self._slots.acquire()
+                try:
+                    await self._run(coroutine)
+                finally:
+                    self._slots.release()
+            finally:
+                lock.release()
+        finally:
+            self._user_waiters[key] -= 1
+            if not self._user_waiters[key]:
+                del self._user_waiters[key]
+                del self._user_locks[key]
+
+    async def _run(self, coroutine):
+        self.running += 1
+        t0 = time.monotonic()
+        try:
+            await coroutine
+        finally:
+            M_UPDATE_SECONDS.observe(time.monotonic() - t0)
+            self.running -= 1
+            self.processed += 1
 
-    if context.user_data.get("mode") == "segment_input":
-        profile["segment"] = text[:60]
-        context.user_data["mode"] = "settings"
-        await update.message.reply_text("✅ Сегмент збережено.", reply_markup=settings_menu())
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# =========================================================
+# 18) WEBHOOK STARTUP (Render)
+# =========================================================
+async def load_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # group -1: runs before every other handler
+    if update.effective_user and context.user_data is not None:
+        with span("state"):
+            await user_state.hydrate(update.effective_user.id, context.user_data)
+
+
+async def ensure_webhook(bot):
+    # setWebhook only when Telegram has another URL: a restart then costs
+    # one getWebhookInfo and keeps the pending updates as they are
+    webhook_url = f"{RENDER_EXTERNAL_URL}/{TELEGRAM_TOKEN}"
+    info = await bot.get_webhook_info()
+    if info.url == webhook_url:
+        print("Webhook already set")
         return
+    await bot.set_webhook(url=webhook_url)
+    print("Webhook set")
 
-    # Quick replies
-    if context.user_data.get("mode") == "quick_replies":
-        template = quick_template_to_text(text)
-        if not template:
-            await update.message.reply_text("Обери тему з кнопок.", reply_markup=quick_replies_menu())
-            return
 
-        allowed, reason = can_call_ai(update, context)
-        if not allowed:
-            if reason == "LIMIT_REACHED":
-                await send_pro_upsell(update, context, reason="limit")
-            else:
-                await update.message.reply_text(reason, reply_markup=main_menu())
-            return
+async def warm_up_openai():
+    # import openai off the event loop and open pooled HTTPS connections,
+    # so the first AI request doesn't pay for the import and TLS handshakes
+    t0 = time.perf_counter()
+    await asyncio.to_thread(client.get)
+    t1 = time.perf_counter()
 
-        register_ai_call(context)
+    async def probe():
+        with contextlib.suppress(Exception):
+            await client.with_options(timeout=10).models.list()
 
-        # soft upsell: after 3rd call, once/day, only FREE
-        if get_user_tier(update) == "free":
-            if context.user_data["limits"]["count"] >= 3 and not context.user_data["upsell"]["shown_soft"]:
-                context.user_data["upsell"]["shown_soft"] = True
-                await send_pro_upsell(update, context, reason="soft")
+    await asyncio.gather(*(probe() for _ in range(OPENAI_WARM_CONNECTIONS)))
+    t2 = time.perf_counter()
+    print(f"WARM-UP: openai import {(t1 - t0) * 1000:.0f} ms, "
+          f"{OPENAI_WARM_CONNECTIONS} connection(s) {(t2 - t1) * 1000:.0f} ms")
 
-        system_prompt = build_system_prompt(profile, "quick_replies")
-        user_prompt = build_user_prompt("quick_replies", template, profile)
 
-        await update.message.reply_text("⏳ Генерую відповіді...", reply_markup=quick_replies_menu())
+async def post_init(app):
+    await ensure_webhook(app.bot)
+    start_background_tasks(app)
+
+
+def start_background_tasks(app):
+    app.bot_data["tokenizer_loader"] = asyncio.create_task(load_tokenizer())
+    if OPENAI_WARM_CONNECTIONS > 0:
+        app.bot_data["warm_up"] = asyncio.create_task(warm_up_openai())
+    if user_state:
+        app.bot_data["user_state_flusher"] = asyncio.create_task(user_state.run_flusher())
+    if tracer.exporter:
+        app.bot_data["trace_flusher"] = asyncio.create_task(tracer.run_flusher())
+
+
+async def post_shutdown(app):
+    for name in ("warm_up", "tokenizer_loader"):
+        if name in app.bot_data:
+            app.bot_data[name].cancel()
+    global user_state
+    if user_state:
+        app.bot_data["user_state_flusher"].cancel()
+        await user_state.flush()
+        user_state.store.close()
+        user_state = None
+    if tracer.exporter:
+        app.bot_data["trace_flusher"].cancel()
+        await tracer.exporter.flush()
+    if quota_backend:
+        await quota_backend.close()
+    await client.close()
+    response_cache.save()
+    subscription_store.close()
+
+
+class TelegramWebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, app):
+        self.app = app
+
+    async def post(self):
+        if self.request.headers.get("Content-Type", "").split(";")[0].strip() != "application/json":
+            raise tornado.web.HTTPError(403)
         try:
-            answer = await call_openai(system_prompt, user_prompt)
-            await update.message.reply_text(answer, reply_markup=quick_replies_menu())
+            update = Update.de_json(json.loads(self.request.body), self.app.bot)
         except Exception as e:
-            print("OPENAI ERROR:", repr(e))
-            await update.message.reply_text("⚠️ Помилка AI. Деталі в логах Render.", reply_markup=main_menu())
-        return
+            M_ERRORS.inc(where="webhook", type=type(e).__name__)
+            raise tornado.web.HTTPError(400) from e
+        if update:
+            await self.app.update_queue.put(update)
+        self.set_status(200)
 
-    # AI modes
-    mode = context.user_data.get("mode")
-    if mode not in ("description", "replies"):
-        await update.message.reply_text("Обери дію з меню.", reply_markup=main_menu())
-        return
+    def log_exception(self, typ, value, tb):
+        if not isinstance(value, tornado.web.HTTPError):
+            print("WEBHOOK ERROR:", repr(value))
 
-    if len(text) > MAX_INPUT_CHARS:
-        await update.message.reply_text(
-            f"✂️ Текст задовгий (>{MAX_INPUT_CHARS} символів). Стисни та надішли ще раз.",
-            reply_markup=main_menu(),
-        )
-        return
 
-    allowed, reason = can_call_ai(update, context)
-    if not allowed:
-        if reason == "LIMIT_REACHED":
-            await send_pro_upsell(update, context, reason="limit")
-        else:
-            await update.message.reply_text(reason, reply_markup=main_menu())
-        return
+def check_metrics_access(handler: tornado.web.RequestHandler):
+    if METRICS_TOKEN:
+        if handler.request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+            raise tornado.web.HTTPError(401)
+    elif handler.request.remote_ip not in ("127.0.0.1", "::1"):
+        raise tornado.web.HTTPError(403)
 
-    register_ai_call(context)
 
-    # soft upsell: after 3rd call, once/day, only FREE
-    if get_user_tier(update) == "free":
-        if context.user_data["limits"]["count"] >= 3 and not context.user_data["upsell"]["shown_soft"]:
-            context.user_data["upsell"]["shown_soft"] = True
-            await send_pro_upsell(update, context, reason="soft")
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        check_metrics_access(self)
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(metrics.render())
 
-    system_prompt = build_system_prompt(profile, mode)
-    user_prompt = build_user_prompt(mode, text, profile)
 
-    await update.message.reply_text("⏳ Готую відповідь...", reply_markup=main_menu())
-    try:
-        answer = await call_openai(system_prompt, user_prompt)
-        await update.message.reply_text(answer, reply_markup=main_menu())
-    except Exception as e:
-        print("OPENAI ERROR:", repr(e))
-        await update.message.reply_text("⚠️ Помилка AI. Деталі в логах Render.", reply_markup=main_menu())
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    M_ERRORS.inc(where="handler", type=type(context.error).__name__)
+    print("HANDLER ERROR:", repr(context.error))
 
 
-# =========================================================
-# 11) WEBHOOK STARTUP (Render)
-# =========================================================
-async def post_init(app):
-    # Виставляємо webhook при старті
-    webhook_url = f"{RENDER_EXTERNAL_URL}/{TELEGRAM_TOKEN}"
-    await app.bot.set_webhook(url=webhook_url)
+def stop_on_signals() -> asyncio.Event:
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with contextlib.suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    return stop
 
 
-def main():
-    _ensure_subscriptions_file()
+async def serve_webhook(app):
+    # Same as app.run_webhook(), but our own tornado app so /metrics
+    # lives on the same port as the Telegram webhook.
+    web_app = tornado.web.Application(
+        [
+            (rf"/{TELEGRAM_TOKEN}/?", TelegramWebhookHandler, {"app": app}),
+            (r"/metrics", MetricsHandler),
+        ],
+        log_function=lambda handler: None,
+    )
+    stop = stop_on_signals()
+
+    await app.initialize()
+    startup.mark("initialize")
+    try:
+        await post_init(app)
+        startup.mark("webhook")
+        await app.start()
+        server = tornado.httpserver.HTTPServer(web_app)
+        server.listen(PORT, address="0.0.0.0")
+        startup.mark("listen")
+        print(f"Webhook server on :{PORT}")
+        startup.report()
+        await stop.wait()
+
+        server.stop()
+        await server.close_all_connections()
+        await app.stop()
+    finally:
+        await app.shutdown()
+        await post_shutdown(app)
+
+
+# registered once; build_application() binds the processor of the latest app
+_update_processor: PerUserUpdateProcessor | None = None
+metrics.add(Gauge("bot_updates_in_flight", "Updates being handled", lambda: _update_processor.running if _update_processor else 0))
+metrics.add(Gauge("bot_openai_in_flight", "OpenAI requests in flight", lambda: openai_gate.in_flight))
+metrics.add(Gauge("bot_openai_queue_depth", "OpenAI requests waiting for a slot", lambda: openai_gate.waiting))
+metrics.add(Gauge("bot_openai_circuit_open", "1 while the OpenAI circuit breaker is open", lambda: openai_breaker.state != "closed"))
+metrics.add(Gauge(
+    "bot_model_latency_ewma_seconds", "EWMA OpenAI latency per mode and model",
+    lambda: dict(model_router.latency), ("mode", "model"),
+))
+metrics.add(Gauge(
+    "bot_token_budget", "Current max_tokens per mode and style",
+    lambda: {key: token_budget.limit(*key) for key in token_budget.stats()}, ("mode", "style"),
+))
+metrics.add(Gauge(
+    "bot_model_error_rate", "EWMA share of failed OpenAI requests per model",
+    lambda: {(m,): model_router.current_error_rate(m) for m in model_router.models}, ("model",),
+))
+
+
+def build_application():
+    # the Application with all handlers, without starting anything
+    # (bench/ drives it directly against local fakes)
+    global user_state, _update_processor
+    update_processor = PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES)
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(update_processor)
+        .request(TracedRequest(connection_pool_size=256))
+        .updater(None)
+    )
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    app = builder.build()
+    _update_processor = update_processor
 
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(post_init).build()
+    if USER_STATE_ENABLED and user_state is None:
+        user_state = UserStatePersistence(UserStateStore(USER_STATE_DB))
+    if user_state:
+        app.add_handler(TypeHandler(Update, load_user_state), group=-1)
 
     # user commands
     app.add_handler(CommandHandler("start", start))
@@ -893,18 +4194,416 @@ def main():
     app.add_handler(CommandHandler("activate", activate_cmd))
     app.add_handler(CommandHandler("deactivate", deactivate_cmd))
     app.add_handler(CommandHandler("list_paid", list_paid_cmd))
+    app.add_handler(CallbackQueryHandler(list_paid_page, pattern=r"^paid:"))
+    app.add_handler(CommandHandler("export_paid", export_paid_cmd))
+    app.add_handler(CommandHandler("stats", stats_cmd))
 
     # text handler
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
+    app.add_error_handler(on_error)
+    return app
+
+
+def check_worker_config():
+    # the JSON store's lock only works inside one process: two workers
+    # would overwrite each other's /activate or /deactivate
+    if WORKERS > 1 and SUBSCRIPTIONS_BACKEND == "json":
+        raise ValueError(
+            "WORKERS>1 потребує SUBSCRIPTIONS_BACKEND=sqlite або redis "
+            "(перенеси підписки: python bot.py migrate-subscriptions)"
+        )
 
-    # Запуск webhook-сервера (Render)
-    app.run_webhook(
-        listen="0.0.0.0",
-        port=PORT,
-        url_path=TELEGRAM_TOKEN,
-        webhook_url=f"{RENDER_EXTERNAL_URL}/{TELEGRAM_TOKEN}",
-    )
+
+def main():
+    if WORKERS > 0:
+        check_worker_config()
+        # front process: webhook + routing only, handlers run in the workers
+        asyncio.run(serve_front(WORKERS))
+        return
+
+    subscription_store.ensure()
+    load_tier_index()
+    response_cache.load()
+    startup.mark("state")
+    app = build_application()
+    startup.mark("app")
+
+    # Запуск webhook-сервера (Render): /<token> для Telegram, /metrics для Prometheus
+    asyncio.run(serve_webhook(app))
+
+
+# =========================================================
+# 19) WORKER MODE (front process + workers sharded by user_id)
+# =========================================================
+# The front only parses the update JSON far enough to find the user and
+# forwards the raw bytes to worker user_id % N over its stdin:
+#   b"<seq> <length>\n" + body
+# The worker handles it like the single-process bot and writes b"<seq>\n"
+# back once the update is fully processed. Updates without an ack are kept
+# and replayed, in order, into a restarted worker (at-least-once: an update
+# that was half done when the worker died is handled again).
+# A user always lands on the same worker, so per-user order holds and the
+# local (user_data) limits stay consistent without a shared backend.
+# seq 0 is a control request ("metrics" or "stats"); the worker answers
+# b"ctl <length>\n" + payload, in order, so the front can serve /metrics and
+# /stats for all shards.
+M_WORKER_RESTARTS = metrics.add(Counter("bot_worker_restarts_total", "Worker process restarts", ("worker",)))
+
+
+def update_routing_key(data: dict) -> int:
+    # user id (or chat id) of a raw update; update_id as a last resort
+    for value in data.values():
+        if isinstance(value, dict):
+            for field in ("from", "user", "chat"):
+                who = value.get(field)
+                if isinstance(who, dict) and isinstance(who.get("id"), int):
+                    return who["id"]
+            message = value.get("message")  # callback_query.message
+            if isinstance(message, dict) and isinstance((message.get("chat") or {}).get("id"), int):
+                return message["chat"]["id"]
+    return int(data.get("update_id", 0))
+
+
+class WorkerProcess:
+    def __init__(self, index: int):
+        self.index = index
+        self.proc: asyncio.subprocess.Process | None = None
+        self.backlog: OrderedDict[int, bytes] = OrderedDict()  # seq -> body, until acked
+        self.restarts = 0
+        self._control: deque[asyncio.Future] = deque()  # control requests, answered in order
+        self._supervisor: asyncio.Task | None = None
+        self._stopping = False
+
+    async def start(self):
+        env = {**os.environ, "WORKERS": "0", "WORKER_INDEX": str(self.index)}
+        self.proc = await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), "worker",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, env=env,
+        )
+        # replay what the previous process didn't finish
+        for seq, body in self.backlog.items():
+            self._write(seq, body)
+        print(f"Worker {self.index} started (pid {self.proc.pid}, replayed {len(self.backlog)})")
+
+    def _write(self, seq: int, body: bytes):
+        if self.proc and self.proc.returncode is None and not self.proc.stdin.is_closing():
+            self.proc.stdin.write(b"%d %d\n" % (seq, len(body)) + body)
+
+    def send(self, seq: int, body: bytes):
+        self.backlog[seq] = body
+        self._write(seq, body)
+
+    async def control(self, command: str, timeout: float = 5.0) -> str:
+        # seq 0 on the same channel: "metrics" or "stats", see worker_control
+        if not self.proc or self.proc.returncode is not None:
+            raise RuntimeError(f"worker {self.index} is not running")
+        fut = asyncio.get_running_loop().create_future()
+        self._control.append(fut)
+        self._write(0, command.encode())
+        return await asyncio.wait_for(fut, timeout)
+
+    async def _read_acks(self):
+        try:
+            while True:
+                line = await self.proc.stdout.readline()
+                if not line:
+                    return
+                if line.startswith(b"ctl "):
+                    payload = await self.proc.stdout.readexactly(int(line[4:]))
+                    # a timed-out request still holds its place in the queue
+                    fut = self._control.popleft() if self._control else None
+                    if fut and not fut.done():
+                        fut.set_result(payload.decode("utf-8"))
+                    continue
+                with contextlib.suppress(ValueError):
+                    self.backlog.pop(int(line), None)
+        finally:
+            while self._control:
+                fut = self._control.popleft()
+                if not fut.done():
+                    fut.set_exception(RuntimeError(f"worker {self.index} exited"))
+
+    async def supervise(self):
+        delay = 1.0
+        while True:
+            await self.start()
+            started = time.monotonic()
+            await self._read_acks()
+            code = await self.proc.wait()
+            if self._stopping:
+                return
+            self.restarts += 1
+            M_WORKER_RESTARTS.inc(worker=self.index)
+            if time.monotonic() - started > 60:
+                delay = 1.0
+            print(f"Worker {self.index} exited with {code}, {len(self.backlog)} updates pending; restart in {delay:.0f} s")
+            await asyncio.sleep(delay)
+            if self._stopping:
+                return
+            delay = min(delay * 2, WORKER_RESTART_MAX_SECONDS)
+
+    def run(self):
+        self._supervisor = asyncio.create_task(self.supervise())
+
+    async def stop(self, timeout: float = 30.0):
+        # EOF on stdin: the worker finishes what it has and exits
+        self._stopping = True
+        if not self.proc or self.proc.returncode is not None:
+            if self._supervisor:
+                self._supervisor.cancel()
+            return
+        self.proc.stdin.close()
+        try:
+            await asyncio.wait_for(self._supervisor, timeout)
+        except asyncio.TimeoutError:
+            self.proc.kill()
+            await self.proc.wait()
+
+
+def _with_label(sample: str, name: str, value) -> str:
+    # 'm{a="b"} 1' -> 'm{worker="0",a="b"} 1', 'm 1' -> 'm{worker="0"} 1'
+    label = f'{name}="{value}"'
+    brace, space = sample.find("{"), sample.find(" ")
+    if brace != -1 and brace < space:
+        return f"{sample[:brace + 1]}{label},{sample[brace + 1:]}".replace(",}", "}")
+    return f"{sample[:space]}{{{label}}}{sample[space:]}"
+
+
+def merge_metrics(front: str, workers: list[tuple[int, str]]) -> str:
+    # one exposition from the front's registry and every worker's:
+    # HELP/TYPE once per family, worker samples get a worker="<i>" label
+    families: dict[str, dict[str, list[str]]] = {}
+
+    def add(text: str, worker: int | None):
+        family = None
+        for line in text.splitlines():
+            if not line:
+                continue
+            if line.startswith("# "):
+                family = line.split(" ", 3)[2]
+                head = families.setdefault(family, {"head": [], "samples": []})["head"]
+                if line not in head:
+                    head.append(line)
+                continue
+            if worker is not None:
+                line = _with_label(line, "worker", worker)
+            families.setdefault(family, {"head": [], "samples": []})["samples"].append(line)
+
+    add(front, None)
+    for index, text in workers:
+        add(text, index)
+    lines = []
+    for fam in families.values():
+        lines.extend(fam["head"])
+        lines.extend(fam["samples"])
+    return "\n".join(lines) + "\n"
+
+
+class FrontMetricsHandler(tornado.web.RequestHandler):
+    # the front's own metrics + every worker's, collected over stdin/stdout
+    def initialize(self, workers: list[WorkerProcess]):
+        self.workers = workers
+
+    async def get(self):
+        check_metrics_access(self)
+        results = await asyncio.gather(*(w.control("metrics") for w in self.workers), return_exceptions=True)
+        texts = []
+        for w, res in zip(self.workers, results):
+            if isinstance(res, BaseException):
+                M_ERRORS.inc(where="metrics", type=type(res).__name__)
+            else:
+                texts.append((w.index, res))
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.write(merge_metrics(metrics.render(), texts))
+
+
+async def send_front_stats(bot, chat_id: int, workers: list[WorkerProcess]):
+    # /stats in worker mode: every shard, not just the admin's worker
+    parts = [f"📊 Статистика: {len(workers)} воркерів"]
+    for w in workers:
+        try:
+            text = await w.control("stats")
+        except Exception as e:
+            text = f"недоступний: {e!r}"
+        parts.append(f"🧩 Воркер {w.index} (в черзі {len(w.backlog)}, перезапусків {w.restarts}):\n{text}")
+    for part in split_message("\n\n".join(parts)):
+        await bot.send_message(chat_id, part)
 
 
+def admin_stats_chat(data: dict) -> int | None:
+    # chat id if the raw update is "/stats" from an admin
+    message = data.get("message") or {}
+    text = (message.get("text") or "").strip()
+    if text.split("@")[0] != "/stats":
+        return None
+    if (message.get("from") or {}).get("id") not in ADMIN_IDS:
+        return None
+    return (message.get("chat") or {}).get("id")
+
+
+class FrontWebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, workers: list[WorkerProcess], counter, bot, tasks: set):
+        self.workers = workers
+        self.counter = counter
+        self.bot = bot
+        self.tasks = tasks
+
+    def post(self):
+        if self.request.headers.get("Content-Type", "").split(";")[0].strip() != "application/json":
+            raise tornado.web.HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+            key = update_routing_key(data)
+        except Exception as e:
+            M_ERRORS.inc(where="webhook", type=type(e).__name__)
+            raise tornado.web.HTTPError(400) from e
+        chat_id = admin_stats_chat(data)
+        if chat_id is not None:
+            task = asyncio.create_task(send_front_stats(self.bot, chat_id, self.workers))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+            self.set_status(200)
+            return
+        worker = self.workers[key % len(self.workers)]
+        if len(worker.backlog) >= WORKER_MAX_BACKLOG:
+            # Telegram retries the update later
+            M_ERRORS.inc(where="webhook", type="WorkerBacklogFull")
+            raise tornado.web.HTTPError(503)
+        worker.send(next(self.counter), self.request.body)
+        self.set_status(200)
+
+    def log_exception(self, typ, value, tb):
+        if not isinstance(value, tornado.web.HTTPError):
+            print("WEBHOOK ERROR:", repr(value))
+
+
+async def serve_front(n_workers: int):
+    workers = [WorkerProcess(i) for i in range(n_workers)]
+    metrics.add(Gauge(
+        "bot_worker_backlog", "Updates sent to a worker and not yet acked",
+        lambda: {(w.index,): len(w.backlog) for w in workers}, ("worker",),
+    ))
+    for w in workers:
+        w.run()
+
+    builder = ApplicationBuilder().token(TELEGRAM_TOKEN).updater(None)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    app = builder.build()
+
+    handler_args = {"workers": workers, "counter": itertools.count(1), "bot": app.bot, "tasks": set()}
+    web_app = tornado.web.Application(
+        [
+            (rf"/{TELEGRAM_TOKEN}/?", FrontWebhookHandler, handler_args),
+            (r"/metrics", FrontMetricsHandler, {"workers": workers}),
+        ],
+        log_function=lambda handler: None,
+    )
+    stop = stop_on_signals()
+    await app.initialize()
+    startup.mark("initialize")
+    try:
+        await ensure_webhook(app.bot)
+        startup.mark("webhook")
+        server = tornado.httpserver.HTTPServer(web_app)
+        server.listen(PORT, address="0.0.0.0")
+        startup.mark("listen")
+        print(f"Webhook front on :{PORT}, {n_workers} workers")
+        startup.report("STARTUP front")
+        await stop.wait()
+
+        server.stop()
+        await server.close_all_connections()
+    finally:
+        await asyncio.gather(*(w.stop() for w in workers))
+        await app.shutdown()
+
+
+def worker_control(command: str) -> str:
+    if command == "metrics":
+        return metrics.render()
+    if command == "stats":
+        return stats_text()
+    return ""
+
+
+async def run_worker():
+    # `python bot.py worker`, started by the front; updates come on stdin
+    ack_out = os.fdopen(os.dup(1), "wb", buffering=0)
+    os.dup2(2, 1)  # print() goes to stderr, stdout is only for acks
+
+    def write_out(data: bytes):
+        view = memoryview(data)
+        while view:
+            view = view[ack_out.write(view):]
+
+    subscription_store.ensure()
+    load_tier_index()
+    response_cache.load()
+    startup.mark("state")
+    app = build_application()
+    startup.mark("app")
+    await app.initialize()
+    startup.mark("initialize")
+    try:
+        start_background_tasks(app)
+        await app.start()
+        startup.mark("start")
+        startup.report(f"STARTUP worker {os.getpid()}")
+
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader(limit=2**20)
+        await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        tasks: set[asyncio.Task] = set()
+
+        async def handle(seq: int, body: bytes):
+            try:
+                update = Update.de_json(json.loads(body), app.bot)
+                await app.update_processor.process_update(update, app.process_update(update))
+            except Exception as e:
+                M_ERRORS.inc(where="worker", type=type(e).__name__)
+                print("WORKER ERROR:", repr(e))
+            finally:
+                write_out(b"%d\n" % seq)
+
+        while True:
+            header = await reader.readline()
+            if not header:
+                break
+            seq, length = map(int, header.split())
+            body = await reader.readexactly(length)
+            if seq == 0:
+                reply = worker_control(body.decode()).encode("utf-8")
+                write_out(b"ctl %d\n" % len(reply) + reply)
+                continue
+            task = asyncio.create_task(handle(seq, body))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        if tasks:
+            await asyncio.gather(*tasks)
+        await app.stop()
+    finally:
+        await app.shutdown()
+        await post_shutdown(app)
+
+
+startup.mark("module")
+
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:] == ["migrate-subscriptions"]:
+        # python bot.py migrate-subscriptions  ->  subscriptions.json => SUBSCRIPTIONS_DB (or Redis)
+        n = migrate_json_to_sqlite()
+        if SUBSCRIPTIONS_BACKEND == "redis":
+            print(f"Перенесено {n} підписок у Redis ({REDIS_PREFIX}subscriptions)")
+        else:
+            print(f"Перенесено {n} підписок у {SUBSCRIPTIONS_DB}. Тепер встанови SUBSCRIPTIONS_BACKEND=sqlite")
+    elif sys.argv[1:] == ["fetch-tokenizer"]:
+        # build step: download the tiktoken vocabulary into TOKENIZER_CACHE_DIR
+        _load_encoding()
+        print(f"Tokenizer {TOKENIZER_ENCODING} cached in {os.environ['TIKTOKEN_CACHE_DIR']}")
+    elif sys.argv[1:] == ["worker"]:
+        asyncio.run(run_worker())
+    else:
+        main()
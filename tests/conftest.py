@@ -0,0 +1,40 @@
+# bot.py reads its config from the environment at import time: set a
+# dummy one and run from a scratch directory, so importing the bot never
+# touches the real subscriptions/state files or the network.
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+os.environ.update({
+    "TELEGRAM_BOT_TOKEN": "123456:test",
+    "OPENAI_API_KEY": "sk-test",
+    "RENDER_EXTERNAL_URL": "https://test.invalid",
+    "USER_STATE_ENABLED": "0",
+    "OPENAI_HEDGE": "0",
+})
+os.chdir(tempfile.mkdtemp(prefix="bot_tests_"))
+
+import bot  # noqa: E402
+from fakes import FakeOpenAI  # noqa: E402
+
+
+@pytest.fixture
+def fake_openai(monkeypatch):
+    # a healthy upstream; start() / stop() inside the test's event loop
+    fake = FakeOpenAI(latency_median=0.01, latency_sigma=0.1, tokens_mean=20, tokens_sd=2, seed=1)
+    monkeypatch.setattr(bot, "OPENAI_BASE_URL", fake.base_url)
+    monkeypatch.setattr(bot, "client", bot.LazyOpenAIClient())
+    return fake
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    cb = bot.CircuitBreaker(failures=3, open_seconds=30)
+    monkeypatch.setattr(bot, "openai_breaker", cb)
+    return cb
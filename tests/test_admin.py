@@ -0,0 +1,44 @@
+import asyncio
+import csv
+import io
+from types import SimpleNamespace
+
+import bot
+
+ADMIN = 42
+
+
+class FakeMessage:
+    def __init__(self):
+        self.documents = []
+        self.texts = []
+
+    async def reply_document(self, document, filename, caption, reply_markup=None):
+        self.documents.append((filename, document))
+
+    async def reply_text(self, text, reply_markup=None):
+        self.texts.append(text)
+
+
+def test_export_paid_is_split_into_bounded_parts(monkeypatch):
+    ids = list(range(1, 2501))
+    monkeypatch.setattr(bot, "ADMIN_IDS", {ADMIN})
+    monkeypatch.setattr(bot, "EXPORT_PART_ROWS", 1000)
+    monkeypatch.setattr(bot, "_tier_index", {uid: "pro" for uid in ids})
+    monkeypatch.setattr(bot, "_tier_ids", {"all": ids, "pro": ids, "pro_plus": []})
+    monkeypatch.setattr(bot, "_refresh_tier_index_if_changed", lambda: None)
+    message = FakeMessage()
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=ADMIN), message=message)
+    context = SimpleNamespace(args=["pro"])
+
+    asyncio.run(bot.export_paid_cmd(update, context))
+
+    assert [name.rsplit("_", 1)[1] for name, _ in message.documents] == ["part1.csv", "part2.csv", "part3.csv"]
+    exported = []
+    for _, data in message.documents:
+        rows = list(csv.reader(io.StringIO(data.decode("utf-8"))))
+        assert rows[0] == ["user_id", "tier"]
+        assert len(rows) - 1 <= 1000
+        exported.extend(int(r[0]) for r in rows[1:])
+    assert exported == ids
+    assert "2500" in message.texts[-1]
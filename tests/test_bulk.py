@@ -0,0 +1,103 @@
+import asyncio
+import csv
+import io
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+ROWS = "назва;ціна\nЧай зелений;120\nКава;250\n"
+
+
+def write(tmp_path, name, data: bytes) -> str:
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+@pytest.mark.parametrize("encoding", ["utf-8", "utf-8-sig", "cp1251"])
+def test_csv_is_read_in_utf8_or_cp1251(tmp_path, encoding):
+    path = write(tmp_path, "input.csv", ROWS.encode(encoding))
+    assert bot.check_table_file(path) == 2
+    rows = list(bot.iter_table_rows(path))
+    assert rows[0] == ["назва", "ціна"]
+    assert rows[1] == ["Чай зелений", "120"]
+
+
+def test_binary_file_is_rejected(tmp_path):
+    path = write(tmp_path, "input.csv", b"PK\x03\x04\x00\x00garbage")
+    with pytest.raises(bot.BulkFileError):
+        bot.check_table_file(path)
+
+
+def test_undecodable_csv_is_rejected(tmp_path):
+    # 0x98 is unassigned in cp1251 and invalid as a UTF-8 start byte
+    path = write(tmp_path, "input.csv", b"name\n\x98\x98\n")
+    with pytest.raises(bot.BulkFileError):
+        bot.check_table_file(path)
+
+
+def test_header_only_is_rejected(tmp_path):
+    path = write(tmp_path, "input.csv", b"name;price\n")
+    with pytest.raises(bot.BulkFileError):
+        bot.check_table_file(path)
+
+
+class FakeMessage:
+    def __init__(self):
+        self.documents = []
+
+    async def reply_text(self, text, reply_markup=None):
+        return self
+
+    async def edit_text(self, text):
+        pass
+
+    async def reply_document(self, document, filename, caption, reply_markup=None):
+        self.documents.append((document, caption))
+
+
+def test_bulk_job_caps_non_empty_rows_and_removes_finished_dir(tmp_path, monkeypatch):
+    job_dir = tmp_path / "job"
+    job_dir.mkdir()
+    # blank lines between rows must not eat into the row cap
+    input_path = write(job_dir, "input.csv", "name\nA\n\n\nB\n  \nC\nD\n".encode())
+    monkeypatch.setattr(bot, "BULK_MAX_ROWS", 3)
+    monkeypatch.setattr(bot, "get_user_tier", lambda update: "pro_plus")
+
+    async def reserve(update, context, tier):
+        return True
+
+    async def call_openai(system_prompt, user_prompt, tier, mode, style):
+        return "опис " + user_prompt.rsplit(": ", 1)[-1]
+
+    monkeypatch.setattr(bot, "reserve_bulk_row", reserve)
+    monkeypatch.setattr(bot, "call_openai", call_openai)
+    message = FakeMessage()
+    update = SimpleNamespace(message=message, effective_user=SimpleNamespace(id=1))
+    context = SimpleNamespace(user_data={"profile": {}})
+
+    asyncio.run(bot.run_bulk_job(update, context, str(job_dir), input_path))
+
+    data, caption = message.documents[0]
+    rows = list(csv.reader(io.StringIO(data.decode("utf-8-sig"))))
+    assert [r[2] for r in rows[1:]] == ["опис A", "опис B", "опис C"]
+    assert caption.endswith("3/3")
+    assert not job_dir.exists()
+
+
+def test_sweep_removes_only_stale_jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "BULK_JOBS_DIR", str(tmp_path))
+    for name in ("stale", "fresh"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "results.csv").write_text("1,a,b\n")
+    old = time.time() - 100 * 3600
+    for path in (tmp_path / "stale" / "results.csv", tmp_path / "stale"):
+        os.utime(path, (old, old))
+
+    bot._sweep_bulk_jobs()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["fresh"]
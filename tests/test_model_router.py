@@ -0,0 +1,74 @@
+import asyncio
+
+import bot
+
+
+def test_router_prefers_fastest_healthy_model(monkeypatch):
+    monkeypatch.setattr(bot, "ROUTER_EXPLORE", 0.0)
+    router = bot.ModelRouter({"a": 1, "b": 1, "big": 2}, {"other": 1, "description": 2})
+    router.record("demo", "a", 2.0, ok=True)
+    router.record("demo", "b", 0.5, ok=True)
+    router.record("demo", "big", 0.1, ok=True)
+    assert router.pick("description") == "big"
+    for _ in range(10):
+        router.record("demo", "big", None, ok=False)
+    assert router.pick("demo") == "b"
+
+
+def test_unhealthy_model_becomes_eligible_again(monkeypatch):
+    monkeypatch.setattr(bot, "ROUTER_EXPLORE", 0.0)
+    monkeypatch.setattr(bot, "ROUTER_ERROR_HALF_LIFE", 60.0)
+    clock = [1000.0]
+    monkeypatch.setattr(bot.time, "monotonic", lambda: clock[0])
+    router = bot.ModelRouter({"a": 1, "b": 1}, {"other": 1})
+    router.record("demo", "a", 0.2, ok=True)
+    router.record("demo", "b", 1.0, ok=True)
+    for _ in range(10):
+        router.record("demo", "a", None, ok=False)
+    assert router.current_error_rate("a") > bot.ROUTER_MAX_ERROR_RATE
+    for _ in range(5):
+        router.record("demo", "b", 1.0, ok=True)  # traffic on "b" doesn't heal "a"
+        assert router.pick("demo") == "b"
+
+    clock[0] += 120  # two half-lives without results for "a"
+    assert router.current_error_rate("a") < bot.ROUTER_MAX_ERROR_RATE
+    assert router.pick("demo") == "a"
+
+
+def test_hedge_avoids_model_of_its_own_first_attempt(monkeypatch, fake_openai):
+    # another request routed in between must not change what the hedge avoids
+    fake_openai.latency_median = 0.5
+    router = bot.ModelRouter({"a": 1, "b": 1}, {"other": 1})
+    picks = []
+    pick = router.pick
+
+    def recording_pick(mode, avoid=None):
+        model = pick(mode, avoid)
+        picks.append((avoid, model))
+        return model
+
+    router.pick = recording_pick
+    monkeypatch.setattr(bot, "model_router", router)
+    monkeypatch.setattr(bot, "ROUTER_EXPLORE", 0.0)
+    monkeypatch.setattr(bot, "OPENAI_HEDGE", True)
+    monkeypatch.setattr(bot, "OPENAI_HEDGE_MAX_SHARE", 1.0)
+    monkeypatch.setattr(bot, "hedge_stats", bot.HedgeStats())
+    monkeypatch.setattr(bot.openai_latency, "percentile", lambda *args, **kwargs: 0.2)
+
+    async def scenario():
+        fake_openai.start()
+        try:
+            bot.client.get()  # import openai outside the timed part
+            task = asyncio.create_task(bot.request_completion("system", "user", "free", "demo"))
+            while not picks:
+                await asyncio.sleep(0.01)
+            router.pick("demo", avoid="a")  # a concurrent request lands on "b"
+            await task
+        finally:
+            await bot.client.close()
+            await fake_openai.stop()
+
+    asyncio.run(scenario())
+    assert picks[0] == (None, "a")
+    assert picks[-1] == ("a", "b")
+    assert bot.hedge_stats.hedged == 1
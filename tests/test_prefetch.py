@@ -0,0 +1,26 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+
+
+def test_prefetched_answer_survives_a_budget_change(monkeypatch):
+    budget = {"value": 300}
+    monkeypatch.setattr(bot.token_budget, "limit", lambda mode, style: budget["value"])
+
+    async def request_completion(system_prompt, user_prompt, tier, mode, style):
+        budget["value"] = 200  # the budget adapts while the prefetch runs...
+        message = SimpleNamespace(content="1) Так, є в наявності")
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=SimpleNamespace(total_tokens=80))
+
+    monkeypatch.setattr(bot, "request_completion", request_completion)
+    prefetcher = bot.QuickReplyPrefetcher()
+    key = prefetcher.prompt_key("system", "user")
+    asyncio.run(prefetcher._run(7, key, "system", "user", "style"))
+
+    budget["value"] = 250  # ...and again before the user taps
+    text, _, cache_key = prefetcher.take(7, "system", "user")
+    assert text == "1) Так, є в наявності"
+    assert cache_key == bot.ResponseCache.key("system", "user", bot.MODEL_NAME, 200)
+    assert prefetcher.stats()["hits"] == 1
+    assert prefetcher.take(7, "system", "user") is None
@@ -0,0 +1,66 @@
+# Several "replicas" (separate connections/clients on one store) race for
+# the same user's quota: the limit must never be exceeded.
+import asyncio
+
+import pytest
+
+import bot
+
+DAY = "2026-01-01"
+LIMIT = 10
+
+
+def sqlite_replicas(tmp_path, n):
+    path = str(tmp_path / "shared_state.db")
+    return [bot.SqliteQuotaBackend(path) for _ in range(n)]
+
+
+def redis_replicas(tmp_path, n):
+    # fakeredis[lua] comes from requirements-dev.txt; without it only the
+    # SQLite cases run
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    server = fakeredis.FakeServer()
+    replicas = []
+    for _ in range(n):
+        backend = bot.RedisQuotaBackend("redis://127.0.0.1:1/0", "test:")
+        backend._redis = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+        backend._reserve = backend._redis.register_script(backend.RESERVE)
+        backend._release = backend._redis.register_script(backend.RELEASE)
+        replicas.append(backend)
+    return replicas
+
+
+@pytest.fixture(params=[sqlite_replicas, redis_replicas], ids=["sqlite", "redis"])
+def replicas(request, tmp_path):
+    return request.param(tmp_path, 4)
+
+
+def test_concurrent_reserves_never_exceed_limit(replicas):
+    async def scenario():
+        results = await asyncio.gather(
+            *(replicas[i % len(replicas)].reserve(7, DAY, LIMIT, 0) for i in range(60))
+        )
+        allowed = [r for r in results if r[0]]
+        assert len(allowed) == LIMIT
+        assert sorted(r[2] for r in allowed) == list(range(1, LIMIT + 1))
+        assert {r[1] for r in results if not r[0]} == {"LIMIT_REACHED"}
+
+        # a released slot is taken exactly once
+        await replicas[0].release(7, DAY)
+        again = await asyncio.gather(*(r.reserve(7, DAY, LIMIT, 0) for r in replicas))
+        assert sum(1 for r in again if r[0]) == 1
+        for r in replicas:
+            await r.close()
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_demo_claims_succeed_once(replicas):
+    async def scenario():
+        claims = await asyncio.gather(*(replicas[i % len(replicas)].claim_demo(7, DAY) for i in range(20)))
+        assert claims.count(True) == 1
+        for r in replicas:
+            await r.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+def test_local_throttling_never_opens_circuit(monkeypatch, fake_openai, breaker):
+    # TPM bucket drained, short deadline, healthy upstream: requests fail
+    # locally with SchedulerBusy and the circuit stays closed
+    limiter = bot.OpenAIRateLimiter(600, 2000)
+    limiter.tokens.level = 0
+    monkeypatch.setattr(bot, "rate_limiter", limiter)
+    monkeypatch.setitem(bot.OPENAI_DEADLINES, "demo", 1.0)
+
+    async def scenario():
+        fake_openai.start()
+        try:
+            results = await asyncio.gather(
+                *(bot.request_completion("system", "user", "free", "demo") for _ in range(6)),
+                return_exceptions=True,
+            )
+            assert all(isinstance(r, bot.SchedulerBusy) for r in results), results
+            assert breaker.state == "closed"
+            assert fake_openai.requests == 0
+
+            limiter.tokens.level = limiter.tokens.capacity
+            bot.OPENAI_DEADLINES["demo"] = 25.0  # the first call also imports openai
+            resp = await bot.request_completion("system", "user", "free", "demo")
+            assert resp.choices[0].message.content
+        finally:
+            await bot.client.close()
+            await fake_openai.stop()
+
+    asyncio.run(scenario())
+
+
+def test_upstream_errors_open_circuit(monkeypatch, fake_openai, breaker):
+    fake_openai.error_rate = 1.0
+    monkeypatch.setattr(bot, "OPENAI_RETRY_BASE_SECONDS", 0.01)
+
+    async def scenario():
+        fake_openai.start()
+        try:
+            for _ in range(3):
+                with pytest.raises(bot.OpenAIUnavailable):
+                    await bot.request_completion("system", "user", "free", "demo")
+            assert breaker.state == "open"
+        finally:
+            await bot.client.close()
+            await fake_openai.stop()
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_attempt_keeps_token_estimate(monkeypatch, fake_openai):
+    # a cancelled request (hedge loser) may already be billed upstream
+    fake_openai.latency_median = 5.0
+    limiter = bot.OpenAIRateLimiter(600, 100000)
+    monkeypatch.setattr(bot, "rate_limiter", limiter)
+
+    async def scenario():
+        fake_openai.start()
+        try:
+            task = asyncio.create_task(
+                bot._completion_attempt("system", "user", "free", "demo", "", asyncio.get_running_loop().time() + 10)
+            )
+            await asyncio.sleep(0.3)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert limiter.tokens.level < limiter.tokens.capacity - 100
+        finally:
+            await bot.client.close()
+            await fake_openai.stop()
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("streaming", [False, True], ids=["completion", "stream"])
+def test_cancelled_probe_reopens_the_probe_slot(monkeypatch, fake_openai, breaker, streaming):
+    # the half-open probe is cancelled (user gone, shutdown): the next
+    # request must become the new probe instead of being rejected forever
+    fake_openai.latency_median = 5.0
+    breaker.state, breaker.open_seconds = "open", 0.0
+
+    async def probe():
+        if streaming:
+            async for _ in bot.stream_openai("system", "user", "free", "demo"):
+                pass
+        else:
+            await bot.request_completion("system", "user", "free", "demo")
+
+    async def scenario():
+        fake_openai.start()
+        try:
+            task = asyncio.create_task(probe())
+            while fake_openai.in_flight == 0:
+                await asyncio.sleep(0.01)
+            assert breaker.state == "half_open" and not breaker.allow()
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            assert breaker.allow()
+        finally:
+            await bot.client.close()
+            await fake_openai.stop()
+
+    asyncio.run(scenario())
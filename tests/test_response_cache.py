@@ -0,0 +1,27 @@
+import bot
+
+
+def sample(name: str, default: float | None = None) -> float:
+    for line in bot.metrics.render().splitlines():
+        if line.startswith(name + " ") or line.startswith(name + "{"):
+            return float(line.rsplit(" ", 1)[1])
+    if default is not None:
+        return default
+    raise AssertionError(f"{name} not exported")
+
+
+def test_cache_hits_and_saved_time_are_exported(monkeypatch):
+    cache = bot.ResponseCache(10, 3600, 1)
+    monkeypatch.setattr(bot, "response_cache", cache)
+    saved_before = sample("bot_response_cache_saved_seconds_total", 0.0)  # the counter is process-wide
+
+    key = bot.ResponseCache.key("system", "user", "model", 300)
+    assert cache.get(key) is None
+    cache.put(key, "answer", 1.5)
+    assert cache.get(key) == "answer"
+    assert cache.get(key) == "answer"
+
+    assert sample("bot_response_cache_hit_ratio") == 2 / 3
+    assert sample("bot_response_cache_entries") == 1
+    assert 'bot_response_cache_lookups_total{result="hit"}' in bot.metrics.render()
+    assert sample("bot_response_cache_saved_seconds_total") - saved_before == 3.0
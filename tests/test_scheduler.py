@@ -0,0 +1,28 @@
+import asyncio
+
+import bot
+
+
+def test_queue_position_counts_requests_served_first():
+    gate = bot.TierScheduler(1, 0)
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def hold(tier):
+            async with gate.slot(tier):
+                await release.wait()
+
+        tasks = [asyncio.create_task(hold(t)) for t in ("free", "free", "pro", "pro_plus")]
+        while gate.waiting < 3:
+            await asyncio.sleep(0)
+        # one free in flight; waiting: free, pro, pro_plus
+        assert gate.queue_position("pro_plus") == 2
+        assert gate.queue_position("pro") == 3
+        assert gate.queue_position("free") == 4
+        assert gate.stats()["tiers"]["pro"]["position"] == 3
+        release.set()
+        await asyncio.gather(*tasks)
+        assert gate.queue_position("free") == 1
+
+    asyncio.run(scenario())
@@ -0,0 +1,44 @@
+import asyncio
+import time
+
+import bot
+
+
+class FakeMessage:
+    def __init__(self):
+        self.edits = []
+
+    async def edit_text(self, text):
+        self.edits.append(text)
+
+
+def run_stream(deltas, gap):
+    message = FakeMessage()
+
+    async def scenario():
+        streaming = bot.StreamingMessage(message)
+        for delta in deltas:
+            streaming.push(delta)
+            await asyncio.sleep(gap)
+        t0 = time.monotonic()
+        await streaming.finish(None, None)
+        return time.monotonic() - t0
+
+    return message.edits, asyncio.run(scenario())
+
+
+def test_fast_answer_gets_only_the_final_edit(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 1.0)
+    edits, finish_seconds = run_stream(["Добрий ", "день! ", "Так, є."], 0.01)
+    assert edits == ["Добрий день! Так, є."]
+    assert finish_seconds < 0.1
+
+
+def test_slow_answer_shows_previews_then_final_text(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_EDIT_INTERVAL", 0.1)
+    monkeypatch.setattr(bot, "STREAM_EDIT_MIN_CHARS", 5)
+    edits, finish_seconds = run_stream([f"слово{i} " for i in range(10)], 0.03)
+    assert len(edits) >= 2
+    assert all(e.endswith("▌") for e in edits[:-1])
+    assert edits[-1] == "".join(f"слово{i} " for i in range(10))
+    assert finish_seconds < 0.1  # no wait for the throttle window
@@ -0,0 +1,47 @@
+import asyncio
+import types
+
+import bot
+
+
+def test_counting_never_loads_the_tokenizer(monkeypatch):
+    # the request path uses the heuristic until load_tokenizer() is done
+    monkeypatch.setattr(bot, "_encoding", None)
+    monkeypatch.setattr(bot, "_load_encoding", lambda: (_ for _ in ()).throw(AssertionError("loaded on request path")))
+    text = "Кросівки Nike Air Max 90, шкіра, розміри 40-45"
+    assert 0 < bot.count_tokens(text) < len(text)
+    assert bot.count_tokens(bot.truncate_tokens(text * 50, 100)) <= 100
+
+
+def test_load_tokenizer_retries_after_failure(monkeypatch):
+    monkeypatch.setattr(bot, "_encoding", None)
+    attempts = []
+
+    def flaky_load():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("vocabulary download failed")
+        bot._encoding = types.SimpleNamespace(encode=lambda text, **kwargs: text.split())
+
+    async def no_sleep(delay):
+        pass
+
+    monkeypatch.setattr(bot, "_load_encoding", flaky_load)
+    monkeypatch.setattr(bot.asyncio, "sleep", no_sleep)
+    asyncio.run(bot.load_tokenizer())
+    assert len(attempts) == 3
+    assert bot.count_tokens("a b c") == 3
+
+
+def test_token_budget_shrinks_and_grows_back(monkeypatch):
+    monkeypatch.setattr(bot, "TOKEN_BUDGET_MIN_SAMPLES", 10)
+    budget = bot.TokenBudget()
+    usage = types.SimpleNamespace
+    for _ in range(20):
+        budget.record("quick_replies", "⚡ Коротко", usage(completion_tokens=100), "stop")
+    small = budget.limit("quick_replies", "⚡ Коротко")
+    assert small < bot.MAX_TOKENS
+    assert budget.limit("description", "⚡ Коротко") == bot.MAX_TOKENS
+    budget.record("quick_replies", "⚡ Коротко", usage(completion_tokens=small), "length")
+    assert budget.limit("quick_replies", "⚡ Коротко") == bot.MAX_TOKENS
+
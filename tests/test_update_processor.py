@@ -0,0 +1,48 @@
+import asyncio
+import random
+
+from telegram import Update
+
+import bot
+from fakes import update_json
+
+USERS = 12
+PER_USER = 8
+LIMIT = 4
+
+
+def test_per_user_order_and_global_limit():
+    processor = bot.PerUserUpdateProcessor(LIMIT)
+    rng = random.Random(1)
+    handled: dict[int, list[int]] = {}
+    state = {"running": 0, "max": 0}
+    user_busy: set[int] = set()
+
+    async def handle(uid: int, n: int):
+        assert uid not in user_busy, "two updates of one user ran at once"
+        user_busy.add(uid)
+        state["running"] += 1
+        state["max"] = max(state["max"], state["running"])
+        await asyncio.sleep(rng.uniform(0, 0.005))
+        state["running"] -= 1
+        user_busy.discard(uid)
+        handled.setdefault(uid, []).append(n)
+
+    async def scenario():
+        await processor.initialize()
+        jobs, update_id = [], 0
+        for n in range(PER_USER):
+            for uid in range(1000, 1000 + USERS):
+                update_id += 1
+                update = Update.de_json(update_json(update_id, uid, f"msg {n}"), None)
+                jobs.append(asyncio.create_task(processor.process_update(update, handle(uid, n))))
+                await asyncio.sleep(0)  # arrival order = creation order
+        await asyncio.gather(*jobs)
+        await processor.shutdown()
+
+    asyncio.run(scenario())
+
+    assert handled == {uid: list(range(PER_USER)) for uid in range(1000, 1000 + USERS)}
+    assert state["max"] == LIMIT  # different users did run concurrently, never above the cap
+    assert processor.running == 0
+    assert processor._user_locks == {}
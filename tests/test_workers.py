@@ -0,0 +1,104 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+import tornado.web
+
+import bot
+from fakes import FakeBotAPI
+
+
+def test_worker_path_is_per_worker(monkeypatch):
+    monkeypatch.setattr(bot, "WORKER_INDEX", "")
+    assert bot.worker_path("media_cache.json") == "media_cache.json"
+    monkeypatch.setattr(bot, "WORKER_INDEX", "2")
+    assert bot.worker_path("media_cache.json") == "media_cache.w2.json"
+    assert bot.worker_path("cache/responses.json") == "cache/responses.w2.json"
+    assert bot.worker_path("") == ""
+
+
+def test_merge_metrics_labels_worker_samples():
+    front = (
+        "# HELP bot_updates_total Updates\n"
+        "# TYPE bot_updates_total counter\n"
+        "bot_updates_total 3\n"
+    )
+    worker = (
+        "# HELP bot_updates_total Updates\n"
+        "# TYPE bot_updates_total counter\n"
+        "bot_updates_total 5\n"
+        "# HELP bot_errors_total Errors\n"
+        "# TYPE bot_errors_total counter\n"
+        'bot_errors_total{where="worker",type="KeyError"} 1\n'
+    )
+    merged = bot.merge_metrics(front, [(0, worker), (1, worker)]).splitlines()
+    assert merged.count("# HELP bot_updates_total Updates") == 1
+    assert merged[:5] == [
+        "# HELP bot_updates_total Updates",
+        "# TYPE bot_updates_total counter",
+        "bot_updates_total 3",
+        'bot_updates_total{worker="0"} 5',
+        'bot_updates_total{worker="1"} 5',
+    ]
+    assert 'bot_errors_total{worker="1",where="worker",type="KeyError"} 1' in merged
+
+
+def test_worker_answers_control_requests(monkeypatch):
+    # a real `bot.py worker` process against a fake Bot API
+    telegram = FakeBotAPI()
+
+    async def scenario():
+        telegram.start()
+        monkeypatch.setenv("TELEGRAM_API_BASE_URL", telegram.base_url)
+        w = bot.WorkerProcess(3)
+        await w.start()
+        reader = asyncio.create_task(w._read_acks())
+        try:
+            text, stats = await asyncio.gather(w.control("metrics", timeout=60), w.control("stats", timeout=60))
+            assert "# TYPE bot_errors_total counter" in text
+            assert stats.startswith("📊")
+        finally:
+            w.proc.stdin.close()
+            await asyncio.wait_for(w.proc.wait(), 30)
+            await reader
+            await telegram.stop()
+
+    asyncio.run(scenario())
+
+
+def test_build_application_twice_keeps_one_metric_family():
+    bot.build_application()
+    bot.build_application()
+    types = [line for line in bot.metrics.render().splitlines() if line.startswith("# TYPE ")]
+    assert len(types) == len(set(types))
+    assert "# TYPE bot_updates_in_flight gauge" in types
+
+
+def test_metrics_need_token_or_localhost(monkeypatch):
+    def handler(ip, auth=None):
+        headers = {"Authorization": auth} if auth else {}
+        return SimpleNamespace(request=SimpleNamespace(remote_ip=ip, headers=headers))
+
+    monkeypatch.setattr(bot, "METRICS_TOKEN", "")
+    bot.check_metrics_access(handler("127.0.0.1"))
+    with pytest.raises(tornado.web.HTTPError) as e:
+        bot.check_metrics_access(handler("203.0.113.5"))
+    assert e.value.status_code == 403
+
+    monkeypatch.setattr(bot, "METRICS_TOKEN", "secret")
+    bot.check_metrics_access(handler("203.0.113.5", "Bearer secret"))
+    with pytest.raises(tornado.web.HTTPError) as e:
+        bot.check_metrics_access(handler("127.0.0.1"))
+    assert e.value.status_code == 401
+
+
+def test_several_workers_need_a_shared_subscription_store(monkeypatch):
+    monkeypatch.setattr(bot, "WORKERS", 2)
+    monkeypatch.setattr(bot, "SUBSCRIPTIONS_BACKEND", "json")
+    with pytest.raises(ValueError):
+        bot.check_worker_config()
+    monkeypatch.setattr(bot, "SUBSCRIPTIONS_BACKEND", "sqlite")
+    bot.check_worker_config()
+    monkeypatch.setattr(bot, "WORKERS", 1)
+    monkeypatch.setattr(bot, "SUBSCRIPTIONS_BACKEND", "json")
+    bot.check_worker_config()  # one worker is the only writer